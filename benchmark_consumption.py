@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк расчета расхода: сравнение с прежним квадратичным алгоритмом
+
+Генерирует длинные истории (ежедневные ревизии, частые поставки), проверяет,
+что новые функции дают результат, совпадающий с эталоном до последнего бита,
+и печатает время работы.
+
+Использование:
+    python benchmark_consumption.py [дней] [товаров]
+"""
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+from utils.calculations import calculate_average_consumption
+from utils.consumption import (
+    consumption_gaps, period_totals, company_gaps_python, company_gaps_numpy, np
+)
+
+
+# ---------------------------------------------------------------------------
+# Эталон: прежние реализации (O(интервалы × поставки)), скопированы без изменений
+# ---------------------------------------------------------------------------
+
+def legacy_consumption_totals(history, supplies):
+    """Цикл из DatabasePG.calculate_consumption до перехода на utils.consumption"""
+    total_consumed_qty = 0.0
+    total_consumed_weight = 0.0
+    total_valid_days = 0
+
+    for i in range(len(history) - 1):
+        cur_rec = history[i]
+        nxt_rec = history[i+1]
+
+        days_between = (nxt_rec['date'] - cur_rec['date']).days
+        if days_between <= 0: continue
+
+        if cur_rec['quantity'] <= 0 and nxt_rec['quantity'] <= 0:
+            continue
+
+        gap_supplies_qty = sum(s['boxes'] for s in supplies if cur_rec['date'] < s['date'] <= nxt_rec['date'])
+        gap_supplies_wgt = sum(s['weight'] for s in supplies if cur_rec['date'] < s['date'] <= nxt_rec['date'])
+
+        consumed_qty = cur_rec['quantity'] + gap_supplies_qty - nxt_rec['quantity']
+        consumed_wgt = cur_rec['weight'] + gap_supplies_wgt - nxt_rec['weight']
+
+        if consumed_qty < 0:
+            continue
+
+        total_valid_days += days_between
+        total_consumed_qty += consumed_qty
+        total_consumed_weight += consumed_wgt
+
+    return total_consumed_qty, total_consumed_weight, total_valid_days
+
+
+def legacy_average_consumption(history, supplies=None):
+    """utils.calculations.calculate_average_consumption до перехода на SupplyIndex"""
+    if len(history) < 2:
+        return 0.0, 0, "Недостаточно данных (менее 2 дней)"
+
+    if supplies is None:
+        supplies = []
+
+    history_sorted = sorted(history, key=lambda x: x['date'])
+
+    daily_consumptions = []
+
+    for i in range(len(history_sorted) - 1):
+        current = history_sorted[i]
+        next_record = history_sorted[i + 1]
+
+        current_stock = current['weight']
+        next_stock = next_record['weight']
+        current_date = current['date']
+        next_date = next_record['date']
+
+        if current_stock == 0 or next_stock == 0:
+            continue
+
+        supply_weight = 0.0
+        for supply in supplies:
+            supply_date = supply['date']
+            if current_date <= supply_date <= next_date:
+                if supply_date == current_date:
+                    if current_stock >= supply['weight'] * 0.9:
+                        continue
+                supply_weight += supply['weight']
+
+        consumption = current_stock + supply_weight - next_stock
+
+        if consumption < 0:
+            continue
+
+        days_diff = (next_date - current_date).days
+        if days_diff <= 0:
+            continue
+
+        daily_consumption = consumption / days_diff
+        daily_consumptions.append((daily_consumption, consumption, days_diff, i))
+
+    if len(daily_consumptions) == 0:
+        return 0.0, 0, "Нет валидных периодов для расчета"
+
+    total_consumption_preliminary = sum(dc[1] for dc in daily_consumptions)
+    total_days_preliminary = sum(dc[2] for dc in daily_consumptions)
+    avg_daily_preliminary = total_consumption_preliminary / total_days_preliminary
+
+    ANOMALY_THRESHOLD = 5.0
+    filtered_consumptions = []
+    anomalies_found = 0
+
+    for daily_consumption, consumption, days_diff, idx in daily_consumptions:
+        if daily_consumption > avg_daily_preliminary * ANOMALY_THRESHOLD:
+            anomalies_found += 1
+            continue
+        filtered_consumptions.append((consumption, days_diff))
+
+    if len(filtered_consumptions) == 0:
+        warning = "(все данные аномальные, расчёт может быть неточным)"
+        return avg_daily_preliminary, total_days_preliminary, warning
+
+    total_consumed = sum(fc[0] for fc in filtered_consumptions)
+    total_days = sum(fc[1] for fc in filtered_consumptions)
+    avg_consumption = total_consumed / total_days
+
+    warning = ""
+    if len(filtered_consumptions) < 3:
+        warning = "(мало данных, риск неправильного расчета)"
+    elif anomalies_found > 0:
+        warning = f"(исключено {anomalies_found} аномальных дней)"
+
+    return avg_consumption, total_days, warning
+
+
+# ---------------------------------------------------------------------------
+# Генерация данных
+# ---------------------------------------------------------------------------
+
+def generate_product(rng: random.Random, days: int):
+    """История с ежедневными ревизиями, пропусками, нулями и частыми поставками"""
+    start = date(2025, 1, 1)
+    package_weight = rng.choice([0.5, 1.0, 2.5])
+    history = []
+    supplies = []
+    quantity = rng.uniform(10, 40)
+
+    for d in range(days):
+        day = start + timedelta(days=d)
+        # Поставки: иногда несколько в день, иногда в день ревизии
+        for _ in range(rng.choice([0, 0, 1, 1, 2, 3])):
+            boxes = rng.uniform(1, 15)
+            supplies.append({'date': day, 'boxes': boxes, 'weight': boxes * package_weight})
+            quantity += boxes
+        quantity = max(0.0, quantity - rng.uniform(0, 8))
+        if rng.random() < 0.05:
+            quantity = 0.0
+        if rng.random() < 0.9:
+            history.append({'date': day, 'quantity': quantity, 'weight': quantity * package_weight})
+
+    # Поставки из API не всегда отсортированы - перемешиваем часть товаров
+    if rng.random() < 0.5:
+        rng.shuffle(supplies)
+    return history, supplies
+
+
+def company_rows(dataset):
+    """Строки остатков и поставок компании в формате запросов DatabasePG"""
+    stock_rows = []
+    supply_rows = []
+    for pid, (history, supplies) in enumerate(dataset, start=1):
+        stock_rows.extend(dict(r, product_id=pid) for r in history)
+        supply_rows.extend(dict(s, product_id=pid) for s in supplies)
+    # Поставки из БД идут без сортировки - перемешиваем между товарами
+    random.Random(7).shuffle(supply_rows)
+    return stock_rows, supply_rows
+
+
+def compare_backends(dataset):
+    """Проверить, что numpy-бэкенд company_gaps (заполнение consumption_gaps) совпадает с Python"""
+    stock_rows, supply_rows = company_rows(dataset)
+
+    started = time.perf_counter()
+    expected = company_gaps_python(stock_rows, supply_rows)
+    python_elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    actual = company_gaps_numpy(stock_rows, supply_rows)
+    numpy_elapsed = time.perf_counter() - started
+
+    assert expected == actual, "numpy-бэкенд расходится с Python"
+    return python_elapsed, numpy_elapsed
+
+
+def main():
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 365
+    products = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    rng = random.Random(42)
+    dataset = [generate_product(rng, days) for _ in range(products)]
+    print(f"📊 Товаров: {products}, дней истории: {days}, "
+          f"поставок: {sum(len(s) for _, s in dataset)}")
+
+    # Проверка совпадения результатов
+    for history, supplies in dataset:
+        expected = legacy_consumption_totals(history, supplies)
+        actual = period_totals(consumption_gaps(history, supplies))
+        assert expected == actual, f"calculate_consumption: {expected} != {actual}"
+
+        expected = legacy_average_consumption(history, supplies)
+        actual = calculate_average_consumption(history, supplies)
+        assert expected == actual, f"calculate_average_consumption: {expected} != {actual}"
+    print("✅ Результаты совпадают с эталоном")
+
+    def timed(fn):
+        started = time.perf_counter()
+        for history, supplies in dataset:
+            fn(history, supplies)
+        return time.perf_counter() - started
+
+    rows = [
+        ("calculate_consumption (старый)", timed(legacy_consumption_totals)),
+        ("calculate_consumption (новый)", timed(lambda h, s: period_totals(consumption_gaps(h, s)))),
+        ("calculate_average_consumption (старый)", timed(legacy_average_consumption)),
+        ("calculate_average_consumption (новый)", timed(calculate_average_consumption)),
+    ]
+
+    if np is not None:
+        # Маленькие компании и крайние случаи (один товар, одна строка, без поставок)
+        for seed in range(50):
+            small_rng = random.Random(seed)
+            small = [generate_product(small_rng, small_rng.randint(1, 40)) for _ in range(small_rng.randint(1, 5))]
+            small = [(h, s if small_rng.random() < 0.8 else []) for h, s in small if h]
+            if small:
+                compare_backends(small)
+        python_elapsed, numpy_elapsed = compare_backends(dataset)
+        print("✅ numpy-бэкенд совпадает с Python")
+        rows.append(("company_gaps по компании (python)", python_elapsed))
+        rows.append(("company_gaps по компании (numpy)", numpy_elapsed))
+    else:
+        print("ℹ️ numpy не установлен - сравнение бэкендов пропущено")
+
+    for name, elapsed in rows:
+        print(f"  {name:<42} {elapsed * 1000:9.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Общая конфигурация процессов WeDrink
+
+Все роли (web, bot, scheduler и совмещенный режим all) читают одни и те же
+переменные окружения через Settings.from_env(), поэтому их можно запускать
+как одним процессом, так и отдельными сервисами с общим .env.
+
+Переменные окружения:
+    APP_ROLE          - роль процесса по умолчанию: all, web, bot, scheduler (по умолчанию all)
+    BOT_TOKEN         - токен бота
+    DATABASE_URL      - PostgreSQL (на Railway); без него используется SQLite
+    DATABASE_PATH     - файл SQLite, по умолчанию wedrink.db
+    PORT              - порт веб-сервера, по умолчанию 5000
+    WEB_WORKERS       - процессов веб-сервера в роли web (SO_REUSEPORT), по умолчанию 1
+    BOT_MODE          - polling (по умолчанию) или webhook
+    WEBHOOK_BASE_URL  - публичный URL для webhook, по умолчанию WEB_APP_URL
+    WEBHOOK_PATH      - путь webhook, по умолчанию /telegram/webhook
+    WEBHOOK_SECRET    - секрет X-Telegram-Bot-Api-Secret-Token (обязателен для webhook)
+    SESSION_KEY       - ключ шифрования cookie сессий сайта (обязателен при WEB_WORKERS > 1 и webhook)
+"""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROLES = ('all', 'web', 'bot', 'scheduler')
+
+
+class Settings:
+    """Настройки процесса"""
+
+    def __init__(self, role: str = 'all', bot_token: str = None, database_url: str = None,
+                 database_path: str = 'wedrink.db', port: int = 5000, web_workers: int = 1,
+                 bot_mode: str = 'polling', webhook_base_url: str = None,
+                 webhook_path: str = '/telegram/webhook', webhook_secret: str = None,
+                 session_key: str = None):
+        self.role = role
+        self.bot_token = bot_token
+        self.database_url = database_url
+        self.database_path = database_path
+        self.port = port
+        self.web_workers = web_workers
+        self.bot_mode = bot_mode
+        self.webhook_base_url = webhook_base_url
+        self.webhook_path = webhook_path
+        self.webhook_secret = webhook_secret
+        self.session_key = session_key
+
+    @classmethod
+    def from_env(cls, role: str = None) -> "Settings":
+        return cls(
+            role=(role or os.getenv('APP_ROLE', 'all')).lower(),
+            bot_token=os.getenv('BOT_TOKEN'),
+            database_url=os.getenv('DATABASE_URL'),
+            database_path=os.getenv('DATABASE_PATH', 'wedrink.db'),
+            port=int(os.getenv('PORT', 5000)),
+            web_workers=max(1, int(os.getenv('WEB_WORKERS', 1))),
+            bot_mode=os.getenv('BOT_MODE', 'polling').lower(),
+            webhook_base_url=os.getenv('WEBHOOK_BASE_URL') or os.getenv('WEB_APP_URL'),
+            webhook_path=os.getenv('WEBHOOK_PATH', '/telegram/webhook'),
+            webhook_secret=os.getenv('WEBHOOK_SECRET'),
+            session_key=os.getenv('SESSION_KEY'),
+        )
+
+    @property
+    def use_webhook(self) -> bool:
+        return self.bot_mode == 'webhook'
+
+    @property
+    def webhook_url(self) -> str:
+        return self.webhook_base_url.rstrip('/') + self.webhook_path
+
+    def validate(self):
+        """Проверить согласованность настроек до запуска"""
+        if self.role not in ROLES:
+            raise ValueError(f"Неизвестная роль {self.role!r}, допустимые: {', '.join(ROLES)}")
+        if self.bot_mode not in ('polling', 'webhook'):
+            raise ValueError(f"BOT_MODE должен быть polling или webhook, получено {self.bot_mode!r}")
+        if not self.bot_token:
+            raise ValueError("BOT_TOKEN не задан")
+        if self.use_webhook and (not self.webhook_base_url or not self.webhook_secret):
+            raise ValueError("BOT_MODE=webhook требует WEBHOOK_BASE_URL (или WEB_APP_URL) и WEBHOOK_SECRET")
+        if self.role == 'bot' and self.use_webhook:
+            raise ValueError("В режиме webhook обновления принимают web-процессы: роль bot не нужна")
+        if self.role in ('all', 'web') and not self.session_key and (self.web_workers > 1 or self.use_webhook):
+            # Без общего ключа каждый процесс шифрует cookie своим случайным ключом,
+            # и сессия, открытая в одном процессе, не читается в другом
+            raise ValueError("WEB_WORKERS > 1 или BOT_MODE=webhook требуют общий SESSION_KEY для всех процессов")
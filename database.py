@@ -239,6 +239,37 @@ class Database:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
+    async def get_stock_histories(self, product_ids: List[int], days: int = 7) -> Dict[int, List[Dict]]:
+        """История остатков по многим товарам одним запросом: {product_id: [ревизии]}"""
+        return await self._fetch_histories('stock', product_ids, days)
+
+    async def get_supply_histories(self, product_ids: List[int], days: int = 14) -> Dict[int, List[Dict]]:
+        """История поставок по многим товарам одним запросом: {product_id: [поставки]}"""
+        return await self._fetch_histories('supplies', product_ids, days)
+
+    async def _fetch_histories(self, table: str, product_ids: List[int], days: int) -> Dict[int, List[Dict]]:
+        """Последние `days` записей таблицы по каждому товару, новые первыми"""
+        histories = {product_id: [] for product_id in product_ids}
+        if not histories:
+            return histories
+        placeholders = ",".join("?" * len(histories))
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(f"""
+                SELECT * FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY product_id ORDER BY date DESC) AS rn
+                    FROM {table}
+                    WHERE product_id IN ({placeholders})
+                )
+                WHERE rn <= ?
+                ORDER BY product_id, date DESC
+            """, (*histories, days)) as cursor:
+                async for row in cursor:
+                    record = dict(row)
+                    del record['rn']
+                    histories[record['product_id']].append(record)
+        return histories
+
     async def calculate_consumption(self, start_date: str, end_date: str) -> List[Dict]:
         """Расчет расхода между двумя датами"""
         async with aiosqlite.connect(self.db_path) as db:
@@ -464,6 +495,12 @@ class Database:
     async def get_pending_order_items(self, order_id: int) -> List[Dict]:
         return []
 
+    async def get_pending_orders_with_items(self) -> List[Dict]:
+        return []
+
+    async def get_pending_order_with_items(self, order_id: int) -> Optional[Dict]:
+        return None
+
     async def add_item_to_order(self, order_id: int, product_id: int,
                                 boxes: int, weight: float, cost: float):
         raise NotImplementedError("Pending orders доступны только с PostgreSQL")
@@ -1,266 +1,316 @@
 """
 База данных PostgreSQL для учета складских остатков WeDrink (Multi-Tenant SaaS)
 """
+import asyncio
 import asyncpg
+import contextlib
+import json
 import os
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional, Sequence
 from datetime import datetime
+from utils.consumption import company_gaps, parse_windows
+from utils.query_cache import QueryCache, cached_query, invalidates_cache
+from migrations import apply_migrations, current_version, latest_version
+
+# Канал LISTEN/NOTIFY для сброса локальных кэшей во всех процессах
+CHANGE_CHANNEL = 'company_changed'
+
+# Пространство ключей pg_advisory_xact_lock(ns, product_id) для пересчета consumption_gaps
+CONSUMPTION_GAPS_LOCK_NS = 7301
+
+
+class _TimedAcquire:
+    """Обертка над pool.acquire(), считающая таймауты ожидания соединения"""
+
+    def __init__(self, db, ctx):
+        self._db = db
+        self._ctx = ctx
+
+    async def __aenter__(self):
+        try:
+            return await self._ctx.__aenter__()
+        except asyncio.TimeoutError:
+            self._db._acquire_timeouts += 1
+            raise
+
+    async def __aexit__(self, *exc):
+        return await self._ctx.__aexit__(*exc)
+
 
 class DatabasePG:
-    def __init__(self, database_url: str):
+    def __init__(self, database_url: str, min_size: int = None, max_size: int = None,
+                 acquire_timeout: float = None):
         self.database_url = database_url
         self.pool = None
+        # Один пул на процесс (бот, веб-сервер и планировщик получают этот объект)
+        self.min_size = min_size if min_size is not None else int(os.getenv('DB_POOL_MIN_SIZE', 1))
+        self.max_size = max_size if max_size is not None else int(os.getenv('DB_POOL_MAX_SIZE', 10))
+        self.acquire_timeout = acquire_timeout if acquire_timeout is not None else float(os.getenv('DB_POOL_TIMEOUT', 30))
+        self._acquire_count = 0
+        self._acquire_timeouts = 0
+        # Окна (в днях) для расчета умного среднего расхода, например CONSUMPTION_WINDOWS=30,60,90
+        self.consumption_windows = parse_windows(os.getenv('CONSUMPTION_WINDOWS'))
+        # Кэш чтений с версиями данных компаний (None, если QUERY_CACHE_TTL=0)
+        self.query_cache = QueryCache.from_env()
+        # Межпроцессный сброс кэшей: NOTIFY company_changed '<company_id>:<entity>'
+        self.notify_changes = os.getenv('DB_NOTIFY_CHANGES', '1') != '0'
+        self._change_handlers: List[Callable[[Optional[int], str], None]] = []
+        # Дополнительные каналы на том же слушающем соединении: channel -> [callback(payload или None)]
+        self._channel_handlers: Dict[str, List[Callable[[Optional[str]], None]]] = {}
+        self._listener_conn = None
+        self._listener_task = None
 
     async def init_db(self):
-        """Инициализация пула соединений и создание таблиц (Multi-Tenant)"""
-        self.pool = await asyncpg.create_pool(
+        """Инициализация пула соединений и проверка версии схемы (Multi-Tenant)"""
+        if self.pool is not None:
+            # Пул уже создан (общий экземпляр для бота, веб-сервера и планировщика)
+            return
+
+        self.pool = await self._create_pool()
+
+        # DDL больше не выполняется при каждом старте: схема ведется миграциями
+        # (migrations/*.sql), здесь только сверяется версия
+        await self.ensure_schema()
+
+        print("✅ PostgreSQL SaaS база данных инициализирована")
+
+    async def _create_pool(self):
+        return await asyncpg.create_pool(
             self.database_url,
-            min_size=1,
-            max_size=10,
+            min_size=self.min_size,
+            max_size=self.max_size,
             ssl='require',
             statement_cache_size=0,
             max_cached_statement_lifetime=0
         )
 
-        async with self.pool.acquire() as conn:
-            # 1. Companies Table
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS companies (
-                    id SERIAL PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    subscription_status TEXT DEFAULT 'trial' CHECK (subscription_status IN ('trial', 'active', 'expired', 'cancelled')),
-                    subscription_ends_at TIMESTAMP,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # Migration: Add shift columns if they are missing
-            await conn.execute("""
-                ALTER TABLE companies
-                ADD COLUMN IF NOT EXISTS default_shift_start TIME,
-                ADD COLUMN IF NOT EXISTS default_shift_end TIME;
-            """)
+    async def ensure_schema(self):
+        """
+        Проверить, что схема БД не старше кода
 
-            # 2. Users Table
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id BIGINT PRIMARY KEY,
-                    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    real_name TEXT,
-                    role TEXT DEFAULT 'user',
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+        В обычном случае это один запрос к schema_migrations. Если версия отстает
+        (первый запуск после деплоя без run_migrations.py), миграции применяются
+        здесь же под advisory lock, если не задано DB_AUTO_MIGRATE=0.
+        """
+        expected = latest_version()
+        async with self.acquire() as conn:
+            version = await current_version(conn)
 
-            # 3. Products Table
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS products (
-                    id SERIAL PRIMARY KEY,
-                    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
-                    name_chinese TEXT,
-                    name_russian TEXT,
-                    name_internal TEXT NOT NULL,
-                    package_weight REAL NOT NULL,
-                    units_per_box INTEGER NOT NULL,
-                    box_weight REAL NOT NULL,
-                    price_per_box REAL NOT NULL,
-                    unit TEXT DEFAULT 'кг',
-                    is_active BOOLEAN DEFAULT TRUE,
-                    is_global BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(company_id, name_internal)
-                )
-            """)
-            
-            # Migration: Add is_global to products
-            await conn.execute("""
-                ALTER TABLE products
-                ADD COLUMN IF NOT EXISTS is_global BOOLEAN DEFAULT FALSE;
-            """)
+        if version >= expected:
+            return
 
-            # 4. Stock Table
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS stock (
-                    id SERIAL PRIMARY KEY,
-                    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
-                    product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
-                    date DATE NOT NULL,
-                    quantity REAL NOT NULL,
-                    weight REAL NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(company_id, product_id, date)
-                )
-            """)
+        if os.getenv('DB_AUTO_MIGRATE', '1') == '0':
+            raise RuntimeError(
+                f"Схема БД устарела (версия {version}, требуется {expected}). "
+                f"Запустите: python run_migrations.py"
+            )
 
-            # 5. Supplies Table
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS supplies (
-                    id SERIAL PRIMARY KEY,
-                    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
-                    product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
-                    date DATE NOT NULL,
-                    boxes INTEGER NOT NULL,
-                    weight REAL NOT NULL,
-                    cost REAL NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+        print(f"⚠️ Схема БД версии {version}, код ожидает {expected} - применяю миграции")
+        await self.migrate()
 
-            # 6. Pending Orders Table
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS pending_orders (
-                    id SERIAL PRIMARY KEY,
-                    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    status TEXT DEFAULT 'pending' CHECK (status IN ('pending', 'completed', 'cancelled')),
-                    total_cost REAL NOT NULL,
-                    notes TEXT
-                )
+    async def migrate(self) -> List[str]:
+        """Применить непримененные миграции и дозаполнить производные таблицы"""
+        async with self.acquire() as conn:
+            applied = await apply_migrations(conn)
+            needs_backfill = await conn.fetchval("""
+                SELECT EXISTS (SELECT 1 FROM stock) AND NOT EXISTS (SELECT 1 FROM consumption_gaps)
             """)
 
-            # 7. Pending Order Items
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS pending_order_items (
-                    id SERIAL PRIMARY KEY,
-                    order_id INTEGER NOT NULL REFERENCES pending_orders(id) ON DELETE CASCADE,
-                    product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
-                    boxes_ordered INTEGER NOT NULL,
-                    weight_ordered REAL NOT NULL,
-                    cost REAL NOT NULL
-                )
-            """)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS pending_stock_items (
-                    id SERIAL PRIMARY KEY,
-                    submission_id INTEGER NOT NULL REFERENCES pending_stock_submissions(id) ON DELETE CASCADE,
-                    product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
-                    quantity REAL NOT NULL,
-                    weight REAL NOT NULL,
-                    edited_quantity REAL,
-                    edited_quantity REAL,
-                    edited_weight REAL
-                )
-            """)
+        if needs_backfill:
+            gaps_count = await self.rebuild_consumption_gaps()
+            print(f"✅ Таблица consumption_gaps заполнена: {gaps_count} интервалов")
 
-            # 10. Shifts (Employee Schedule)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS shifts (
-                    id SERIAL PRIMARY KEY,
-                    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
-                    user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
-                    date DATE NOT NULL,
-                    start_time TIME,
-                    end_time TIME,
-                    status VARCHAR(50) DEFAULT 'assigned',
-                    is_notified BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+        return [f"{m.version:04d}_{m.name}" for m in applied]
 
-            # 10. Shifts (Employee Schedule)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS shifts (
-                    id SERIAL PRIMARY KEY,
-                    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
-                    user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
-                    date DATE NOT NULL,
-                    start_time TIME,
-                    end_time TIME,
-                    status VARCHAR(50) DEFAULT 'assigned',
-                    is_notified BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # Добавляем колонку к существующей таблице, если она есть
+    async def close(self):
+        """Закрыть пул соединений"""
+        if self._listener_task is not None:
+            self._listener_task.cancel()
             try:
-                await conn.execute("ALTER TABLE shifts ADD COLUMN IF NOT EXISTS is_notified BOOLEAN DEFAULT FALSE;")
-            except Exception as e:
+                await self._listener_task
+            except asyncio.CancelledError:
                 pass
+            self._listener_task = None
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
 
-            # 11. Supplier Debts (Missing items from deliveries)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS supplier_debts (
-                    id SERIAL PRIMARY KEY,
-                    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
-                    product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
-                    boxes REAL NOT NULL,
-                    weight REAL NOT NULL,
-                    cost REAL NOT NULL,
-                    status VARCHAR(50) DEFAULT 'active',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    resolved_at TIMESTAMP NULL
-                )
-            """)
+    def acquire(self):
+        """Взять соединение из общего пула (async with db.acquire() as conn)"""
+        self._acquire_count += 1
+        return _TimedAcquire(self, self.pool.acquire(timeout=self.acquire_timeout))
+
+    async def invalidate_company(self, company_id: Optional[int] = None, entity: str = '*'):
+        """
+        Данные компании изменились: сбросить локальные кэши и оповестить другие процессы
 
-        # Безопасное добавление новых колонок (миграция для существующих баз)
+        company_id=None - изменение касается всех компаний. Только для записей в
+        обход методов DatabasePG (разовые хендлеры и скрипты): берет отдельное
+        соединение после их COMMIT. Методы записи оповещают через _notify_change.
+        """
+        self._apply_change(company_id, entity)
+        if self.pool is None or not self.notify_changes:
+            return
+        payload = f"{'*' if company_id is None else company_id}:{entity}"
         try:
-            async with self.pool.acquire() as conn:
-                await conn.execute("ALTER TABLE companies ADD COLUMN IF NOT EXISTS notes TEXT")
+            async with self.acquire() as conn:
+                await conn.execute("SELECT pg_notify($1, $2)", CHANGE_CHANNEL, payload)
         except Exception as e:
-            print(f"Migration error for companies.notes: {e}")
+            print(f"⚠️ Не удалось отправить NOTIFY {CHANGE_CHANNEL} ({payload}): {e}")
 
-        # Таблица для личных заметок по компании (отдельные карточки)
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS company_notes (
-                    id SERIAL PRIMARY KEY,
-                    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
-                    content TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+    async def _notify_change(self, conn, company_id: Optional[int], entity: str):
+        """
+        Оповестить другие процессы об изменении на соединении записи
 
-        print("✅ PostgreSQL SaaS база данных инициализирована")
+        Вызывается внутри транзакции метода: NOTIFY уходит при COMMIT вместе с
+        данными и не отправляется при откате, второе соединение из пула не нужно.
+        Локальные кэши сбрасывает invalidates_cache (или _apply_change) после COMMIT.
+        """
+        if not self.notify_changes:
+            return
+        payload = f"{'*' if company_id is None else company_id}:{entity}"
+        await conn.execute("SELECT pg_notify($1, $2)", CHANGE_CHANNEL, payload)
 
-    async def close(self):
-        """Закрыть пул соединений"""
-        if self.pool:
-            await self.pool.close()
+    def add_change_handler(self, handler: Callable[[Optional[int], str], None]):
+        """Подписать локальный кэш на изменения: handler(company_id или None, entity)"""
+        self._change_handlers.append(handler)
+
+    async def add_channel_listener(self, channel: str, handler: Callable[[Optional[str]], None]):
+        """
+        Слушать еще один канал NOTIFY на соединении start_change_listener
+
+        handler(payload) вызывается на каждое уведомление и handler(None) после
+        переподключения, когда уведомления могли быть пропущены.
+        """
+        first = channel not in self._channel_handlers
+        self._channel_handlers.setdefault(channel, []).append(handler)
+        conn = self._listener_conn
+        if first and conn is not None and not conn.is_closed():
+            await conn.add_listener(channel, self._on_channel_notification)
+
+    def _on_channel_notification(self, connection, pid, channel, payload):
+        self._dispatch_channel(channel, payload)
 
+    def _dispatch_channel(self, channel: str, payload: Optional[str]):
+        for handler in self._channel_handlers.get(channel, []):
+            try:
+                handler(payload)
+            except Exception as e:
+                print(f"⚠️ Ошибка обработчика {channel} ({payload}): {e}")
+
+    def _apply_change(self, company_id: Optional[int], entity: str):
+        # Кэшированные чтения не зависят от пользователей - их кэш не трогаем
+        if self.query_cache is not None and entity != 'users':
+            self.query_cache.invalidate(company_id)
+        for handler in self._change_handlers:
+            try:
+                handler(company_id, entity)
+            except Exception as e:
+                print(f"⚠️ Ошибка обработчика изменений ({company_id}:{entity}): {e}")
+
+    def _on_change_notification(self, connection, pid, channel, payload):
+        company_part, _, entity = payload.partition(':')
+        company_id = None if company_part == '*' else int(company_part)
+        self._apply_change(company_id, entity or '*')
+
+    async def start_change_listener(self):
+        """Слушать company_changed от других процессов (одно соединение на процесс)"""
+        if self._listener_task is None:
+            self._listener_task = asyncio.create_task(self._listen_changes())
+
+    async def _listen_changes(self):
+        delay = 1
+        while True:
+            lost = asyncio.Event()
+            try:
+                conn = await asyncpg.connect(self.database_url, ssl='require')
+                try:
+                    conn.add_termination_listener(lambda c: lost.set())
+                    await conn.add_listener(CHANGE_CHANNEL, self._on_change_notification)
+                    for channel in list(self._channel_handlers):
+                        await conn.add_listener(channel, self._on_channel_notification)
+                    self._listener_conn = conn
+                    # Пока слушателя не было, изменения других процессов могли пройти мимо
+                    self._apply_change(None, '*')
+                    for channel in list(self._channel_handlers):
+                        self._dispatch_channel(channel, None)
+                    print(f"👂 LISTEN {CHANGE_CHANNEL}")
+                    delay = 1
+                    await lost.wait()
+                finally:
+                    self._listener_conn = None
+                    if not conn.is_closed():
+                        await conn.close()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Слушатель {CHANGE_CHANNEL} отключен: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    def pool_stats(self) -> Dict:
+        """Статистика пула соединений"""
+        if not self.pool:
+            return {'initialized': False}
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return {
+            'initialized': True,
+            'min_size': self.pool.get_min_size(),
+            'max_size': self.pool.get_max_size(),
+            'size': size,
+            'idle': idle,
+            'in_use': size - idle,
+            'acquire_timeout': self.acquire_timeout,
+            'acquires_total': self._acquire_count,
+            'acquire_timeouts': self._acquire_timeouts,
+        }
+
+    @invalidates_cache('products')
     async def add_product(self, company_id: int, name_chinese: str, name_russian: str, name_internal: str,
                          package_weight: float, units_per_box: int, price_per_box: float,
                          unit: str = "кг") -> int:
         """Добавить товар компании"""
         box_weight = package_weight * units_per_box
-        async with self.pool.acquire() as conn:
-            result = await conn.fetchval("""
-                INSERT INTO products
-                (company_id, name_chinese, name_russian, name_internal, package_weight,
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-                RETURNING id
-            """, company_id, name_chinese, name_russian, name_internal, package_weight,
-                units_per_box, box_weight, price_per_box, unit)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                result = await conn.fetchval("""
+                    INSERT INTO products
+                    (company_id, name_chinese, name_russian, name_internal, package_weight,
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                    RETURNING id
+                """, company_id, name_chinese, name_russian, name_internal, package_weight,
+                    units_per_box, box_weight, price_per_box, unit)
+                await self._notify_change(conn, company_id, 'products')
             return result
 
+    @invalidates_cache('products')
     async def add_product_globally(self, name_chinese: str, name_russian: str, name_internal: str,
                          package_weight: float, units_per_box: int, price_per_box: float,
                          unit: str = "кг") -> bool:
         """Добавить товар ВО ВСЕ существующие компании (Для СуперАдмина)"""
         box_weight = package_weight * units_per_box
-        async with self.pool.acquire() as conn:
-            companies = await conn.fetch("SELECT id FROM companies")
-            
-            for comp in companies:
-                c_id = comp['id']
-                await conn.execute("""
-                    INSERT INTO products
-                    (company_id, name_chinese, name_russian, name_internal, package_weight,
-                     units_per_box, box_weight, price_per_box, unit, is_global)
-                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, TRUE)
-                    ON CONFLICT(company_id, name_internal) DO NOTHING
-                """, c_id, name_chinese, name_russian, name_internal, package_weight,
-                    units_per_box, box_weight, price_per_box, unit)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                companies = await conn.fetch("SELECT id FROM companies")
+
+                for comp in companies:
+                    c_id = comp['id']
+                    await conn.execute("""
+                        INSERT INTO products
+                        (company_id, name_chinese, name_russian, name_internal, package_weight,
+                         units_per_box, box_weight, price_per_box, unit, is_global)
+                        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, TRUE)
+                        ON CONFLICT(company_id, name_internal) DO NOTHING
+                    """, c_id, name_chinese, name_russian, name_internal, package_weight,
+                        units_per_box, box_weight, price_per_box, unit)
+                await self._notify_change(conn, None, 'products')
             return True
 
+    @cached_query
     async def get_all_products(self, company_id: int, active_only: bool = False) -> List[Dict]:
         """Получить все товары компании (либо только активные)"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             if active_only:
                 rows = await conn.fetch("SELECT * FROM products WHERE company_id = $1 AND is_active = TRUE ORDER BY name_internal", company_id)
             else:
@@ -269,71 +319,149 @@ class DatabasePG:
 
     async def get_product_by_name(self, company_id: int, name_internal: str) -> Optional[Dict]:
         """Получить товар по внутреннему названию для конкретной компании"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             row = await conn.fetchrow(
                 "SELECT * FROM products WHERE company_id = $1 AND name_internal = $2", 
                 company_id, name_internal
             )
             return dict(row) if row else None
 
+    @invalidates_cache('products')
     async def toggle_product_status(self, company_id: int, product_id: int, is_active: bool) -> bool:
         """Включить или отключить ингредиент"""
-        async with self.pool.acquire() as conn:
-            # Возвращает команду вроде "UPDATE 1", если успешно
-            result = await conn.execute(
-                "UPDATE products SET is_active = $1 WHERE company_id = $2 AND id = $3",
-                is_active, company_id, product_id
-            )
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                # Возвращает команду вроде "UPDATE 1", если успешно
+                result = await conn.execute(
+                    "UPDATE products SET is_active = $1 WHERE company_id = $2 AND id = $3",
+                    is_active, company_id, product_id
+                )
+                await self._notify_change(conn, company_id, 'products')
             return result == "UPDATE 1"
 
+    @invalidates_cache('stock')
     async def add_stock(self, company_id: int, product_id: int, date, quantity: float, weight: float):
         """Добавить/обновить остаток на дату"""
         if isinstance(date, str):
             from datetime import datetime
             date = datetime.strptime(date, '%Y-%m-%d').date()
 
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO stock (company_id, product_id, date, quantity, weight)
-                VALUES ($1, $2, $3, $4, $5)
-                ON CONFLICT(product_id, date)
-                DO UPDATE SET quantity=EXCLUDED.quantity, weight=EXCLUDED.weight
-            """, company_id, product_id, date, quantity, weight)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO stock (company_id, product_id, date, quantity, weight)
+                    VALUES ($1, $2, $3, $4, $5)
+                    ON CONFLICT(product_id, date)
+                    DO UPDATE SET quantity=EXCLUDED.quantity, weight=EXCLUDED.weight
+                """, company_id, product_id, date, quantity, weight)
+                await self._refresh_consumption_gaps(conn, company_id, [product_id], date)
+                await self._notify_change(conn, company_id, 'stock')
+
+    @invalidates_cache('stock')
+    async def bulk_upsert_stock(self, company_id: int, date, items: List[Dict]) -> int:
+        """Добавить/обновить остатки всей инвентаризации на дату одним запросом
+
+        items: [{'product_id', 'quantity', 'weight'}, ...]
+        """
+        if isinstance(date, str):
+            from datetime import datetime
+            date = datetime.strptime(date, '%Y-%m-%d').date()
+
+        if not items:
+            return 0
+
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                count = await self._upsert_stock_rows(conn, company_id, date, items)
+                await self._notify_change(conn, company_id, 'stock')
+                return count
+
+    async def _upsert_stock_rows(self, conn, company_id: int, date, items: List[Dict]) -> int:
+        """Upsert строк остатков через unnest на уже открытом соединении (в транзакции)"""
+        # Повторы товара в одной инвентаризации: как и при поштучной записи, побеждает последний
+        rows = {}
+        for item in items:
+            rows[int(item['product_id'])] = (float(item['quantity']), float(item['weight']))
+        product_ids = list(rows)
+
+        await conn.execute("""
+            INSERT INTO stock (company_id, product_id, date, quantity, weight)
+            SELECT $1, i.product_id, $2, i.quantity, i.weight
+            FROM unnest($3::int[], $4::float8[], $5::float8[]) as i(product_id, quantity, weight)
+            ON CONFLICT(product_id, date)
+            DO UPDATE SET quantity=EXCLUDED.quantity, weight=EXCLUDED.weight
+        """, company_id, date, product_ids,
+            [rows[pid][0] for pid in product_ids],
+            [rows[pid][1] for pid in product_ids])
+
+        await self._refresh_consumption_gaps(conn, company_id, product_ids, date)
+        return len(product_ids)
 
     async def increment_stock(self, company_id: int, product_id: int, date, add_boxes: float, add_weight: float):
         """Увеличить (или создать) текущий остаток приходами/поставками (авто-обновление склада)"""
+        await self.increment_stock_many(company_id, date, [
+            {'product_id': product_id, 'quantity': add_boxes, 'weight': add_weight}
+        ])
+
+    @invalidates_cache('stock')
+    async def increment_stock_many(self, company_id: int, date, items: List[Dict]):
+        """Увеличить остатки нескольких товаров одним запросом
+
+        items: [{'product_id', 'quantity', 'weight'}, ...] - прирост упаковок и веса
+        """
         if isinstance(date, str):
             from datetime import datetime
             date = datetime.strptime(date, '%Y-%m-%d').date()
 
-        async with self.pool.acquire() as conn:
-            # Ищем самую свежую запись по складу
-            prev = await conn.fetchrow("""
-                SELECT date, quantity, weight FROM stock 
-                WHERE company_id = $1 AND product_id = $2 AND date <= $3 
-                ORDER BY date DESC LIMIT 1
-            """, company_id, product_id, date)
-
-            if prev and prev['date'] == date:
-                # Если уже есть запись на СЕГОДНЯ, просто прибавляем к ней
-                new_q = prev['quantity'] + add_boxes
-                new_w = prev['weight'] + add_weight
-                await conn.execute("""
-                    UPDATE stock SET quantity=$1, weight=$2 
-                    WHERE company_id=$3 AND product_id=$4 AND date=$5
-                """, new_q, new_w, company_id, product_id, date)
-            else:
-                # Если записи на сегодня нет (или вообще нет), берем предыдущий остаток (если есть)
-                base_q = prev['quantity'] if prev else 0
-                base_w = prev['weight'] if prev else 0
-                new_q = base_q + add_boxes
-                new_w = base_w + add_weight
-                await conn.execute("""
-                    INSERT INTO stock (company_id, product_id, date, quantity, weight)
-                    VALUES ($1, $2, $3, $4, $5)
-                """, company_id, product_id, date, new_q, new_w)
+        increments = {}
+        for item in items:
+            pid = int(item['product_id'])
+            add_q, add_w = increments.get(pid, (0.0, 0.0))
+            increments[pid] = (add_q + float(item['quantity']), add_w + float(item['weight']))
+
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await self._increment_stock_rows(conn, company_id, date, increments)
+                await self._notify_change(conn, company_id, 'stock')
 
+    async def _increment_stock_rows(self, conn, company_id: int, date, increments: Dict[int, tuple]):
+        """
+        Прибавить приход к складу на дату одним запросом (на открытом соединении, в транзакции)
 
+        increments: {product_id: (добавить упаковок, добавить веса)}
+        Если записи на дату нет - базой служит последний остаток до этой даты (или 0).
+        Если запись уже есть - прибавляем к ней атомарно (stock.quantity + прирост),
+        поэтому параллельные приходы не теряют друг друга.
+        """
+        if not increments:
+            return
+        product_ids = list(increments)
+        add_quantity = [float(increments[pid][0]) for pid in product_ids]
+        add_weight = [float(increments[pid][1]) for pid in product_ids]
+
+        await conn.execute("""
+            INSERT INTO stock (company_id, product_id, date, quantity, weight)
+            SELECT $1, i.product_id, $2,
+                   COALESCE(prev.quantity, 0) + i.add_quantity,
+                   COALESCE(prev.weight, 0) + i.add_weight
+            FROM unnest($3::int[], $4::float8[], $5::float8[]) as i(product_id, add_quantity, add_weight)
+            LEFT JOIN LATERAL (
+                SELECT s.quantity, s.weight FROM stock s
+                WHERE s.company_id = $1 AND s.product_id = i.product_id AND s.date < $2
+                ORDER BY s.date DESC LIMIT 1
+            ) prev ON TRUE
+            ON CONFLICT(product_id, date) DO UPDATE
+            SET quantity = stock.quantity + (
+                    SELECT a.add_quantity FROM unnest($3::int[], $4::float8[]) as a(product_id, add_quantity)
+                    WHERE a.product_id = stock.product_id),
+                weight = stock.weight + (
+                    SELECT a.add_weight FROM unnest($3::int[], $5::float8[]) as a(product_id, add_weight)
+                    WHERE a.product_id = stock.product_id)
+        """, company_id, date, product_ids, add_quantity, add_weight)
+
+        await self._refresh_consumption_gaps(conn, company_id, product_ids, date)
+
+    @invalidates_cache('stock')
     async def add_supply(self, company_id: int, product_id: int, date, boxes: int,
                         weight: float, cost: float):
         """Добавить поставку"""
@@ -341,27 +469,134 @@ class DatabasePG:
             from datetime import datetime
             date = datetime.strptime(date, '%Y-%m-%d').date()
 
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO supplies (company_id, product_id, date, boxes, weight, cost)
-                VALUES ($1, $2, $3, $4, $5, $6)
-            """, company_id, product_id, date, boxes, weight, cost)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO supplies (company_id, product_id, date, boxes, weight, cost)
+                    VALUES ($1, $2, $3, $4, $5, $6)
+                """, company_id, product_id, date, boxes, weight, cost)
+                await self._refresh_consumption_gaps(conn, company_id, [product_id], date)
+                await self._notify_change(conn, company_id, 'stock')
 
+    @invalidates_cache('products')
     async def update_product_price(self, company_id: int, product_id: int, new_price: float):
         """Обновить стоимость за коробку/литр товара на основе новой поставки"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                UPDATE products
-                SET price_per_box = $1
-                WHERE id = $2 AND company_id = $3
-            """, new_price, product_id, company_id)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    UPDATE products
+                    SET price_per_box = $1
+                    WHERE id = $2 AND company_id = $3
+                """, new_price, product_id, company_id)
+                await self._notify_change(conn, company_id, 'products')
+
+    @invalidates_cache('stock')
+    async def receive_supply(self, company_id: int, date, items: List[Dict], debts: List[Dict] = None,
+                             resolve_order_id: int = None) -> Dict:
+        """
+        Принять поставку целиком в одной транзакции
+
+        Записывает приход (supplies), увеличивает склад на количество упаковок
+        (boxes * units_per_box), обновляет цены за коробку, закрывает заявку
+        (без повторной вставки supplies) и заводит долги поставщика.
+        Все шаги - пакетными запросами, независимо от числа позиций.
+
+        items / debts: [{'product_id', 'boxes', 'weight', 'cost'}, ...]
+        ValueError, если какой-либо товар не принадлежит компании.
+        """
+        if isinstance(date, str):
+            from datetime import datetime
+            date = datetime.strptime(date, '%Y-%m-%d').date()
+
+        lines = []
+        for item in items:
+            boxes = float(item.get('boxes', 0))
+            weight = float(item.get('weight', 0))
+            if boxes > 0 or weight > 0:
+                lines.append((int(item['product_id']), boxes, weight, float(item.get('cost', 0))))
+
+        debt_lines = []
+        for debt in debts or []:
+            boxes = float(debt.get('boxes', 0))
+            weight = float(debt.get('weight', 0))
+            if boxes > 0 or weight > 0:
+                debt_lines.append((int(debt['product_id']), boxes, weight, float(debt.get('cost', 0))))
+
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                # Товары поставки и долгов должны принадлежать компании: чужой id отклоняет всю поставку
+                product_ids = sorted({pid for pid, _, _, _ in lines + debt_lines})
+                products = await conn.fetch(
+                    "SELECT id, units_per_box FROM products WHERE id = ANY($1::int[]) AND company_id = $2",
+                    product_ids, company_id
+                ) if product_ids else []
+                units_per_box = {row['id']: row['units_per_box'] for row in products}
+                unknown = [pid for pid in product_ids if pid not in units_per_box]
+                if unknown:
+                    raise ValueError(f"Товары не найдены в компании: {', '.join(map(str, unknown))}")
+
+                if lines:
+                    # 1. Приход (supplies)
+                    await conn.execute("""
+                        INSERT INTO supplies (company_id, product_id, date, boxes, weight, cost)
+                        SELECT $1, i.product_id, $2, i.boxes, i.weight, i.cost
+                        FROM unnest($3::int[], $4::int[], $5::float8[], $6::float8[])
+                             as i(product_id, boxes, weight, cost)
+                    """, company_id, date,
+                        [pid for pid, _, _, _ in lines],
+                        [int(boxes) for _, boxes, _, _ in lines],
+                        [weight for _, _, weight, _ in lines],
+                        [cost for _, _, _, cost in lines])
+
+                    # 2. Склад: прибавляем упаковки, а не коробки (повторы товара суммируются)
+                    increments = {}
+                    for pid, boxes, weight, _ in lines:
+                        packages = boxes * units_per_box.get(pid, 1)
+                        add_q, add_w = increments.get(pid, (0.0, 0.0))
+                        increments[pid] = (add_q + packages, add_w + weight)
+                    await self._increment_stock_rows(conn, company_id, date, increments)
+
+                    # 3. Цена за коробку по последней строке товара с количеством и стоимостью
+                    prices = {}
+                    for pid, boxes, _, cost in lines:
+                        if boxes > 0 and cost > 0:
+                            prices[pid] = round(cost / boxes, 2)
+                    if prices:
+                        await conn.execute("""
+                            UPDATE products p
+                            SET price_per_box = u.price
+                            FROM unnest($2::int[], $3::float8[]) as u(id, price)
+                            WHERE p.id = u.id AND p.company_id = $1
+                        """, company_id, list(prices), list(prices.values()))
+
+                if resolve_order_id:
+                    await conn.execute(
+                        "UPDATE pending_orders SET status = 'completed' WHERE id = $1 AND company_id = $2",
+                        int(resolve_order_id), company_id
+                    )
+
+                if debt_lines:
+                    await conn.execute("""
+                        INSERT INTO supplier_debts (company_id, product_id, boxes, weight, cost)
+                        SELECT $1, d.product_id, d.boxes, d.weight, d.cost
+                        FROM unnest($2::int[], $3::float8[], $4::float8[], $5::float8[])
+                             as d(product_id, boxes, weight, cost)
+                    """, company_id,
+                        [pid for pid, _, _, _ in debt_lines],
+                        [boxes for _, boxes, _, _ in debt_lines],
+                        [weight for _, _, weight, _ in debt_lines],
+                        [cost for _, _, _, cost in debt_lines])
+
+                await self._notify_change(conn, company_id, 'stock')
+
+        return {'supplies': len(lines), 'debts': len(debt_lines)}
 
     async def get_supply_total(self, company_id: int, date) -> float:
         """Получить общую сумму поставок за день"""
         if isinstance(date, str):
             from datetime import datetime
             date = datetime.strptime(date, '%Y-%m-%d').date()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             total = await conn.fetchval("SELECT SUM(cost) FROM supplies WHERE company_id = $1 AND date = $2", company_id, date)
             return float(total) if total else 0.0
 
@@ -372,7 +607,7 @@ class DatabasePG:
             start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
         if isinstance(end_date, str):
             end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             total = await conn.fetchval("SELECT SUM(cost) FROM supplies WHERE company_id = $1 AND date BETWEEN $2 AND $3", company_id, start_date, end_date)
             return float(total) if total else 0.0
 
@@ -381,7 +616,7 @@ class DatabasePG:
         if isinstance(date_val, str):
             from datetime import datetime
             date_val = datetime.strptime(date_val, '%Y-%m-%d').date()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             return await conn.fetchval("SELECT MAX(date) FROM stock WHERE company_id = $1 AND date < $2", company_id, date_val)
 
     async def get_supplies_between(self, company_id: int, start_date, end_date) -> List[Dict]:
@@ -391,7 +626,7 @@ class DatabasePG:
             start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
         if isinstance(end_date, str):
             end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT s.product_id, s.boxes, s.date,
                        p.units_per_box, p.package_weight, p.name_internal
@@ -407,7 +642,7 @@ class DatabasePG:
             from datetime import datetime
             date = datetime.strptime(date, '%Y-%m-%d').date()
 
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT s.id, s.product_id, s.date, s.quantity, s.weight,
                        p.name_chinese, p.name_russian, p.name_internal,
@@ -419,41 +654,41 @@ class DatabasePG:
             """, company_id, date)
             return [dict(row) for row in rows]
 
+    @cached_query
     async def get_latest_stock(self, company_id: int) -> List[Dict]:
         """Получить самые свежие остатки по каждому товару. Если товар пропущен в последней ревизии, считаем его равным 0."""
-        async with self.pool.acquire() as conn:
-            # Получаем дату самой последней ревизии по всей компании
-            global_latest = await conn.fetchval("SELECT MAX(date) FROM stock WHERE company_id = $1", company_id)
-            if not global_latest:
-                from datetime import date
-                global_latest = date.today()
-
-            rows = await conn.fetch("""
-                WITH RankedStock AS (
-                    SELECT product_id, quantity, weight, date,
-                           ROW_NUMBER() OVER(PARTITION BY product_id ORDER BY date DESC) as rn
-                    FROM stock
-                    WHERE company_id = $1
-                )
-                SELECT p.id as product_id, 
-                       CASE WHEN rs.date >= $2 THEN rs.quantity ELSE 0 END as quantity, 
-                       CASE WHEN rs.date >= $2 THEN rs.weight ELSE 0 END as weight,
-                       $2 as date,
-                       p.name_chinese, p.name_russian, p.name_internal,
-                       p.package_weight, p.units_per_box, p.box_weight, p.price_per_box, p.unit
-                FROM products p
-                LEFT JOIN RankedStock rs ON p.id = rs.product_id AND rs.rn = 1
-                WHERE p.company_id = $1 AND p.is_active = TRUE
-                ORDER BY p.name_internal
-            """, company_id, global_latest)
-            return [dict(row) for row in rows]
+        async with self.acquire() as conn:
+            return await self._fetch_latest_stock(conn, company_id)
+
+    async def _fetch_latest_stock(self, conn, company_id: int) -> List[Dict]:
+        """Свежие остатки по каждому товару на уже открытом соединении"""
+        # Снимок stock_latest (одна строка на товар, ведется триггером на stock):
+        # оба запроса - O(товаров), а не проход по всей истории ревизий
+        global_latest = await conn.fetchval("SELECT MAX(date) FROM stock_latest WHERE company_id = $1", company_id)
+        if not global_latest:
+            from datetime import date
+            global_latest = date.today()
+
+        rows = await conn.fetch("""
+            SELECT p.id as product_id, 
+                   CASE WHEN sl.date >= $2 THEN sl.quantity ELSE 0 END as quantity, 
+                   CASE WHEN sl.date >= $2 THEN sl.weight ELSE 0 END as weight,
+                   $2 as date,
+                   p.name_chinese, p.name_russian, p.name_internal,
+                   p.package_weight, p.units_per_box, p.box_weight, p.price_per_box, p.unit
+            FROM products p
+            LEFT JOIN stock_latest sl ON sl.product_id = p.id
+            WHERE p.company_id = $1 AND p.is_active = TRUE
+            ORDER BY p.name_internal
+        """, company_id, global_latest)
+        return [dict(row) for row in rows]
 
     async def has_stock_for_date(self, company_id: int, date) -> bool:
         """Проверка наличия остатков на дату"""
         if isinstance(date, str):
             from datetime import datetime
             date = datetime.strptime(date, '%Y-%m-%d').date()
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             val = await conn.fetchval(
                 "SELECT 1 FROM stock WHERE company_id = $1 AND date = $2 LIMIT 1", 
                 company_id, date
@@ -462,7 +697,7 @@ class DatabasePG:
 
     async def get_stock_history(self, company_id: int, product_id: int, days: int = 7) -> List[Dict]:
         """История остатков товара"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT date, quantity, weight
                 FROM stock
@@ -472,151 +707,157 @@ class DatabasePG:
             """, company_id, product_id, days)
             return [dict(row) for row in rows]
 
+    async def get_stock_histories(self, company_id: int, product_ids: Sequence[int],
+                                  days: int = 7) -> Dict[int, List[Dict]]:
+        """
+        История остатков сразу по многим товарам: {product_id: [ревизии]}
+
+        То же, что get_stock_history для каждого товара (последние `days`
+        ревизий, новые первыми), но одним запросом: LATERAL с LIMIT идет
+        по индексу (company_id, product_id, date) для каждого товара.
+        """
+        histories = {product_id: [] for product_id in product_ids}
+        if not histories:
+            return histories
+        async with self.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT p.product_id, s.date, s.quantity, s.weight
+                FROM unnest($2::int[]) AS p(product_id)
+                CROSS JOIN LATERAL (
+                    SELECT date, quantity, weight
+                    FROM stock
+                    WHERE company_id = $1 AND product_id = p.product_id
+                    ORDER BY date DESC
+                    LIMIT $3
+                ) s
+                ORDER BY p.product_id, s.date DESC
+            """, company_id, list(histories), days)
+        for row in rows:
+            histories[row['product_id']].append(
+                {'date': row['date'], 'quantity': row['quantity'], 'weight': row['weight']})
+        return histories
+
     async def calculate_consumption(self, company_id: int, start_date, end_date) -> List[Dict]:
         """Определяет средний расход товара за период с учетом пропусков и пустых полок"""
-        from datetime import datetime, date
-        from collections import defaultdict
+        from datetime import datetime
 
         if isinstance(start_date, str):
             start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
         if isinstance(end_date, str):
             end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
 
-        async with self.pool.acquire() as conn:
-            # 1. Fetch all products to guarantee we return a row for each
-            products_rows = await conn.fetch("""
-                SELECT id, name_internal, name_russian, price_per_box, unit, box_weight, units_per_box
-                FROM products WHERE company_id = $1 AND is_active = TRUE
-            """, company_id)
-            products = {r['id']: dict(r) for r in products_rows}
-
-            # 2. Fetch all raw historical stock for the period
-            stock_rows = await conn.fetch("""
-                SELECT product_id, date, quantity, weight
-                FROM stock
-                WHERE company_id = $1 AND date >= $2 AND date <= $3
-                ORDER BY product_id, date ASC
-            """, company_id, start_date, end_date)
-
-            # Organize stock history by product
-            history_by_product = defaultdict(list)
-            for r in stock_rows:
-                history_by_product[r['product_id']].append(dict(r))
-
-            # 3. Fetch all supplies for the period
-            supply_rows = await conn.fetch("""
-                SELECT product_id, date, boxes, weight
-                FROM supplies
-                WHERE company_id = $1 AND date > $2 AND date <= $3
+        async with self.acquire() as conn:
+            # Расход - сумма по готовым интервалам consumption_gaps, целиком лежащим в периоде
+            rows = await conn.fetch("""
+                WITH stock_ends AS (
+                    SELECT product_id,
+                           (array_agg(quantity ORDER BY date ASC))[1] as start_quantity,
+                           (array_agg(quantity ORDER BY date DESC))[1] as end_quantity
+                    FROM stock
+                    WHERE company_id = $1 AND date >= $2 AND date <= $3
+                    GROUP BY product_id
+                ),
+                supplied AS (
+                    SELECT product_id, SUM(boxes) as supplied_quantity
+                    FROM supplies
+                    WHERE company_id = $1 AND date > $2 AND date <= $3
+                    GROUP BY product_id
+                ),
+                consumed AS (
+                    SELECT product_id,
+                           SUM(consumed_quantity) as consumed_quantity,
+                           SUM(consumed_weight) as consumed_weight,
+                           SUM(valid_days) as valid_days
+                    FROM consumption_gaps
+                    WHERE company_id = $1 AND start_date >= $2 AND end_date <= $3 AND valid_days > 0
+                    GROUP BY product_id
+                )
+                SELECT p.id, p.name_internal, p.name_russian, p.price_per_box, p.unit, p.box_weight, p.units_per_box,
+                       COALESCE(se.start_quantity, 0) as start_quantity,
+                       COALESCE(se.end_quantity, 0) as end_quantity,
+                       COALESCE(su.supplied_quantity, 0) as supplied_quantity,
+                       COALESCE(c.consumed_quantity, 0) as consumed_quantity,
+                       COALESCE(c.consumed_weight, 0) as consumed_weight,
+                       COALESCE(c.valid_days, 0) as valid_days
+                FROM products p
+                LEFT JOIN stock_ends se ON se.product_id = p.id
+                LEFT JOIN supplied su ON su.product_id = p.id
+                LEFT JOIN consumed c ON c.product_id = p.id
+                WHERE p.company_id = $1 AND p.is_active = TRUE
             """, company_id, start_date, end_date)
 
-            supplies_by_product = defaultdict(list)
-            for r in supply_rows:
-                supplies_by_product[r['product_id']].append(dict(r))
-
         results = []
-        for pid, prod in products.items():
-            history = history_by_product[pid]
-            supplies = supplies_by_product[pid]
-
-            # If there's 0 or 1 stock records, we can't calculate a delta
-            if len(history) < 2:
-                prod_copy = dict(prod)
-                prod_copy['product_id'] = pid
-                prod_copy['start_quantity'] = history[0]['quantity'] if history else 0.0
-                prod_copy['end_quantity'] = history[-1]['quantity'] if history else 0.0
-                prod_copy['supplied_quantity'] = sum(s['boxes'] for s in supplies)
-                prod_copy['consumed_quantity'] = 0.0
-                prod_copy['consumed_weight'] = 0.0
-                prod_copy['actual_days'] = 1 # Prevent ZeroDivisionError downstream
-                results.append(prod_copy)
-                continue
-
-            total_consumed_qty = 0.0
-            total_consumed_weight = 0.0
-            total_valid_days = 0
-
-            # Step 4. Run the day-by-day smart consumption loop
-            for i in range(len(history) - 1):
-                cur_rec = history[i]
-                nxt_rec = history[i+1]
-
-                days_between = (nxt_rec['date'] - cur_rec['date']).days
-                if days_between <= 0: continue
-
-                # If BOTH the start and end of this specific gap is 0, we assume the product was 
-                # completely out of stock during this time. We discard these days from the average.
-                # Note: If a supply arrived during this gap, the end stock wouldn't be 0.
-                if cur_rec['quantity'] <= 0 and nxt_rec['quantity'] <= 0:
-                    continue
-
-                # Find all supplies that arrived exactly within this gap
-                gap_supplies_qty = sum(s['boxes'] for s in supplies if cur_rec['date'] < s['date'] <= nxt_rec['date'])
-                gap_supplies_wgt = sum(s['weight'] for s in supplies if cur_rec['date'] < s['date'] <= nxt_rec['date'])
-
-                consumed_qty = cur_rec['quantity'] + gap_supplies_qty - nxt_rec['quantity']
-                consumed_wgt = cur_rec['weight'] + gap_supplies_wgt - nxt_rec['weight']
-                
-                # Anomaly Filtering:
-                # If staff manually added stock without a supply, consumed_qty will be negative.
-                # We skip this interval completely to prevent dragging the average down.
-                if consumed_qty < 0:
-                    continue
-
-                total_valid_days += days_between
-                total_consumed_qty += consumed_qty
-                total_consumed_weight += consumed_wgt
-
-            # Build result
-            prod_copy = dict(prod)
-            prod_copy['product_id'] = pid
-            prod_copy['start_quantity'] = history[0]['quantity']
-            prod_copy['end_quantity'] = history[-1]['quantity']
-            prod_copy['supplied_quantity'] = sum(s['boxes'] for s in supplies)
-            prod_copy['consumed_quantity'] = total_consumed_qty
-            prod_copy['consumed_weight'] = total_consumed_weight
-            prod_copy['actual_days'] = total_valid_days if total_valid_days > 0 else 1
-
-            results.append(prod_copy)
+        for row in rows:
+            prod = dict(row)
+            valid_days = prod.pop('valid_days')
+            prod['product_id'] = prod['id']
+            prod['consumed_quantity'] = float(prod['consumed_quantity'])
+            prod['consumed_weight'] = float(prod['consumed_weight'])
+            prod['actual_days'] = valid_days if valid_days > 0 else 1  # Prevent ZeroDivisionError downstream
+            results.append(prod)
 
         return results
 
 
-    async def get_stock_with_consumption(self, company_id: int) -> List[Dict]:
-        """Получить текущие остатки и средний (МАКСИМАЛЬНЫЙ из 30/60/90) умный расход"""
-        from datetime import timedelta
-        latest_stock = await self.get_latest_stock(company_id)
-        if not latest_stock:
-            return []
-            
-        latest_date = latest_stock[0]['date']
-        
-        # Helper to get consumption for a specific lookback period
-        async def fetch_consumption_for_period(days: int):
-            start_date = latest_date - timedelta(days=days)
-            real_start_date = await self.get_latest_date_before(company_id, start_date + timedelta(days=1))
-            
-            if not real_start_date:
-                # Если данных за этот период (e.g. 30 дней) еще нет (новая точка),
-                # берем самую ПЕРВУЮ доступную дату ревизии.
-                real_start_date = await self.get_earliest_stock_date(company_id)
-                # Если истории нет совсем или первая точка совпадает с текущей
-                if not real_start_date or real_start_date >= latest_date:
-                    return 1, {}
-            
-            actual_days = (latest_date - real_start_date).days
-            if actual_days <= 0:
-                actual_days = 1
-            cons_list = await self.calculate_consumption(company_id, real_start_date, latest_date)
-            return actual_days, {item['product_id']: item for item in cons_list}
-
-        # Fetch tiered consumption data
-        days_30, cons_30 = await fetch_consumption_for_period(30)
-        days_60, cons_60 = await fetch_consumption_for_period(60)
-        days_90, cons_90 = await fetch_consumption_for_period(90)
+    @cached_query
+    async def get_stock_with_consumption(self, company_id: int, windows: Optional[Sequence[int]] = None) -> List[Dict]:
+        """
+        Получить текущие остатки и средний (МАКСИМАЛЬНЫЙ из окон 30/60/90) умный расход
 
-        # Bulk fetch pending orders
-        pending_weights = await self.get_all_pending_weights(company_id)
+        Все окна считаются одним запросом по таблице consumption_gaps: каждый
+        интервал добавляется во все окна, которые его покрывают.
+        """
+        windows = tuple(windows or self.consumption_windows)
+
+        async with self.acquire() as conn:
+            latest_stock = await self._fetch_latest_stock(conn, company_id)
+            if not latest_stock:
+                return []
+
+            latest_date = latest_stock[0]['date']
+
+            # Старт каждого окна: последняя ревизия не позже (latest - N дней).
+            # Если данных за окно еще нет (новая точка) - самая ПЕРВАЯ ревизия.
+            bounds = await conn.fetch("""
+                SELECT w.days,
+                       (SELECT MAX(date) FROM stock
+                        WHERE company_id = $1 AND date <= $2::date - w.days) as start_date,
+                       (SELECT MIN(date) FROM stock WHERE company_id = $1) as earliest_date
+                FROM unnest($3::int[]) as w(days)
+            """, company_id, latest_date, list(windows))
+
+            window_starts = {}
+            for row in bounds:
+                real_start_date = row['start_date']
+                if not real_start_date:
+                    real_start_date = row['earliest_date']
+                    # Если истории нет совсем или первая точка совпадает с текущей
+                    if not real_start_date or real_start_date >= latest_date:
+                        real_start_date = None
+                window_starts[row['days']] = real_start_date
+
+            # Суммы по готовым интервалам consumption_gaps для каждого окна
+            consumption = {}
+            active = [(d, start) for d, start in window_starts.items() if start is not None]
+            if active:
+                rows = await conn.fetch("""
+                    SELECT g.product_id, w.days,
+                           SUM(g.consumed_quantity) as consumed_quantity,
+                           SUM(g.consumed_weight) as consumed_weight,
+                           SUM(g.valid_days) as valid_days
+                    FROM unnest($2::int[], $3::date[]) as w(days, start_date)
+                    JOIN consumption_gaps g
+                      ON g.company_id = $1 AND g.start_date >= w.start_date
+                     AND g.end_date <= $4 AND g.valid_days > 0
+                    GROUP BY g.product_id, w.days
+                """, company_id, [d for d, _ in active], [start for _, start in active], latest_date)
+                for row in rows:
+                    consumption.setdefault(row['product_id'], {})[row['days']] = (
+                        row['consumed_quantity'], row['consumed_weight'], row['valid_days']
+                    )
+
+            # Bulk fetch pending orders
+            pending_weights = await self._fetch_pending_weights(conn, company_id)
 
         for item in latest_stock:
             pid = item['product_id']
@@ -625,30 +866,22 @@ class DatabasePG:
             pending_boxes = pending_w / item['package_weight'] if item['package_weight'] else 0
             total_available = item['quantity'] + pending_boxes
 
-            # Evaluate consumption tiers for all 3 periods and take the MAXIMUM daily qty
-            cons_30_data = cons_30.get(pid)
-            cons_60_data = cons_60.get(pid)
-            cons_90_data = cons_90.get(pid)
-            
-            avg_30 = (cons_30_data['consumed_quantity'] / cons_30_data['actual_days']) if cons_30_data and cons_30_data['consumed_quantity'] > 0 else 0
-            avg_60 = (cons_60_data['consumed_quantity'] / cons_60_data['actual_days']) if cons_60_data and cons_60_data['consumed_quantity'] > 0 else 0
-            avg_90 = (cons_90_data['consumed_quantity'] / cons_90_data['actual_days']) if cons_90_data and cons_90_data['consumed_quantity'] > 0 else 0
-            
-            avg_w_30 = (cons_30_data['consumed_weight'] / cons_30_data['actual_days']) if cons_30_data and cons_30_data['consumed_weight'] > 0 else 0
-            avg_w_60 = (cons_60_data['consumed_weight'] / cons_60_data['actual_days']) if cons_60_data and cons_60_data['consumed_weight'] > 0 else 0
-            avg_w_90 = (cons_90_data['consumed_weight'] / cons_90_data['actual_days']) if cons_90_data and cons_90_data['consumed_weight'] > 0 else 0
+            # Evaluate consumption tiers for all periods and take the MAXIMUM daily qty
+            totals = consumption.get(pid, {})
+            avg_qty = []
+            avg_w = []
+            for d in windows:
+                consumed_qty, consumed_wgt, valid_days = totals.get(d, (0.0, 0.0, 0))
+                actual_days = valid_days if valid_days > 0 else 1
+                avg_qty.append(consumed_qty / actual_days if consumed_qty > 0 else 0)
+                avg_w.append(consumed_wgt / actual_days if consumed_wgt > 0 else 0)
 
-            max_avg_qty = max(avg_30, avg_60, avg_90)
-            
-            # We also need the weight corresponding to the max qty
+            max_avg_qty = max(avg_qty) if avg_qty else 0
+
+            # We also need the weight corresponding to the max qty (shortest window wins ties)
             max_avg_w = 0
             if max_avg_qty > 0:
-                if max_avg_qty == avg_30:
-                    max_avg_w = avg_w_30
-                elif max_avg_qty == avg_60:
-                    max_avg_w = avg_w_60
-                else:
-                    max_avg_w = avg_w_90
+                max_avg_w = avg_w[avg_qty.index(max_avg_qty)]
 
             if max_avg_qty > 0:
                 item['avg_daily_consumption_qty'] = round(max_avg_qty, 2)
@@ -660,15 +893,135 @@ class DatabasePG:
                 item['avg_daily_consumption_weight'] = 0
                 item['days_remaining'] = 999
                 item['total_days_remaining'] = 999
-                
+
             item['pending_boxes'] = pending_boxes
             item['pending_weight'] = pending_w
 
         return latest_stock
 
+    async def _refresh_consumption_gaps(self, conn, company_id: int, product_ids: List[int], date):
+        """
+        Пересчитать интервалы consumption_gaps, которые задевает изменение на дату
+
+        Изменение остатка или поставки на дату D влияет только на интервалы
+        [предыдущая ревизия -> D] и [D -> следующая ревизия]. Удаляем интервалы
+        товара, начинающиеся в [предыдущая ревизия, D], и строим заново по строкам
+        stock между предыдущей и следующей ревизией. Вызывать в транзакции записи.
+        """
+        product_ids = sorted(set(product_ids))
+        if not product_ids:
+            return
+        await self._lock_consumption_gaps(conn, product_ids)
+
+        bounds = await conn.fetch("""
+            SELECT p.product_id,
+                   COALESCE((SELECT MAX(s.date) FROM stock s
+                             WHERE s.company_id = $1 AND s.product_id = p.product_id AND s.date < $3), $3) as lo,
+                   COALESCE((SELECT MIN(s.date) FROM stock s
+                             WHERE s.company_id = $1 AND s.product_id = p.product_id AND s.date > $3), $3) as hi
+            FROM unnest($2::int[]) as p(product_id)
+        """, company_id, product_ids, date)
+        los = [row['lo'] for row in bounds]
+        his = [row['hi'] for row in bounds]
+
+        await conn.execute("""
+            DELETE FROM consumption_gaps g
+            USING unnest($2::int[], $3::date[]) as b(product_id, lo)
+            WHERE g.company_id = $1 AND g.product_id = b.product_id
+              AND g.start_date >= b.lo AND g.start_date <= $4
+        """, company_id, product_ids, los, date)
+
+        stock_rows = await conn.fetch("""
+            SELECT s.product_id, s.date, s.quantity, s.weight
+            FROM stock s
+            JOIN unnest($2::int[], $3::date[], $4::date[]) as b(product_id, lo, hi) ON s.product_id = b.product_id
+            WHERE s.company_id = $1 AND s.date >= b.lo AND s.date <= b.hi
+            ORDER BY s.product_id, s.date
+        """, company_id, product_ids, los, his)
+        supply_rows = await conn.fetch("""
+            SELECT s.product_id, s.date, s.boxes, s.weight
+            FROM supplies s
+            JOIN unnest($2::int[], $3::date[], $4::date[]) as b(product_id, lo, hi) ON s.product_id = b.product_id
+            WHERE s.company_id = $1 AND s.date > b.lo AND s.date <= b.hi
+            ORDER BY s.product_id, s.date, s.id
+        """, company_id, product_ids, los, his)
+
+        await self._insert_consumption_gaps(conn, company_id, company_gaps(stock_rows, supply_rows))
+
+    async def _lock_consumption_gaps(self, conn, product_ids: List[int]):
+        """
+        Сериализовать пересчет интервалов товаров до конца транзакции
+
+        Без блокировки две записи в один интервал могут удалить и вставить
+        интервалы по разным снимкам stock и оставить пересекающиеся строки.
+        Ключи берутся по возрастанию product_id, чтобы не было взаимных блокировок.
+        """
+        await conn.execute("""
+            SELECT pg_advisory_xact_lock($1, p.product_id)
+            FROM unnest($2::int[]) WITH ORDINALITY AS p(product_id, n)
+            ORDER BY p.n
+        """, CONSUMPTION_GAPS_LOCK_NS, sorted(product_ids))
+
+    async def _insert_consumption_gaps(self, conn, company_id: int, gaps) -> int:
+        """Записать интервалы [(product_id, ConsumptionGap), ...] одним запросом"""
+        if not gaps:
+            return 0
+        await conn.execute("""
+            INSERT INTO consumption_gaps (company_id, product_id, start_date, end_date, days,
+                                          consumed_quantity, consumed_weight, valid_days, is_anomaly)
+            SELECT $1, g.* FROM unnest($2::int[], $3::date[], $4::date[], $5::int[],
+                                       $6::float8[], $7::float8[], $8::int[], $9::bool[]) as g
+            ON CONFLICT (product_id, start_date) DO UPDATE
+            SET end_date = EXCLUDED.end_date, days = EXCLUDED.days,
+                consumed_quantity = EXCLUDED.consumed_quantity, consumed_weight = EXCLUDED.consumed_weight,
+                valid_days = EXCLUDED.valid_days, is_anomaly = EXCLUDED.is_anomaly
+        """, company_id,
+            [pid for pid, _ in gaps],
+            [gap.start_date for _, gap in gaps],
+            [gap.end_date for _, gap in gaps],
+            [gap.days for _, gap in gaps],
+            [float(gap.consumed_quantity) for _, gap in gaps],
+            [float(gap.consumed_weight) for _, gap in gaps],
+            [gap.valid_days for _, gap in gaps],
+            [gap.is_anomaly for _, gap in gaps])
+        return len(gaps)
+
+    @invalidates_cache('stock')
+    async def rebuild_consumption_gaps(self, company_id: Optional[int] = None) -> int:
+        """Полностью пересчитать consumption_gaps по stock и supplies (для одной компании или всех)"""
+        async with self.acquire() as conn:
+            if company_id is None:
+                company_ids = [row['id'] for row in await conn.fetch("SELECT id FROM companies ORDER BY id")]
+            else:
+                company_ids = [company_id]
+
+            total = 0
+            for cid in company_ids:
+                async with conn.transaction():
+                    product_ids = [row['id'] for row in await conn.fetch(
+                        "SELECT id FROM products WHERE company_id = $1 ORDER BY id", cid
+                    )]
+                    await self._lock_consumption_gaps(conn, product_ids)
+                    await conn.execute("DELETE FROM consumption_gaps WHERE company_id = $1", cid)
+                    stock_rows = await conn.fetch("""
+                        SELECT product_id, date, quantity, weight
+                        FROM stock
+                        WHERE company_id = $1
+                        ORDER BY product_id, date
+                    """, cid)
+                    supply_rows = await conn.fetch("""
+                        SELECT product_id, date, boxes, weight
+                        FROM supplies
+                        WHERE company_id = $1
+                        ORDER BY product_id, date, id
+                    """, cid)
+                    total += await self._insert_consumption_gaps(conn, cid, company_gaps(stock_rows, supply_rows))
+                    await self._notify_change(conn, cid, 'stock')
+            return total
+
     async def get_stock_dates_summary(self, company_id: int) -> List[Dict]:
         """Сводка по доступным датам остатков"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT date, COUNT(product_id) as items_count
                 FROM stock
@@ -680,20 +1033,20 @@ class DatabasePG:
             return [dict(row) for row in rows]
 
     async def get_latest_stock_date(self, company_id: int):
-        async with self.pool.acquire() as conn:
-            return await conn.fetchval("SELECT MAX(date) FROM stock WHERE company_id = $1", company_id)
+        async with self.acquire() as conn:
+            return await conn.fetchval("SELECT MAX(date) FROM stock_latest WHERE company_id = $1", company_id)
 
     async def get_earliest_stock_date(self, company_id: int):
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             return await conn.fetchval("SELECT MIN(date) FROM stock WHERE company_id = $1", company_id)
 
     async def get_total_stock_records(self, company_id: int) -> int:
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             return await conn.fetchval("SELECT COUNT(*) FROM stock WHERE company_id = $1", company_id)
 
     async def get_supply_history(self, company_id: int, product_id: int, days: int = 14) -> List[Dict]:
         """История поставок товара"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT date, boxes, weight, cost
                 FROM supplies
@@ -703,31 +1056,64 @@ class DatabasePG:
             """, company_id, product_id, days)
             return [dict(row) for row in rows]
 
+    async def get_supply_histories(self, company_id: int, product_ids: Sequence[int],
+                                   days: int = 14) -> Dict[int, List[Dict]]:
+        """История поставок сразу по многим товарам (как get_supply_history, одним запросом)"""
+        histories = {product_id: [] for product_id in product_ids}
+        if not histories:
+            return histories
+        async with self.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT p.product_id, s.date, s.boxes, s.weight, s.cost
+                FROM unnest($2::int[]) AS p(product_id)
+                CROSS JOIN LATERAL (
+                    SELECT date, boxes, weight, cost
+                    FROM supplies
+                    WHERE company_id = $1 AND product_id = p.product_id
+                    ORDER BY date DESC
+                    LIMIT $3
+                ) s
+                ORDER BY p.product_id, s.date DESC
+            """, company_id, list(histories), days)
+        for row in rows:
+            histories[row['product_id']].append(
+                {'date': row['date'], 'boxes': row['boxes'], 'weight': row['weight'], 'cost': row['cost']})
+        return histories
+
     async def add_or_update_user(self, user_id: int, username: str = None, 
                                first_name: str = None, last_name: str = None, company_id: Optional[int] = None):
         """Добавить пользователя или обновить его данные"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             # Сначала проверяем, есть ли уже пользователь (чтобы не затереть его company_id)
             existing = await conn.fetchrow("SELECT company_id FROM users WHERE id = $1", user_id)
-            
+
             final_company_id = company_id
             if existing and company_id is None:
                 final_company_id = existing['company_id']
 
-            await conn.execute("""
-                INSERT INTO users (id, username, first_name, last_name, company_id, last_seen)
-                VALUES ($1, $2, $3, $4, $5, CURRENT_TIMESTAMP)
-                ON CONFLICT(id) DO UPDATE SET
-                    username = EXCLUDED.username,
-                    first_name = EXCLUDED.first_name,
-                    last_name = EXCLUDED.last_name,
-                    company_id = COALESCE($5, users.company_id),
-                    last_seen = CURRENT_TIMESTAMP
-            """, user_id, username, first_name, last_name, final_company_id)
+            # Обычный вызов на каждое сообщение ничего не меняет; оповещаем только о смене компании,
+            # и только тогда платим за явную транзакцию
+            company_changed = company_id is not None and (not existing or existing['company_id'] != company_id)
+            async with (conn.transaction() if company_changed else contextlib.nullcontext()):
+                await conn.execute("""
+                    INSERT INTO users (id, username, first_name, last_name, company_id, last_seen)
+                    VALUES ($1, $2, $3, $4, $5, CURRENT_TIMESTAMP)
+                    ON CONFLICT(id) DO UPDATE SET
+                        username = EXCLUDED.username,
+                        first_name = EXCLUDED.first_name,
+                        last_name = EXCLUDED.last_name,
+                        company_id = COALESCE($5, users.company_id),
+                        last_seen = CURRENT_TIMESTAMP
+                """, user_id, username, first_name, last_name, final_company_id)
+                if company_changed:
+                    await self._notify_change(conn, company_id, 'users')
+
+        if company_changed:
+            self._apply_change(company_id, 'users')
 
     async def get_users_by_company(self, company_id: int) -> List[Dict]:
         """Получить список всех сотрудников франшизы (только активных)"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             records = await conn.fetch("""
                 SELECT id, username, first_name, last_name, real_name, role, is_active, created_at, last_seen
                 FROM users 
@@ -738,7 +1124,7 @@ class DatabasePG:
 
     async def get_archived_users_by_company(self, company_id: int) -> List[Dict]:
         """Получить список всех удаленных сотрудников (неактивных)"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             records = await conn.fetch("""
                 SELECT id, username, first_name, last_name, real_name, role, is_active, created_at, last_seen
                 FROM users 
@@ -749,28 +1135,36 @@ class DatabasePG:
 
     async def get_user_role(self, user_id: int) -> str:
         """Получить роль пользователя"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             role = await conn.fetchval("SELECT role FROM users WHERE id = $1", user_id)
             return role if role else 'user'
 
     async def update_user_role(self, user_id: int, new_role: str):
         """Обновление роли пользователя"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("UPDATE users SET role = $1 WHERE id = $2", new_role, user_id)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                company_id = await conn.fetchval(
+                    "UPDATE users SET role = $1 WHERE id = $2 RETURNING company_id", new_role, user_id)
+                await self._notify_change(conn, company_id, 'users')
+        self._apply_change(company_id, 'users')
 
     async def update_user_real_name(self, user_id: int, real_name: str):
         """Обновление реального ФИО пользователя"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             await conn.execute("UPDATE users SET real_name = $1 WHERE id = $2", real_name, user_id)
 
     async def set_user_role(self, user_id: int, role: str):
         """Установить роль пользователю"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("UPDATE users SET role = $2 WHERE id = $1", user_id, role)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                company_id = await conn.fetchval(
+                    "UPDATE users SET role = $2 WHERE id = $1 RETURNING company_id", user_id, role)
+                await self._notify_change(conn, company_id, 'users')
+        self._apply_change(company_id, 'users')
 
     async def list_users_with_roles(self, company_id: int) -> List[Dict]:
         """Список всех активных пользователей компании"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT id, first_name, last_name, username, role, last_seen 
                 FROM users 
@@ -783,13 +1177,13 @@ class DatabasePG:
 
     async def get_admin_ids(self, company_id: int) -> List[int]:
         """Получить ID всех админов компании"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("SELECT id FROM users WHERE company_id = $1 AND role = 'admin'", company_id)
             return [row['id'] for row in rows]
 
     async def get_user_info(self, user_id: int) -> Dict:
         """Получить информацию о пользователе со статусом активности"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             row = await conn.fetchrow("""
                 SELECT u.id, u.first_name, u.last_name, u.username, u.role, u.company_id, u.is_active, c.name as company_name
                 FROM users u
@@ -798,33 +1192,56 @@ class DatabasePG:
             """, user_id)
             return dict(row) if row else {}
             
+    async def get_auth_context(self, user_id: int) -> Optional[Dict]:
+        """Роль, компания, активность и статус подписки пользователя одним запросом (для веб-авторизации)"""
+        async with self.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT u.id, u.role, u.company_id, u.is_active, c.subscription_status
+                FROM users u
+                LEFT JOIN companies c ON u.company_id = c.id
+                WHERE u.id = $1
+            """, user_id)
+            return dict(row) if row else None
+
+    @invalidates_cache('users')
     async def remove_user(self, user_id: int, company_id: int) -> bool:
         """Пометить пользователя как неактивного (удален) из компании"""
-        async with self.pool.acquire() as conn:
-            result = await conn.execute("""
-                UPDATE users 
-                SET is_active = FALSE, role = 'employee'
-                WHERE id = $1 AND company_id = $2 AND role != 'superadmin'
-            """, user_id, company_id)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                result = await conn.execute("""
+                    UPDATE users
+                    SET is_active = FALSE, role = 'employee'
+                        WHERE id = $1 AND company_id = $2 AND role != 'superadmin'
+                """, user_id, company_id)
+                await self._notify_change(conn, company_id, 'users')
             return result.endswith('1')
 
+    @invalidates_cache('users')
     async def restore_user(self, user_id: int, company_id: int) -> bool:
         """Восстановить пользователя обратно в штат (роль employee)"""
-        async with self.pool.acquire() as conn:
-            result = await conn.execute("""
-                UPDATE users 
-                SET is_active = TRUE, role = 'employee'
-                WHERE id = $1 AND company_id = $2
-            """, user_id, company_id)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                result = await conn.execute("""
+                    UPDATE users
+                    SET is_active = TRUE, role = 'employee'
+                    WHERE id = $1 AND company_id = $2
+                """, user_id, company_id)
+                await self._notify_change(conn, company_id, 'users')
             return result.endswith('1')
 
-    async def create_stock_submission(self, company_id: int, user_id: int, date, items: List[Dict]) -> int:
-        """Создать заявку на ввод остатков"""
+    async def create_stock_submission(self, company_id: int, user_id: int, date, items: List[Dict],
+                                      notify: Optional[Callable[[int], List[Dict]]] = None) -> int:
+        """
+        Создать заявку на ввод остатков
+
+        notify(submission_id) -> уведомления (utils.notification_outbox.notification),
+        которые записываются в notification_outbox в той же транзакции.
+        """
         if isinstance(date, str):
             from datetime import datetime
             date = datetime.strptime(date, '%Y-%m-%d').date()
 
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.transaction():
                 sub_id = await conn.fetchval("""
                     INSERT INTO pending_stock_submissions (company_id, submitted_by, submission_date)
@@ -843,11 +1260,14 @@ class DatabasePG:
                         VALUES ($1, $2, $3, $4)
                     """, sub_id, item['product_id'], item['quantity'], item['weight'])
 
+                if notify:
+                    await self._insert_notifications(conn, company_id, notify(sub_id))
+
                 return sub_id
 
     async def get_pending_submissions(self, company_id: int) -> List[Dict]:
         """Получить все заявки компании"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT s.id, s.submission_date, s.status, s.created_at, 
                        u.first_name, u.last_name, u.real_name, u.username
@@ -860,7 +1280,7 @@ class DatabasePG:
 
     async def get_all_submissions(self, company_id: int) -> List[Dict]:
         """Получить все заявки (для web-панели)"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT ps.*, u.username, u.first_name, u.last_name, u.real_name,
                        COUNT(psi.id) as items_count
@@ -875,7 +1295,7 @@ class DatabasePG:
 
     async def get_submission_by_id(self, company_id: int, submission_id: int) -> Dict:
         """Получить заявку"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             row = await conn.fetchrow("""
                 SELECT s.*, u.first_name, u.last_name 
                 FROM pending_stock_submissions s
@@ -886,7 +1306,7 @@ class DatabasePG:
 
     async def get_submission_items(self, submission_id: int) -> List[Dict]:
         """Получить товары в заявке"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT i.*, p.name_internal, p.name_russian, p.package_weight, p.unit
                 FROM pending_stock_items i
@@ -897,7 +1317,7 @@ class DatabasePG:
 
     async def approve_submission(self, submission_id: int, admin_id: int):
         """Одобрить заявку: копирует данные в stock"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.transaction():
                 sub = await conn.fetchrow("SELECT submission_date, company_id FROM pending_stock_submissions WHERE id = $1", submission_id)
                 if not sub:
@@ -908,26 +1328,26 @@ class DatabasePG:
                 
                 items = await conn.fetch("SELECT * FROM pending_stock_items WHERE submission_id = $1", submission_id)
                 
-                for item in items:
-                    qty = item['edited_quantity'] if item['edited_quantity'] is not None else item['quantity']
-                    wgt = item['edited_weight'] if item['edited_weight'] is not None else item['weight']
-                    
-                    await conn.execute("""
-                        INSERT INTO stock (company_id, product_id, date, quantity, weight)
-                        VALUES ($1, $2, $3, $4, $5)
-                        ON CONFLICT(product_id, date) DO UPDATE 
-                        SET quantity=EXCLUDED.quantity, weight=EXCLUDED.weight
-                    """, company_id, item['product_id'], date, qty, wgt)
+                stock_items = [{
+                    'product_id': item['product_id'],
+                    'quantity': item['edited_quantity'] if item['edited_quantity'] is not None else item['quantity'],
+                    'weight': item['edited_weight'] if item['edited_weight'] is not None else item['weight'],
+                } for item in items]
+                if stock_items:
+                    await self._upsert_stock_rows(conn, company_id, date, stock_items)
                 
                 await conn.execute("""
                     UPDATE pending_stock_submissions 
                     SET status = 'approved', reviewed_at = CURRENT_TIMESTAMP, reviewed_by = $2
                     WHERE id = $1
                 """, submission_id, admin_id)
+                await self._notify_change(conn, company_id, 'stock')
+
+        self._apply_change(company_id, 'stock')
 
     async def reject_submission(self, submission_id: int, admin_id: int, reason: str = None):
         """Отклонить заявку"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             await conn.execute("""
                 UPDATE pending_stock_submissions 
                 SET status = 'rejected', reviewed_at = CURRENT_TIMESTAMP, 
@@ -938,7 +1358,7 @@ class DatabasePG:
     async def update_submission_item(self, submission_id: int, product_id: int, 
                                      edited_quantity: float, edited_weight: float):
         """Правка остатка админом перед аппрувом"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             await conn.execute("""
                 UPDATE pending_stock_items
                 SET edited_quantity = $3, edited_weight = $4
@@ -947,7 +1367,7 @@ class DatabasePG:
 
     async def get_user_submissions(self, company_id: int, user_id: int, limit: int = 20) -> List[Dict]:
         """История заявок пользователя"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT id, submission_date, status, created_at, rejection_reason
                 FROM pending_stock_submissions
@@ -957,28 +1377,63 @@ class DatabasePG:
             """, company_id, user_id, limit)
             return [dict(row) for row in rows]
 
+    @invalidates_cache('orders')
     async def create_pending_order(self, company_id: int, total_cost: float, notes: str = None) -> int:
         """Создать заявку на заказ"""
-        async with self.pool.acquire() as conn:
-            return await conn.fetchval("""
-                INSERT INTO pending_orders (company_id, total_cost, notes)
-                VALUES ($1, $2, $3)
-                RETURNING id
-            """, company_id, total_cost, notes)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                order_id = await conn.fetchval("""
+                    INSERT INTO pending_orders (company_id, total_cost, notes)
+                    VALUES ($1, $2, $3)
+                    RETURNING id
+                """, company_id, total_cost, notes)
+                await self._notify_change(conn, company_id, 'orders')
+                return order_id
+
+    @invalidates_cache('orders')
+    async def create_pending_order_with_items(self, company_id: int, total_cost: float, notes: str,
+                                              items: List[Dict], notifications: Sequence[Dict] = ()) -> int:
+        """
+        Создать заказ в пути вместе с позициями и уведомлениями одной транзакцией
+
+        items - [{'product_id', 'boxes_ordered', 'weight_ordered', 'cost'}].
+        notifications (utils.notification_outbox.notification) попадают в
+        notification_outbox только если заказ сохранен.
+        """
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                order_id = await conn.fetchval("""
+                    INSERT INTO pending_orders (company_id, total_cost, notes)
+                    VALUES ($1, $2, $3)
+                    RETURNING id
+                """, company_id, total_cost, notes)
+                await conn.executemany("""
+                    INSERT INTO pending_order_items
+                    (order_id, product_id, boxes_ordered, weight_ordered, cost)
+                    VALUES ($1, $2, $3, $4, $5)
+                """, [(order_id, item['product_id'], item['boxes_ordered'],
+                       item['weight_ordered'], item['cost']) for item in items])
+                await self._insert_notifications(conn, company_id, notifications)
+                await self._notify_change(conn, company_id, 'orders')
+                return order_id
 
     async def add_item_to_order(self, order_id: int, product_id: int, 
                                 boxes_ordered: int, weight_ordered: float, cost: float):
         """Добавить товар к заказу"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO pending_order_items 
-                (order_id, product_id, boxes_ordered, weight_ordered, cost)
-                VALUES ($1, $2, $3, $4, $5)
-            """, order_id, product_id, boxes_ordered, weight_ordered, cost)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                company_id = await conn.fetchval("""
+                    INSERT INTO pending_order_items
+                    (order_id, product_id, boxes_ordered, weight_ordered, cost)
+                    VALUES ($1, $2, $3, $4, $5)
+                    RETURNING (SELECT company_id FROM pending_orders WHERE id = $1)
+                """, order_id, product_id, boxes_ordered, weight_ordered, cost)
+                await self._notify_change(conn, company_id, 'orders')
+        self._apply_change(company_id, 'orders')
 
     async def get_pending_orders(self, company_id: int) -> List[Dict]:
         """Получить все неисполненные заказы"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT * FROM pending_orders 
                 WHERE company_id = $1 AND status = 'pending' 
@@ -988,7 +1443,7 @@ class DatabasePG:
 
     async def get_pending_order_items(self, order_id: int) -> List[Dict]:
         """Детали заказа"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT i.*, p.name_internal, p.package_weight
                 FROM pending_order_items i
@@ -997,9 +1452,66 @@ class DatabasePG:
             """, order_id)
             return [dict(row) for row in rows]
 
+    @cached_query
+    async def get_pending_orders_with_items(self, company_id: int) -> List[Dict]:
+        """
+        Неисполненные заказы вместе с позициями одним запросом
+
+        Позиции собираются json_agg в подзапросе, поэтому экрану приемки
+        не нужен отдельный запрос get_pending_order_items на каждый заказ.
+        У каждого заказа есть items, items_count и total_weight.
+        """
+        return await self._fetch_pending_orders_with_items(company_id)
+
+    async def get_pending_order_with_items(self, company_id: int, order_id: int) -> Optional[Dict]:
+        """Один неисполненный заказ компании с позициями или None"""
+        orders = await self._fetch_pending_orders_with_items(company_id, order_id)
+        return orders[0] if orders else None
+
+    async def _fetch_pending_orders_with_items(self, company_id: int, order_id: Optional[int] = None) -> List[Dict]:
+        async with self.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT o.*,
+                       COALESCE(agg.items, '[]'::json) AS items,
+                       COALESCE(agg.items_count, 0) AS items_count,
+                       COALESCE(agg.total_weight, 0) AS total_weight
+                FROM pending_orders o
+                LEFT JOIN LATERAL (
+                    SELECT json_agg(json_build_object(
+                               'id', i.id,
+                               'order_id', i.order_id,
+                               'product_id', i.product_id,
+                               'boxes_ordered', i.boxes_ordered,
+                               'weight_ordered', i.weight_ordered,
+                               'cost', i.cost,
+                               'name_internal', p.name_internal,
+                               'name_russian', p.name_russian,
+                               'package_weight', p.package_weight,
+                               'box_weight', p.box_weight,
+                               'unit', p.unit
+                           ) ORDER BY i.id) AS items,
+                           COUNT(*) AS items_count,
+                           SUM(i.weight_ordered) AS total_weight
+                    FROM pending_order_items i
+                    JOIN products p ON i.product_id = p.id
+                    WHERE i.order_id = o.id
+                ) agg ON TRUE
+                WHERE o.company_id = $1 AND o.status = 'pending'
+                  AND ($2::int IS NULL OR o.id = $2)
+                ORDER BY o.created_at ASC
+            """, company_id, order_id)
+
+        orders = []
+        for row in rows:
+            order = dict(row)
+            order['items'] = json.loads(order['items'])
+            order['total_weight'] = float(order['total_weight'])
+            orders.append(order)
+        return orders
+
     async def complete_order(self, order_id: int):
         """Заказ прибыл - переводим в статус completed, добавляем supplies"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.transaction():
                 order = await conn.fetchrow("SELECT status, company_id FROM pending_orders WHERE id = $1", order_id)
                 if not order or order['status'] != 'pending':
@@ -1016,31 +1528,48 @@ class DatabasePG:
                         VALUES ($1, $2, $3, $4, $5, $6)
                     """, company_id, item['product_id'], today, item['boxes_ordered'], item['weight_ordered'], item['cost'])
 
+                await self._refresh_consumption_gaps(conn, company_id, [item['product_id'] for item in items], today)
+
                 await conn.execute("UPDATE pending_orders SET status = 'completed' WHERE id = $1", order_id)
+                await self._notify_change(conn, company_id, 'stock')
+
+        self._apply_change(company_id, 'stock')
 
     async def resolve_order_without_insert(self, order_id: int):
         """Отметить заказ как выполненный (например при ручной приемке) без автоматического добавления в supplies"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("UPDATE pending_orders SET status = 'completed' WHERE id = $1", order_id)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                company_id = await conn.fetchval(
+                    "UPDATE pending_orders SET status = 'completed' WHERE id = $1 RETURNING company_id", order_id)
+                await self._notify_change(conn, company_id, 'orders')
+        self._apply_change(company_id, 'orders')
 
     async def cancel_order(self, order_id: int):
         """Отменить заказ"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("UPDATE pending_orders SET status = 'cancelled' WHERE id = $1", order_id)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                company_id = await conn.fetchval(
+                    "UPDATE pending_orders SET status = 'cancelled' WHERE id = $1 RETURNING company_id", order_id)
+                await self._notify_change(conn, company_id, 'orders')
+        self._apply_change(company_id, 'orders')
 
+    @invalidates_cache('debts')
     async def add_supplier_debt(self, company_id: int, product_id: int, boxes: float, weight: float, cost: float) -> int:
         """Добавить недовезенный товар в долги поставщика"""
-        async with self.pool.acquire() as conn:
-            result = await conn.fetchval("""
-                INSERT INTO supplier_debts (company_id, product_id, boxes, weight, cost)
-                VALUES ($1, $2, $3, $4, $5)
-                RETURNING id
-            """, company_id, product_id, boxes, weight, cost)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                result = await conn.fetchval("""
+                    INSERT INTO supplier_debts (company_id, product_id, boxes, weight, cost)
+                    VALUES ($1, $2, $3, $4, $5)
+                    RETURNING id
+                """, company_id, product_id, boxes, weight, cost)
+                await self._notify_change(conn, company_id, 'debts')
             return result
 
+    @cached_query
     async def get_active_debts(self, company_id: int) -> List[Dict]:
         """Получить все незакрытые долги поставщиков"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT d.*, p.name_internal, p.name_russian, p.package_weight, p.units_per_box
                 FROM supplier_debts d
@@ -1052,9 +1581,10 @@ class DatabasePG:
 
     async def resolve_supplier_debt(self, debt_id: int):
         """Закрыть долг (товар был доставлен) - переносит в supplies и stock"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.transaction():
-                debt = await conn.fetchrow("SELECT * FROM supplier_debts WHERE id = $1 AND status = 'active'", debt_id)
+                # FOR UPDATE: одновременное закрытие одного долга не должно дважды добавить приход
+                debt = await conn.fetchrow("SELECT * FROM supplier_debts WHERE id = $1 AND status = 'active' FOR UPDATE", debt_id)
                 if not debt:
                     return
 
@@ -1074,28 +1604,9 @@ class DatabasePG:
                 """, company_id, debt['product_id'], today, debt['boxes'], debt['weight'], debt['cost'])
 
                 # 2. Обновляем склад (stock)
-                prev = await conn.fetchrow("""
-                    SELECT date, quantity, weight FROM stock 
-                    WHERE company_id = $1 AND product_id = $2 AND date <= $3 
-                    ORDER BY date DESC LIMIT 1
-                """, company_id, debt['product_id'], today)
-
-                if prev and prev['date'] == today:
-                    new_q = prev['quantity'] + packages
-                    new_w = prev['weight'] + debt['weight']
-                    await conn.execute("""
-                        UPDATE stock SET quantity=$1, weight=$2 
-                        WHERE company_id=$3 AND product_id=$4 AND date=$5
-                    """, new_q, new_w, company_id, debt['product_id'], today)
-                else:
-                    base_q = prev['quantity'] if prev else 0
-                    base_w = prev['weight'] if prev else 0
-                    new_q = base_q + packages
-                    new_w = base_w + debt['weight']
-                    await conn.execute("""
-                        INSERT INTO stock (company_id, product_id, date, quantity, weight)
-                        VALUES ($1, $2, $3, $4, $5)
-                    """, company_id, debt['product_id'], today, new_q, new_w)
+                await self._increment_stock_rows(conn, company_id, today, {
+                    debt['product_id']: (packages, float(debt['weight']))
+                })
 
                 # 3. Обновляем статус долга
                 await conn.execute("""
@@ -1103,31 +1614,42 @@ class DatabasePG:
                     SET status = 'resolved', resolved_at = CURRENT_TIMESTAMP 
                     WHERE id = $1
                 """, debt_id)
+                await self._notify_change(conn, company_id, 'stock')
+
+        self._apply_change(company_id, 'stock')
 
     async def cancel_supplier_debt(self, debt_id: int):
         """Отменить долг поставщика (товар так и не привезли, долг списан без прихода)"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                UPDATE supplier_debts 
-                SET status = 'cancelled', resolved_at = CURRENT_TIMESTAMP 
-                WHERE id = $1
-            """, debt_id)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                company_id = await conn.fetchval("""
+                    UPDATE supplier_debts
+                    SET status = 'cancelled', resolved_at = CURRENT_TIMESTAMP
+                    WHERE id = $1
+                    RETURNING company_id
+                """, debt_id)
+                await self._notify_change(conn, company_id, 'debts')
+        self._apply_change(company_id, 'debts')
 
     async def get_all_pending_weights(self, company_id: int) -> Dict[int, float]:
         """Получить вес в пути (pending orders) для всех товаров компани"""
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch("""
-                SELECT i.product_id, SUM(i.weight_ordered) as total_weight
-                FROM pending_order_items i
-                JOIN pending_orders o ON i.order_id = o.id
-                WHERE o.company_id = $1 AND o.status = 'pending'
-                GROUP BY i.product_id
-            """, company_id)
-            return {row['product_id']: float(row['total_weight']) for row in rows}
+        async with self.acquire() as conn:
+            return await self._fetch_pending_weights(conn, company_id)
+
+    async def _fetch_pending_weights(self, conn, company_id: int) -> Dict[int, float]:
+        """Вес в пути по всем товарам на уже открытом соединении"""
+        rows = await conn.fetch("""
+            SELECT i.product_id, SUM(i.weight_ordered) as total_weight
+            FROM pending_order_items i
+            JOIN pending_orders o ON i.order_id = o.id
+            WHERE o.company_id = $1 AND o.status = 'pending'
+            GROUP BY i.product_id
+        """, company_id)
+        return {row['product_id']: float(row['total_weight']) for row in rows}
 
     async def get_pending_weight_for_product(self, company_id: int, product_id: int) -> float:
         """Сколько кг сейчас в пути (в pending orders)"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             val = await conn.fetchval("""
                 SELECT SUM(i.weight_ordered) 
                 FROM pending_order_items i
@@ -1136,9 +1658,10 @@ class DatabasePG:
             """, company_id, product_id)
             return float(val) if val else 0.0
 
+    @cached_query
     async def get_company_details(self, company_id: int) -> Optional[Dict]:
         """Получить детальную информацию о компании, включая заметки (notes)"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             row = await conn.fetchrow("""
                 SELECT id, name, subscription_status, subscription_ends_at, notes, created_at,
                        default_shift_start, default_shift_end
@@ -1147,6 +1670,7 @@ class DatabasePG:
             """, company_id)
             return dict(row) if row else None
 
+    @invalidates_cache('company')
     async def update_company_details(self, company_id: int, name: str, default_shift_start: str = None, default_shift_end: str = None) -> bool:
         """Обновить название компании и стандартные часы смены"""
         from datetime import datetime
@@ -1160,27 +1684,33 @@ class DatabasePG:
             default_shift_end = default_shift_end.replace('.', ':')
             end_time = datetime.strptime(default_shift_end, '%H:%M').time()
             
-        async with self.pool.acquire() as conn:
-            result = await conn.execute("""
-                UPDATE companies
-                SET name = $1, default_shift_start = $2, default_shift_end = $3
-                WHERE id = $4
-            """, name, start_time, end_time, company_id)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                result = await conn.execute("""
+                    UPDATE companies
+                    SET name = $1, default_shift_start = $2, default_shift_end = $3
+                    WHERE id = $4
+                """, name, start_time, end_time, company_id)
+                await self._notify_change(conn, company_id, 'company')
             return result.startswith("UPDATE 1")
 
+    @invalidates_cache('company')
     async def update_company_notes(self, company_id: int, notes: str):
         """Обновить личные заметки администратора франшизы"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                UPDATE companies
-                SET notes = $1
-                WHERE id = $2
-            """, notes, company_id)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    UPDATE companies
+                    SET notes = $1
+                    WHERE id = $2
+                """, notes, company_id)
+                await self._notify_change(conn, company_id, 'company')
 
     # --- Новые методы для раздельных заметок на дашборде ---
+    @cached_query
     async def get_dashboard_notes(self, company_id: int) -> list[dict]:
         """Получить все заметки на дашборде"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT id, content, created_at
                 FROM company_notes
@@ -1189,37 +1719,47 @@ class DatabasePG:
             """, company_id)
             return [dict(row) for row in rows]
             
+    @invalidates_cache('notes')
     async def add_dashboard_note(self, company_id: int, content: str) -> int:
         """Добавить новую заметку на дашборд"""
-        async with self.pool.acquire() as conn:
-            return await conn.fetchval("""
-                INSERT INTO company_notes (company_id, content)
-                VALUES ($1, $2)
-                RETURNING id
-            """, company_id, content)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                note_id = await conn.fetchval("""
+                    INSERT INTO company_notes (company_id, content)
+                    VALUES ($1, $2)
+                    RETURNING id
+                """, company_id, content)
+                await self._notify_change(conn, company_id, 'notes')
+                return note_id
             
+    @invalidates_cache('notes')
     async def update_dashboard_note(self, note_id: int, company_id: int, content: str) -> bool:
         """Редактировать существующую заметку"""
-        async with self.pool.acquire() as conn:
-            result = await conn.execute("""
-                UPDATE company_notes
-                SET content = $1
-                WHERE id = $2 AND company_id = $3
-            """, content, note_id, company_id)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                result = await conn.execute("""
+                    UPDATE company_notes
+                    SET content = $1
+                    WHERE id = $2 AND company_id = $3
+                """, content, note_id, company_id)
+                await self._notify_change(conn, company_id, 'notes')
             return result == "UPDATE 1"
             
+    @invalidates_cache('notes')
     async def delete_dashboard_note(self, note_id: int, company_id: int) -> bool:
         """Удалить заметку"""
-        async with self.pool.acquire() as conn:
-            result = await conn.execute("""
-                DELETE FROM company_notes
-                WHERE id = $1 AND company_id = $2
-            """, note_id, company_id)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                result = await conn.execute("""
+                    DELETE FROM company_notes
+                    WHERE id = $1 AND company_id = $2
+                """, note_id, company_id)
+                await self._notify_change(conn, company_id, 'notes')
             return result == "DELETE 1"
 
     async def get_recent_activity(self, company_id: int, limit: int = 5) -> List[Dict]:
         """Получить ленту последних событий (приемки, заявки, заказы)"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT 
                     'supply' as type,
@@ -1257,7 +1797,7 @@ class DatabasePG:
 
     async def get_all_companies(self) -> list:
         """Получить список всех компаний (для Super-Admin)"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             records = await conn.fetch("""
                 SELECT 
                     c.id, 
@@ -1274,7 +1814,7 @@ class DatabasePG:
             
     async def create_company(self, name: str, trial_days: int = 14) -> dict:
         """Создать новую компанию (для Super-Admin)"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             # Создаем новую компанию
             record = await conn.fetchrow("""
                 INSERT INTO companies (name, subscription_status, subscription_ends_at)
@@ -1284,42 +1824,49 @@ class DatabasePG:
             
             return dict(record) if record else None
             
+    @invalidates_cache('products')
     async def copy_global_products_to_company(self, target_company_id: int):
         """Скопировать все товары из системной компании (id=1) в новую компанию"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO products 
-                (company_id, name_chinese, name_russian, name_internal, package_weight, units_per_box, box_weight, price_per_box, unit, is_global)
-                SELECT 
-                    $1, name_chinese, name_russian, name_internal, package_weight, units_per_box, box_weight, price_per_box, unit, TRUE
-                FROM products 
-                WHERE company_id = 1 AND is_global = TRUE
-                ON CONFLICT (company_id, name_internal) DO NOTHING
-            """, target_company_id)
-
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO products
+                    (company_id, name_chinese, name_russian, name_internal, package_weight, units_per_box, box_weight, price_per_box, unit, is_global)
+                    SELECT
+                        $1, name_chinese, name_russian, name_internal, package_weight, units_per_box, box_weight, price_per_box, unit, TRUE
+                    FROM products
+                    WHERE company_id = 1 AND is_global = TRUE
+                    ON CONFLICT (company_id, name_internal) DO NOTHING
+                """, target_company_id)
+                await self._notify_change(conn, None, 'products')
+
+    @invalidates_cache('company')
     async def update_company_subscription(self, company_id: int, status: str, days_to_add: int = None):
         """Обновить статус подписки и/или добавить дни"""
-        async with self.pool.acquire() as conn:
-            if days_to_add is not None:
-                await conn.execute("""
-                    UPDATE companies 
-                    SET subscription_status = $1, 
-                        subscription_ends_at = CURRENT_TIMESTAMP + interval '1 day' * $2
-                    WHERE id = $3
-                """, status, days_to_add, company_id)
-            else:
-                await conn.execute("""
-                    UPDATE companies 
-                    SET subscription_status = $1
-                    WHERE id = $2
-                """, status, company_id)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                if days_to_add is not None:
+                    await conn.execute("""
+                        UPDATE companies
+                        SET subscription_status = $1,
+                            subscription_ends_at = CURRENT_TIMESTAMP + interval '1 day' * $2
+                        WHERE id = $3
+                    """, status, days_to_add, company_id)
+                else:
+                    await conn.execute("""
+                        UPDATE companies
+                        SET subscription_status = $1
+                        WHERE id = $2
+                    """, status, company_id)
+                await self._notify_change(conn, company_id, 'company')
 
+    @invalidates_cache('company')
     async def delete_company(self, company_id: int):
         """Удалить компанию и все связанные данные"""
         if company_id == 1:
             raise ValueError("Нельзя удалить системную компанию (id=1)")
             
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             async with conn.transaction():
                 # Удаляем связанные данные (каскад)
                 await conn.execute("DELETE FROM stock WHERE company_id = $1", company_id)
@@ -1347,6 +1894,7 @@ class DatabasePG:
                 
                 # Сама компания
                 await conn.execute("DELETE FROM companies WHERE id = $1", company_id)
+                await self._notify_change(conn, company_id, 'company')
 
     # ==========================
     # Shift Schedule (Staff)
@@ -1359,7 +1907,7 @@ class DatabasePG:
         if isinstance(end_date, str):
             end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
             
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT s.id, s.user_id, s.date, s.start_time, s.end_time, s.company_id,
                        u.first_name, u.last_name, u.real_name, u.role
@@ -1385,7 +1933,7 @@ class DatabasePG:
             end_time = end_time.replace('.', ':')
             parsed_end = datetime.strptime(end_time, '%H:%M').time()
             
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             shift_id = await conn.fetchval("""
                 INSERT INTO shifts (company_id, user_id, date, start_time, end_time)
                 VALUES ($1, $2, $3, $4, $5)
@@ -1396,13 +1944,13 @@ class DatabasePG:
             return shift_id
 
     async def delete_shift(self, company_id: int, shift_id: int) -> bool:
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             result = await conn.execute("DELETE FROM shifts WHERE id = $1 AND company_id = $2", shift_id, company_id)
             return result.startswith("DELETE 1")
 
     async def get_admins_for_company(self, company_id: int) -> List[int]:
         """Получить список Telegram ID всех администраторов и менеджеров конкретной компании"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             records = await conn.fetch(
                 "SELECT id FROM users WHERE company_id = $1 AND role IN ('admin', 'manager', 'superadmin') AND is_active = TRUE",
                 company_id
@@ -1411,7 +1959,7 @@ class DatabasePG:
 
     async def get_all_active_users(self) -> list:
         """Fallback method for getting all active users if shift isn't used"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             rows = await conn.fetch("SELECT id FROM users WHERE is_active = TRUE")
             return [row['id'] for row in rows]
 
@@ -1421,7 +1969,7 @@ class DatabasePG:
         Если на этот день есть смены, возвращает только тех, у кого смена.
         Если смен нет (расписание не ведется), возвращает всех активных сотрудников компании.
         """
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             shifts_today = await conn.fetchval("""
                 SELECT COUNT(*) FROM shifts WHERE company_id = $1 AND date = $2::DATE
             """, company_id, date_str)
@@ -1441,18 +1989,264 @@ class DatabasePG:
                 
             return [row['id'] for row in rows]
 
+    # ============ NOTIFICATION OUTBOX ============
+
+    async def _insert_notifications(self, conn, company_id: Optional[int], notifications: Sequence[Dict]) -> int:
+        """Записать уведомления в notification_outbox на открытом соединении (в транзакции вызывающего)"""
+        rows = [
+            (company_id, chat_id, n.get('kind'), n['text'], json.dumps(n.get('options') or {}))
+            for n in notifications
+            for chat_id in n['chat_ids']
+        ]
+        if rows:
+            await conn.executemany("""
+                INSERT INTO notification_outbox (company_id, chat_id, kind, text, options)
+                VALUES ($1, $2, $3, $4, $5::jsonb)
+            """, rows)
+        return len(rows)
+
+    async def enqueue_notifications(self, company_id: Optional[int], notifications: Sequence[Dict]) -> int:
+        """Поставить уведомления в очередь отправки (без связанного изменения данных)"""
+        async with self.acquire() as conn:
+            return await self._insert_notifications(conn, company_id, notifications)
+
+    async def claim_notifications(self, limit: int, lease_seconds: int, lease_token: str,
+                                  max_attempts: int) -> List[Dict]:
+        """
+        Забрать пачку уведомлений для отправки
+
+        Строки закрепляются за lease_token на lease_seconds (SKIP LOCKED:
+        параллельные воркеры берут разные строки). Пока пачка отправляется,
+        аренду продлевает extend_notification_leases. Если воркер упал, после
+        аренды строки снова станут доступны. attempts учитывает и такие попытки:
+        строки, исчерпавшие max_attempts без отметки результата (воркер каждый
+        раз падал на них), больше не выдаются и переводятся в dead.
+        """
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    UPDATE notification_outbox
+                    SET status = 'dead', locked_until = NULL, locked_by = NULL,
+                        last_error = COALESCE(last_error, 'аренда истекла без результата')
+                    WHERE status = 'pending'
+                      AND attempts >= $1
+                      AND (locked_until IS NULL OR locked_until < now())
+                """, max_attempts)
+                rows = await conn.fetch("""
+                    UPDATE notification_outbox
+                    SET locked_until = now() + make_interval(secs => $2),
+                        locked_by = $3,
+                        attempts = attempts + 1
+                    WHERE id IN (
+                        SELECT id FROM notification_outbox
+                        WHERE status = 'pending'
+                          AND attempts < $4
+                          AND next_attempt_at <= now()
+                          AND (locked_until IS NULL OR locked_until < now())
+                        ORDER BY next_attempt_at, id
+                        LIMIT $1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, company_id, chat_id, kind, text, options, attempts
+                """, limit, lease_seconds, lease_token, max_attempts)
+        notifications = []
+        for row in sorted(rows, key=lambda r: r['id']):
+            item = dict(row)
+            item['options'] = json.loads(item['options'])
+            notifications.append(item)
+        return notifications
+
+    async def extend_notification_leases(self, ids: Sequence[int], lease_seconds: int,
+                                         lease_token: str) -> int:
+        """Продлить аренду еще не отправленных строк пачки; возвращает число продленных"""
+        if not ids:
+            return 0
+        async with self.acquire() as conn:
+            result = await conn.execute("""
+                UPDATE notification_outbox
+                SET locked_until = now() + make_interval(secs => $2)
+                WHERE id = ANY($1::bigint[]) AND locked_by = $3 AND status = 'pending'
+            """, list(ids), lease_seconds, lease_token)
+            return int(result.split()[-1])
+
+    async def complete_notifications(self, sent_ids: Sequence[int], failed: Sequence[tuple],
+                                     max_attempts: int, lease_token: str):
+        """
+        Отметить результат отправки
+
+        failed - [(id, текст ошибки, можно ли повторить)]. Повторяемые ошибки
+        откладываются с экспоненциальной паузой (30 с, 1 мин, 2 мин... до 1 ч),
+        остальные и исчерпавшие max_attempts переводятся в dead. Строки, аренду
+        которых уже перехватил другой воркер (locked_by не lease_token), не меняются.
+        """
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                if sent_ids:
+                    await conn.execute("""
+                        UPDATE notification_outbox
+                        SET status = 'sent', sent_at = now(), locked_until = NULL, locked_by = NULL,
+                            last_error = NULL
+                        WHERE id = ANY($1::bigint[]) AND locked_by = $2 AND status = 'pending'
+                    """, list(sent_ids), lease_token)
+                if failed:
+                    await conn.executemany("""
+                        UPDATE notification_outbox
+                        SET status = CASE WHEN NOT $3 OR attempts >= $4 THEN 'dead' ELSE 'pending' END,
+                            last_error = $2,
+                            locked_until = NULL,
+                            locked_by = NULL,
+                            next_attempt_at = now() + make_interval(
+                                secs => LEAST(30 * power(2, GREATEST(attempts - 1, 0)), 3600))
+                        WHERE id = $1 AND locked_by = $5 AND status = 'pending'
+                    """, [(notification_id, error, retryable, max_attempts, lease_token)
+                          for notification_id, error, retryable in failed])
+
+    async def purge_sent_notifications(self, days: int = 7, dead_days: int = 30) -> int:
+        """Удалить отправленные уведомления старше days дней и недоставленные (dead) старше dead_days"""
+        async with self.acquire() as conn:
+            result = await conn.execute("""
+                DELETE FROM notification_outbox
+                WHERE (status = 'sent' AND sent_at < now() - make_interval(days => $1))
+                   OR (status = 'dead' AND created_at < now() - make_interval(days => $2))
+            """, days, dead_days)
+            return int(result.split()[-1])
+
+    async def get_outbox_stats(self) -> Dict:
+        """Размер очереди уведомлений по статусам и возраст самого старого ожидающего"""
+        async with self.acquire() as conn:
+            rows = await conn.fetch("SELECT status, COUNT(*) AS count FROM notification_outbox GROUP BY status")
+            oldest = await conn.fetchval("""
+                SELECT EXTRACT(EPOCH FROM now() - MIN(created_at))
+                FROM notification_outbox WHERE status = 'pending'
+            """)
+        stats = {row['status']: row['count'] for row in rows}
+        stats['oldest_pending_seconds'] = float(oldest) if oldest is not None else None
+        return stats
+
+    async def get_fsm_record(self, key: str, ttl_seconds: int) -> Optional[Dict]:
+        """Состояние FSM по ключу ({'state', 'data'}) или None, если его нет или оно устарело"""
+        async with self.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT state, data FROM fsm_states
+                WHERE key = $1 AND updated_at > now() - make_interval(secs => $2)
+            """, key, ttl_seconds)
+            return dict(row) if row else None
+
+    async def save_fsm_records(self, records: Sequence[tuple], channel: str, origin: str):
+        """
+        Записать пачку состояний FSM одной транзакцией
+
+        records - [(key, state, data)]; пустые (state и data равны None)
+        удаляются. Ключи объявляются в channel как '<origin>:<key>', чтобы
+        другие процессы сбросили их из локального кэша.
+        """
+        upserts = [r for r in records if r[1] is not None or r[2] is not None]
+        deletes = [r[0] for r in records if r[1] is None and r[2] is None]
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                if upserts:
+                    await conn.execute("""
+                        INSERT INTO fsm_states (key, state, data, updated_at)
+                        SELECT k, s, d, now()
+                        FROM unnest($1::text[], $2::text[], $3::bytea[]) AS t(k, s, d)
+                        ON CONFLICT (key) DO UPDATE
+                        SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = now()
+                    """, [r[0] for r in upserts], [r[1] for r in upserts], [r[2] for r in upserts])
+                if deletes:
+                    await conn.execute("DELETE FROM fsm_states WHERE key = ANY($1::text[])", deletes)
+                if self.notify_changes:
+                    # Доставляются после COMMIT, одной командой на всю пачку
+                    await conn.execute("""
+                        SELECT pg_notify($1, $2 || ':' || k) FROM unnest($3::text[]) AS k
+                    """, channel, origin, [r[0] for r in records])
+
+    async def purge_fsm_records(self, ttl_seconds: int) -> int:
+        """Удалить состояния FSM, не менявшиеся дольше ttl_seconds"""
+        async with self.acquire() as conn:
+            result = await conn.execute("""
+                DELETE FROM fsm_states WHERE updated_at < now() - make_interval(secs => $1)
+            """, ttl_seconds)
+            return int(result.split()[-1])
+
+    async def save_draft_order(self, key: str, data: Dict, ttl_seconds: int):
+        """Сохранить черновик заказа на ttl_seconds; попутно удалить просроченные"""
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO draft_orders (key, data, expires_at)
+                    VALUES ($1, $2::jsonb, now() + make_interval(secs => $3))
+                    ON CONFLICT (key) DO UPDATE
+                    SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+                """, key, json.dumps(data), ttl_seconds)
+                await conn.execute("DELETE FROM draft_orders WHERE expires_at < now()")
+
+    async def get_draft_order(self, key: str) -> Optional[Dict]:
+        """Черновик заказа по ключу или None, если его нет или он просрочен"""
+        async with self.acquire() as conn:
+            data = await conn.fetchval("""
+                SELECT data FROM draft_orders WHERE key = $1 AND expires_at > now()
+            """, key)
+            return json.loads(data) if data else None
+
+    async def get_stock_reminder_targets(self, date) -> List[Dict]:
+        """
+        Кому напомнить про ввод остатков: все компании без остатков за дату
+
+        Одним запросом вместо has_stock_for_date + get_active_users_for_reminder +
+        get_admins_for_company на каждую компанию. Для каждой компании с
+        активной подпиской или триалом, у которой нет ни одной строки stock
+        за дату, возвращает {'id', 'user_ids', 'admin_ids'}. user_ids выбираются
+        так же, как в get_active_users_for_reminder (с учетом графика смен).
+        """
+        if isinstance(date, str):
+            date = datetime.strptime(date, '%Y-%m-%d').date()
+        async with self.acquire() as conn:
+            rows = await conn.fetch("""
+                WITH missing AS (
+                    SELECT c.id,
+                           EXISTS (SELECT 1 FROM shifts s
+                                   WHERE s.company_id = c.id AND s.date = $1) AS has_shifts
+                    FROM companies c
+                    WHERE c.subscription_status IN ('active', 'trial')
+                      AND NOT EXISTS (SELECT 1 FROM stock st
+                                      WHERE st.company_id = c.id AND st.date = $1)
+                )
+                SELECT m.id,
+                       COALESCE(array_agg(u.id ORDER BY u.id) FILTER (
+                           WHERE u.id IS NOT NULL AND (
+                               NOT m.has_shifts
+                               OR u.role IN ('admin', 'manager', 'superadmin')
+                               OR EXISTS (SELECT 1 FROM shifts s WHERE s.user_id = u.id AND s.date = $1)
+                           )
+                       ), '{}') AS user_ids,
+                       COALESCE(array_agg(u.id ORDER BY u.id) FILTER (
+                           WHERE u.role IN ('admin', 'manager', 'superadmin')
+                       ), '{}') AS admin_ids
+                FROM missing m
+                LEFT JOIN users u ON u.company_id = m.id AND u.is_active = TRUE
+                GROUP BY m.id
+                ORDER BY m.id
+            """, date)
+            return [
+                {'id': row['id'], 'user_ids': list(row['user_ids']), 'admin_ids': list(row['admin_ids'])}
+                for row in rows
+            ]
+
+    @invalidates_cache('company')
     async def check_expired_subscriptions(self) -> int:
         """Переводит компании с истекшей подпиской в статус expired"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             from datetime import datetime
             from zoneinfo import ZoneInfo
             now = datetime.now(ZoneInfo("Asia/Almaty"))
             
-            result = await conn.execute("""
-                UPDATE companies 
-                SET subscription_status = 'expired'
-                WHERE subscription_end_date < $1 AND subscription_status IN ('active', 'trial')
-            """, now)
+            async with conn.transaction():
+                result = await conn.execute("""
+                    UPDATE companies
+                    SET subscription_status = 'expired'
+                    WHERE subscription_end_date < $1 AND subscription_status IN ('active', 'trial')
+                """, now)
+                await self._notify_change(conn, None, 'company')
             
             # Вернуть количество обновленных строк ('UPDATE 5' -> 5)
             try:
@@ -1463,7 +2257,7 @@ class DatabasePG:
 
     async def get_expiring_subscriptions(self, days_left: int) -> list:
         """Получает компании, подписка которых истекает ровно через X дней (или менее, если days_left=0)"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             from datetime import timedelta
             from zoneinfo import ZoneInfo
             now = datetime.now(ZoneInfo("Asia/Almaty")).date()
@@ -1489,18 +2283,20 @@ class DatabasePG:
             
             return [dict(r) for r in rows]
 
+    @cached_query
     async def get_company(self, company_id: int) -> Optional[Dict]:
         """Получить информацию о компании"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             row = await conn.fetchrow(
                 "SELECT id, name, name_internal, name_russian, subscription_status, subscription_end "
                 "FROM companies WHERE id = $1", company_id
             )
             return dict(row) if row else None
 
+    @invalidates_cache('company')
     async def extend_company_subscription(self, company_id: int, days_to_add: int) -> bool:
         """Продление подписки компании (или активация, если была отключена)"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             from datetime import timedelta
             from zoneinfo import ZoneInfo
             
@@ -1514,29 +2310,34 @@ class DatabasePG:
             else:
                 new_end = current_end + timedelta(days=days_to_add)
                 
-            result = await conn.execute(
-                "UPDATE companies SET subscription_status = 'active', subscription_end = $1 WHERE id = $2",
-                new_end, company_id
-            )
+            async with conn.transaction():
+                result = await conn.execute(
+                    "UPDATE companies SET subscription_status = 'active', subscription_end = $1 WHERE id = $2",
+                    new_end, company_id
+                )
+                await self._notify_change(conn, company_id, 'company')
             return result.startswith("UPDATE")
 
+    @invalidates_cache('products')
     async def duplicate_company_products(self, source_company_id: int, target_company_id: int) -> int:
         """Копирует все активные товары от одной компании (шаблона) к другой"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             # We explicitly list all columns EXCEPT id, created_at to avoid ID conflicts
-            result = await conn.execute("""
-                INSERT INTO products (
-                    company_id, name_russian, name_internal, 
-                    unit, box_weight, is_active, 
-                    category_id, display_order, price, units_per_box, is_global
-                )
-                SELECT 
-                    $2, name_russian, name_internal, 
-                    unit, box_weight, is_active, 
-                    category_id, display_order, price, units_per_box, is_global
-                FROM products 
-                WHERE company_id = $1 AND is_active = TRUE
-            """, source_company_id, target_company_id)
+            async with conn.transaction():
+                result = await conn.execute("""
+                    INSERT INTO products (
+                        company_id, name_russian, name_internal,
+                        unit, box_weight, is_active,
+                        category_id, display_order, price, units_per_box, is_global
+                    )
+                    SELECT
+                        $2, name_russian, name_internal,
+                        unit, box_weight, is_active,
+                        category_id, display_order, price, units_per_box, is_global
+                    FROM products
+                    WHERE company_id = $1 AND is_active = TRUE
+                """, source_company_id, target_company_id)
+                await self._notify_change(conn, None, 'products')
             
             # Extract number of inserted rows from result string like 'INSERT 0 45'
             try:
@@ -1545,9 +2346,15 @@ class DatabasePG:
             except Exception:
                 return 0
 
-    async def get_users_with_shift_in_one_hour(self, current_datetime) -> list:
+    async def get_users_with_shift_in_one_hour(self, current_datetime,
+                                               notify: Optional[Callable[[Dict], List[Dict]]] = None) -> list:
         """
         Возвращает список ID пользователей, у которых смена начинается ровно через 1 час.
+
+        У каждой смены есть admin_ids - активные админы компании. notify(смена)
+        -> уведомления, которые записываются в notification_outbox в той же
+        транзакции, что и отметка is_notified: отмеченная смена всегда получит
+        напоминание, даже если процесс перезапустится до отправки.
         """
         target_date = current_datetime.date()
         target_time = current_datetime.replace(second=0, microsecond=0).time()
@@ -1556,24 +2363,32 @@ class DatabasePG:
         # повторных запусках планировщика в одно и то же время, 
         # смена отмечалась как 'уведомленная' и больше не возвращалась.
         
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch("""
-                UPDATE shifts 
-                SET is_notified = TRUE
-                WHERE id IN (
-                    SELECT s.id
-                    FROM shifts s
-                    JOIN users u ON u.id = s.user_id
-                    WHERE u.is_active = TRUE 
-                      AND s.date = $1 
-                      AND s.is_notified = FALSE
-                      AND s.start_time >= $2::time + interval '55 minutes'
-                      AND s.start_time <= $2::time + interval '65 minutes'
-                )
-                RETURNING user_id AS id, company_id, 
-                          (SELECT first_name FROM users WHERE id = shifts.user_id) AS first_name,
-                          (SELECT last_name FROM users WHERE id = shifts.user_id) AS last_name,
-                          start_time
-            """, target_date, target_time)
-            
-            return [dict(row) for row in rows]
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch("""
+                    UPDATE shifts 
+                    SET is_notified = TRUE
+                    WHERE id IN (
+                        SELECT s.id
+                        FROM shifts s
+                        JOIN users u ON u.id = s.user_id
+                        WHERE u.is_active = TRUE 
+                          AND s.date = $1 
+                          AND s.is_notified = FALSE
+                          AND s.start_time >= $2::time + interval '55 minutes'
+                          AND s.start_time <= $2::time + interval '65 minutes'
+                    )
+                    RETURNING user_id AS id, company_id, 
+                              (SELECT first_name FROM users WHERE id = shifts.user_id) AS first_name,
+                              (SELECT last_name FROM users WHERE id = shifts.user_id) AS last_name,
+                              start_time,
+                              ARRAY(SELECT a.id FROM users a
+                                    WHERE a.company_id = shifts.company_id AND a.is_active = TRUE
+                                      AND a.role IN ('admin', 'manager', 'superadmin')) AS admin_ids
+                """, target_date, target_time)
+
+                shifts = [dict(row) for row in rows]
+                if notify:
+                    for shift in shifts:
+                        await self._insert_notifications(conn, shift['company_id'], notify(shift))
+                return shifts
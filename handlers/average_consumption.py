@@ -7,6 +7,7 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKe
 from database import Database
 from keyboards import get_main_menu
 from utils.calculations import calculate_average_consumption
+from handlers.stock import get_user_company_id, load_consumption_inputs
 
 router = Router()
 
@@ -50,16 +51,16 @@ async def process_avg_consumption(callback: CallbackQuery, db: Database):
             parse_mode="HTML"
         )
 
-        # Получаем все товары
-        products = await db.get_all_products()
+        # Все товары, их история и поставки - тремя запросами на компанию
+        company_id = await get_user_company_id(db, callback.from_user.id) if hasattr(db, 'pool') else 1
+        products, histories, supplies_by_product = await load_consumption_inputs(db, company_id, days=days)
 
         # Рассчитываем средний расход для каждого товара
         consumption_data = []
 
         for product in products:
-            # Получаем историю и поставки
-            history = await db.get_stock_history(product['id'], days=days)
-            supplies = await db.get_supply_history(product['id'], days=days)
+            history = histories.get(product['id'], [])
+            supplies = supplies_by_product.get(product['id'], [])
 
             if len(history) < 2:
                 # Недостаточно данных
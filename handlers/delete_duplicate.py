@@ -38,6 +38,7 @@ async def delete_duplicate_product(message: Message, db):
         await db.pool.execute("DELETE FROM stock WHERE product_id = $1", product_id)
         await db.pool.execute("DELETE FROM supplies WHERE product_id = $1", product_id)
         await db.pool.execute("DELETE FROM products WHERE id = $1", product_id)
+        await db.invalidate_company(None, 'products')
 
         result_text = (
             f"✅ <b>Товар успешно удален!</b>\n\n"
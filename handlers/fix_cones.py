@@ -29,6 +29,7 @@ async def cmd_fix_cones(message: Message, db: DatabasePG):
                 box_weight = 400.0
             WHERE name_internal = 'Хрустящие рожки по 400 штук'
         """)
+        await db.invalidate_company(None, 'products')
 
         # Проверяем результат
         row = await conn.fetchrow("""
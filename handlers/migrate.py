@@ -125,8 +125,19 @@ async def cmd_migrate_packaging(message: Message, db):
                     """, new_boxes, new_weight, record['id'])
 
             total_updated += 1
+            await db.invalidate_company(None, 'products')
             await message.answer(f"✅ {product['name_russian']} обновлён")
 
+        # Остатки и поставки изменены напрямую - пересчитываем интервалы расхода затронутых компаний
+        company_ids = {p.get('company_id') for p in packaging_products}
+        if None in company_ids:
+            await db.rebuild_consumption_gaps()
+            await db.invalidate_company(None, 'stock')
+        else:
+            for company_id in sorted(company_ids):
+                await db.rebuild_consumption_gaps(company_id)
+                await db.invalidate_company(company_id, 'stock')
+
         await message.answer(
             f"✅ <b>МИГРАЦИЯ ЗАВЕРШЕНА!</b>\n\n"
             f"Обновлено товаров: {total_updated}\n\n"
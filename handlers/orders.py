@@ -8,6 +8,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from database import Database
 from keyboards import get_main_menu
+from handlers.stock import get_user_company_id
 from utils.calculations import (
     calculate_average_consumption,
     days_until_stockout,
@@ -29,31 +30,50 @@ class OrderStates(StatesGroup):
 
 async def prepare_order_data(db, company_id=1, lookback_days: int = 30):
     """Подготовить данные для формирования заказа с учетом товаров в пути"""
-    stock = await db.get_latest_stock(company_id) if hasattr(db, 'pool') else await db.get_latest_stock()
+    if not hasattr(db, 'pool'):
+        return await _prepare_order_data_sqlite(db, lookback_days)
+
+    stock = await db.get_latest_stock(company_id)
+    product_ids = [item['product_id'] for item in stock]
+
+    # История остатков, поставки и вес в пути по всем товарам - три запроса на компанию
+    histories = await db.get_stock_histories(company_id, product_ids, days=lookback_days)
+    supplies = await db.get_supply_histories(company_id, product_ids, days=lookback_days)
+    pending_weights = await db.get_all_pending_weights(company_id)
+
+    return [
+        _enrich_order_item(item, histories[item['product_id']], supplies[item['product_id']],
+                           pending_weights.get(item['product_id'], 0.0))
+        for item in stock
+    ]
+
+
+async def _prepare_order_data_sqlite(db, lookback_days: int):
+    """prepare_order_data для локальной SQLite: запросы по каждому товару"""
+    stock = await db.get_latest_stock()
     enriched_stock = []
 
     for item in stock:
         # Получаем историю остатков за последние `lookback_days` дней для стабильного среднего
-        if hasattr(db, 'pool'):
-            history = await db.get_stock_history(company_id, item['product_id'], days=lookback_days)
-            supplies = await db.get_supply_history(company_id, item['product_id'], days=lookback_days)
-            pending_weight = await db.get_pending_weight_for_product(company_id, item['product_id'])
-        else:
-            history = await db.get_stock_history(item['product_id'], days=lookback_days)
-            supplies = await db.get_supply_history(item['product_id'], days=lookback_days)
-            pending_weight = await db.get_pending_weight_for_product(item['product_id'])
+        history = await db.get_stock_history(item['product_id'], days=lookback_days)
+        supplies = await db.get_supply_history(item['product_id'], days=lookback_days)
+        pending_weight = await db.get_pending_weight_for_product(item['product_id'])
+        enriched_stock.append(_enrich_order_item(item, history, supplies, pending_weight))
+
+    return enriched_stock
 
-        # Рассчитываем средний расход с учетом поставок
-        avg_consumption, days_with_data, warning = calculate_average_consumption(history, supplies)
 
-        enriched_stock.append({
-            **item,
-            'avg_daily_consumption': avg_consumption,
-            'consumption_warning': warning,
-            'pending_weight': pending_weight  # Добавляем вес в пути
-        })
+def _enrich_order_item(item: dict, history: list, supplies: list, pending_weight: float) -> dict:
+    """Добавить к остатку средний расход и вес в пути"""
+    # Рассчитываем средний расход с учетом поставок
+    avg_consumption, days_with_data, warning = calculate_average_consumption(history, supplies)
 
-    return enriched_stock
+    return {
+        **item,
+        'avg_daily_consumption': avg_consumption,
+        'consumption_warning': warning,
+        'pending_weight': pending_weight  # Добавляем вес в пути
+    }
 
 
 async def generate_order(message: Message, db: Database, days: int,
@@ -262,6 +282,22 @@ async def handle_webapp_data(message: Message, db: Database, state: FSMContext):
         traceback.print_exc()
 
 
+async def load_pending_orders(db, user_id: int):
+    """Заказы в пути компании пользователя вместе с позициями одним запросом"""
+    if hasattr(db, 'pool'):
+        company_id = await get_user_company_id(db, user_id)
+        return await db.get_pending_orders_with_items(company_id)
+    return await db.get_pending_orders_with_items()
+
+
+async def load_pending_order(db, user_id: int, order_id: int):
+    """Один заказ в пути компании пользователя с позициями (None, если не найден)"""
+    if hasattr(db, 'pool'):
+        company_id = await get_user_company_id(db, user_id)
+        return await db.get_pending_order_with_items(company_id, order_id)
+    return await db.get_pending_order_with_items(order_id)
+
+
 @router.callback_query(F.data == "view_pending_orders")
 @router.message(Command("pending_orders"))
 @router.message(F.text == "📦 Заказы в пути")
@@ -276,7 +312,7 @@ async def cmd_view_pending_orders(update, db: Database, user_role: str = 'employ
         callback = None
 
     try:
-        orders = await db.get_pending_orders()
+        orders = await load_pending_orders(db, update.from_user.id)
 
         if not orders:
             text = "📦 <b>Активных заказов нет</b>\n\nВсе товары поступили на склад."
@@ -328,7 +364,8 @@ async def cmd_order_details(message: Message, db: Database):
             return
 
         order_id = int(parts[1])
-        items = await db.get_pending_order_items(order_id)
+        order = await load_pending_order(db, message.from_user.id, order_id)
+        items = order['items'] if order else []
 
         if not items:
             await message.answer(f"❌ Заказ #{order_id} не найден или уже закрыт")
@@ -339,7 +376,7 @@ async def cmd_order_details(message: Message, db: Database):
 
         total_cost = 0
         for item in items:
-            unit = item.get('unit', 'кг')
+            unit = item.get('unit') or 'кг'
             lines.append(
                 f"▫️ {item['name_russian']}\n"
                 f"   {item['boxes_ordered']} коробок × {item['box_weight']} {unit} = "
@@ -18,7 +18,35 @@ class StockInput(StatesGroup):
     entering_stock = State()
 
 
-async def format_stock_report(db: Database, stock_data: dict) -> str:
+async def get_user_company_id(db, user_id: int) -> int:
+    """Компания пользователя (PostgreSQL); по умолчанию - основная компания (id=1)"""
+    user_info = await db.get_user_info(user_id)
+    if user_info and user_info.get('company_id'):
+        return user_info['company_id']
+    return 1
+
+
+async def load_consumption_inputs(db, company_id: int = 1, days: int = 30):
+    """
+    Каталог и история для расчета среднего расхода - три запроса на компанию
+
+    Возвращает (products, histories, supplies): товары каталога и истории
+    остатков/поставок, сгруппированные по товару {product_id: [записи]}.
+    """
+    if hasattr(db, 'pool'):
+        products = await db.get_all_products(company_id)
+        product_ids = [product['id'] for product in products]
+        histories = await db.get_stock_histories(company_id, product_ids, days=days)
+        supplies = await db.get_supply_histories(company_id, product_ids, days=days)
+    else:
+        products = await db.get_all_products()
+        product_ids = [product['id'] for product in products]
+        histories = await db.get_stock_histories(product_ids, days=days)
+        supplies = await db.get_supply_histories(product_ids, days=days)
+    return products, histories, supplies
+
+
+async def format_stock_report(db: Database, stock_data: dict, company_id: int = 1) -> str:
     """Форматировать мини-отчет по складу с цветовой индикацией"""
     lines = ["📊 <b>ОТЧЕТ ПО СКЛАДУ</b>\n"]
 
@@ -27,20 +55,19 @@ async def format_stock_report(db: Database, stock_data: dict) -> str:
     yellow_items = []   # 7-10 дней
     green_items = []    # больше 10 дней
 
+    # Каталог и история за 30 дней (для стабильности среднего) по всем товарам сразу
+    products, histories, supplies = await load_consumption_inputs(db, company_id, days=30)
+    products_by_id = {product['id']: product for product in products}
+
     for product_id, data in stock_data.items():
         try:
-            # Получаем информацию о продукте
-            products = await db.get_all_products()
-            product = next((p for p in products if p['id'] == product_id), None)
+            product = products_by_id.get(product_id)
             if not product:
                 continue
 
-            # Получаем историю для расчета среднего расхода (30 дней для стабильности)
-            history = await db.get_stock_history(product_id, days=30)
-            supplies = await db.get_supply_history(product_id, days=30)
-
             # Рассчитываем средний расход с учетом поставок
-            avg_consumption, days_with_data, warning = calculate_average_consumption(history, supplies)
+            avg_consumption, days_with_data, warning = calculate_average_consumption(
+                histories.get(product_id, []), supplies.get(product_id, []))
 
             current_stock = data['weight']
             days_left = days_until_stockout(current_stock, avg_consumption)
@@ -187,18 +214,28 @@ async def process_stock_input(message: Message, state: FSMContext, db: Database,
         saved = 0
         total_weight = 0
 
-        for product_id, data in stock_data.items():
+        if hasattr(db, 'pool'):
+            # PostgreSQL: вся инвентаризация одним запросом
+            items = [{'product_id': product_id, **data} for product_id, data in stock_data.items()]
             try:
-                await db.add_stock(
-                    product_id=product_id,
-                    date=today,
-                    quantity=data['quantity'],
-                    weight=data['weight']
-                )
-                saved += 1
-                total_weight += data['weight']
+                company_id = await get_user_company_id(db, message.from_user.id)
+                saved = await db.bulk_upsert_stock(company_id, today, items)
+                total_weight = sum(item['weight'] for item in items)
             except Exception as e:
                 print(f"Ошибка сохранения: {e}")
+        else:
+            for product_id, data in stock_data.items():
+                try:
+                    await db.add_stock(
+                        product_id=product_id,
+                        date=today,
+                        quantity=data['quantity'],
+                        weight=data['weight']
+                    )
+                    saved += 1
+                    total_weight += data['weight']
+                except Exception as e:
+                    print(f"Ошибка сохранения: {e}")
 
         await state.clear()
         is_private = message.chat.type == 'private'
@@ -215,7 +252,8 @@ async def process_stock_input(message: Message, state: FSMContext, db: Database,
         # Формируем и отправляем мини-отчет отдельным сообщением
         try:
             print(f"📊 Формирование отчёта для {len(stock_data)} товаров...")
-            report = await format_stock_report(db, stock_data)
+            report_company_id = await get_user_company_id(db, message.from_user.id) if hasattr(db, 'pool') else 1
+            report = await format_stock_report(db, stock_data, report_company_id)
             print(f"✅ Отчёт сформирован, длина: {len(report)} символов")
 
             if report and len(report) > 50:  # Проверяем что отчёт не пустой
@@ -294,19 +332,25 @@ async def handle_web_app_data(message: Message, db: Database):
         from datetime import datetime
         date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
 
-        # Сохраняем каждый остаток
+        # Сохраняем остатки
         saved = 0
         total_weight = 0
 
-        for item in stock_items:
-            await db.add_stock(
-                product_id=item['product_id'],
-                date=date_obj,
-                quantity=item['quantity'],
-                weight=item['weight']
-            )
-            saved += 1
-            total_weight += item['weight']
+        if hasattr(db, 'pool'):
+            # PostgreSQL: вся инвентаризация одним запросом
+            company_id = await get_user_company_id(db, message.from_user.id)
+            saved = await db.bulk_upsert_stock(company_id, date_obj, stock_items)
+            total_weight = sum(item['weight'] for item in stock_items)
+        else:
+            for item in stock_items:
+                await db.add_stock(
+                    product_id=item['product_id'],
+                    date=date_obj,
+                    quantity=item['quantity'],
+                    weight=item['weight']
+                )
+                saved += 1
+                total_weight += item['weight']
 
         # Формируем stock_data для отчета
         stock_data = {}
@@ -317,7 +361,7 @@ async def handle_web_app_data(message: Message, db: Database):
             }
 
         # Формируем мини-отчет
-        report = await format_stock_report(db, stock_data)
+        report = await format_stock_report(db, stock_data, company_id if hasattr(db, 'pool') else 1)
 
         await message.answer(
             f"✅ <b>Остатки сохранены через форму!</b>\n\n"
@@ -355,7 +399,12 @@ async def cmd_test_report(message: Message, db: Database, user_role: str = 'empl
         await message.answer("🧪 Тестирование отчёта по остаткам...", parse_mode="HTML")
 
         # Получаем последние остатки
-        stock = await db.get_latest_stock()
+        if hasattr(db, 'pool'):
+            company_id = await get_user_company_id(db, message.from_user.id)
+            stock = await db.get_latest_stock(company_id)
+        else:
+            company_id = 1
+            stock = await db.get_latest_stock()
 
         if not stock:
             await message.answer("❌ Нет данных об остатках для тестирования")
@@ -372,7 +421,7 @@ async def cmd_test_report(message: Message, db: Database, user_role: str = 'empl
         print(f"🧪 Тестирование отчёта для {len(stock_data)} товаров...")
 
         # Генерируем отчёт
-        report = await format_stock_report(db, stock_data)
+        report = await format_stock_report(db, stock_data, company_id)
 
         print(f"✅ Отчёт сформирован, длина: {len(report)} символов")
 
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Диагностика индексов: EXPLAIN (ANALYZE, BUFFERS) для горячих запросов DatabasePG
+
+Создает временную схему в базе DATABASE_URL, применяет к ней миграции и заполняет
+синтетическими данными (много компаний, ежедневные ревизии, поставки, заказы,
+смены). Затем вызывает горячие методы DatabasePG, перехватывает выполненный ими
+SQL и для каждого запроса выполняет EXPLAIN (ANALYZE, BUFFERS) в откатываемой
+транзакции. Последовательные сканы, отбросившие много чужих строк, выводятся
+как кандидаты на индекс. Схема удаляется в конце (кроме режима --keep).
+
+Использование:
+    python index_advisor.py [компаний] [дней] [--keep]
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import asyncpg
+from dotenv import load_dotenv
+
+from database_pg import DatabasePG
+
+load_dotenv()
+
+# Seq Scan, отбросивший фильтром не меньше строк, считается проблемой
+SEQ_SCAN_ROWS_THRESHOLD = 1000
+PRODUCTS_PER_COMPANY = 40
+USERS_PER_COMPANY = 5
+
+
+class _RecordingConnection:
+    """Прокси соединения asyncpg, записывающий выполняемые запросы"""
+
+    def __init__(self, conn, db):
+        self._conn = conn
+        self._db = db
+
+    def _record(self, query, args):
+        if self._db.recording:
+            self._db.recorded.append((self._db.current_method, query, args))
+
+    async def fetch(self, query, *args, **kwargs):
+        self._record(query, args)
+        return await self._conn.fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        self._record(query, args)
+        return await self._conn.fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        self._record(query, args)
+        return await self._conn.fetchval(query, *args, **kwargs)
+
+    async def execute(self, query, *args, **kwargs):
+        self._record(query, args)
+        return await self._conn.execute(query, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class _RecordingAcquire:
+    def __init__(self, db, ctx):
+        self._db = db
+        self._ctx = ctx
+
+    async def __aenter__(self):
+        return _RecordingConnection(await self._ctx.__aenter__(), self._db)
+
+    async def __aexit__(self, *exc):
+        return await self._ctx.__aexit__(*exc)
+
+
+class AdvisorDB(DatabasePG):
+    """DatabasePG, работающий во временной схеме и записывающий свой SQL"""
+
+    def __init__(self, database_url: str, schema: str):
+        super().__init__(database_url, min_size=1, max_size=2)
+        self.schema = schema
+        self.query_cache = None  # каждый метод должен дойти до SQL
+        self.recording = False
+        self.current_method = None
+        self.recorded = []
+
+    async def _create_pool(self):
+        return await asyncpg.create_pool(
+            self.database_url,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            ssl='prefer',
+            statement_cache_size=0,
+            server_settings={'search_path': self.schema},
+        )
+
+    def acquire(self):
+        return _RecordingAcquire(self, super().acquire())
+
+
+async def seed(conn, companies: int, days: int):
+    """Синтетические данные: все компании одинакового размера"""
+    await conn.execute("""
+        INSERT INTO companies (name, subscription_status, subscription_ends_at)
+        SELECT 'Advisor ' || g, 'active', NOW() + interval '30 days'
+        FROM generate_series(1, $1) g
+    """, companies)
+    await conn.execute("""
+        INSERT INTO products (company_id, name_internal, package_weight, units_per_box,
+                              box_weight, price_per_box, is_active)
+        SELECT c.id, 'product_' || g, 1.0, 10, 10.0, 10000, TRUE
+        FROM companies c, generate_series(1, $1) g
+    """, PRODUCTS_PER_COMPANY)
+    await conn.execute("""
+        INSERT INTO users (id, company_id, username, first_name, role, is_active)
+        SELECT c.id * 1000 + g, c.id, 'user_' || c.id || '_' || g, 'User ' || g,
+               CASE WHEN g = 1 THEN 'admin' ELSE 'user' END, TRUE
+        FROM companies c, generate_series(1, $1) g
+    """, USERS_PER_COMPANY)
+    await conn.execute("""
+        INSERT INTO stock (company_id, product_id, date, quantity, weight)
+        SELECT p.company_id, p.id, CURRENT_DATE - d, q, q
+        FROM products p, generate_series(0, $1 - 1) d, LATERAL (SELECT (random() * 50)::real AS q) r
+    """, days)
+    await conn.execute("""
+        INSERT INTO supplies (company_id, product_id, date, boxes, weight, cost)
+        SELECT p.company_id, p.id, CURRENT_DATE - d, 3, 30.0, 30000
+        FROM products p, generate_series(0, $1 - 1) d
+        WHERE random() < 0.1
+    """, days)
+    await conn.execute("""
+        INSERT INTO pending_orders (company_id, status, total_cost, created_at)
+        SELECT c.id, CASE WHEN g <= 2 THEN 'pending' ELSE 'completed' END, 500000,
+               NOW() - (g || ' days')::interval
+        FROM companies c, generate_series(1, 20) g
+    """)
+    await conn.execute("""
+        INSERT INTO pending_order_items (order_id, product_id, boxes_ordered, weight_ordered, cost)
+        SELECT o.id, p.id, 2, 20.0, 20000
+        FROM pending_orders o JOIN products p ON p.company_id = o.company_id
+    """)
+    await conn.execute("""
+        INSERT INTO pending_stock_submissions (company_id, submitted_by, submission_date, status, created_at)
+        SELECT u.company_id, u.id, CURRENT_DATE - d,
+               CASE WHEN d = 0 THEN 'pending' ELSE 'approved' END, NOW() - (d || ' days')::interval
+        FROM users u, generate_series(0, 29) d
+    """)
+    await conn.execute("""
+        INSERT INTO pending_stock_items (submission_id, product_id, quantity, weight)
+        SELECT s.id, p.id, 10, 10
+        FROM pending_stock_submissions s JOIN products p ON p.company_id = s.company_id
+        WHERE s.status = 'pending'
+    """)
+    await conn.execute("""
+        INSERT INTO shifts (company_id, user_id, date, start_time, end_time, is_notified)
+        SELECT u.company_id, u.id, CURRENT_DATE + d, '09:00', '18:00', d < 0
+        FROM users u, generate_series(-60, 7) d
+    """)
+    await conn.execute("""
+        INSERT INTO supplier_debts (company_id, product_id, boxes, weight, cost, status)
+        SELECT p.company_id, p.id, 1, 10, 10000, CASE WHEN random() < 0.2 THEN 'active' ELSE 'resolved' END
+        FROM products p
+    """)
+    await conn.execute("ANALYZE")
+
+
+async def run_hot_paths(db: AdvisorDB, company_id: int):
+    """Вызвать горячие методы DatabasePG для одной компании, записывая их SQL"""
+    async with db.acquire() as conn:
+        product_id = await conn.fetchval(
+            "SELECT MIN(id) FROM products WHERE company_id = $1", company_id)
+        order_id = await conn.fetchval(
+            "SELECT MIN(id) FROM pending_orders WHERE company_id = $1 AND status = 'pending'", company_id)
+        product_ids = [row['id'] for row in await conn.fetch(
+            "SELECT id FROM products WHERE company_id = $1", company_id)]
+
+    today = date.today()
+    calls = [
+        ('get_latest_stock', lambda: db.get_latest_stock(company_id)),
+        ('get_stock_with_consumption', lambda: db.get_stock_with_consumption(company_id)),
+        ('calculate_consumption', lambda: db.calculate_consumption(company_id, today - timedelta(days=30), today)),
+        ('get_stock_by_date', lambda: db.get_stock_by_date(company_id, today)),
+        ('has_stock_for_date', lambda: db.has_stock_for_date(company_id, today)),
+        ('get_latest_date_before', lambda: db.get_latest_date_before(company_id, today)),
+        ('get_stock_dates_summary', lambda: db.get_stock_dates_summary(company_id)),
+        ('get_stock_history', lambda: db.get_stock_history(company_id, product_id, 30)),
+        ('get_supply_history', lambda: db.get_supply_history(company_id, product_id, 14)),
+        ('get_stock_histories', lambda: db.get_stock_histories(company_id, product_ids, 30)),
+        ('get_supply_histories', lambda: db.get_supply_histories(company_id, product_ids, 30)),
+        ('get_supplies_between', lambda: db.get_supplies_between(company_id, today - timedelta(days=7), today)),
+        ('get_supply_total_period', lambda: db.get_supply_total_period(company_id, today - timedelta(days=30), today)),
+        ('get_pending_orders', lambda: db.get_pending_orders(company_id)),
+        ('get_pending_order_items', lambda: db.get_pending_order_items(order_id)),
+        ('get_pending_orders_with_items', lambda: db.get_pending_orders_with_items(company_id)),
+        ('get_all_pending_weights', lambda: db.get_all_pending_weights(company_id)),
+        ('get_pending_submissions', lambda: db.get_pending_submissions(company_id)),
+        ('get_all_submissions', lambda: db.get_all_submissions(company_id)),
+        ('get_active_debts', lambda: db.get_active_debts(company_id)),
+        ('get_stock_reminder_targets', lambda: db.get_stock_reminder_targets(today)),
+        ('get_recent_activity', lambda: db.get_recent_activity(company_id)),
+        ('get_shifts', lambda: db.get_shifts(company_id, today - timedelta(days=7), today + timedelta(days=7))),
+        ('get_active_users_for_reminder', lambda: db.get_active_users_for_reminder(company_id, today.isoformat())),
+        ('get_admins_for_company', lambda: db.get_admins_for_company(company_id)),
+        ('get_users_with_shift_in_one_hour', lambda: db.get_users_with_shift_in_one_hour(
+            datetime.combine(today, datetime.min.time()).replace(hour=8))),
+    ]
+
+    db.recording = True
+    try:
+        for name, call in calls:
+            db.current_method = name
+            await call()
+    finally:
+        db.recording = False
+
+
+def seq_scans(plan, found=None):
+    """Все узлы Seq Scan плана с числом отброшенных фильтром строк"""
+    if found is None:
+        found = []
+    if plan.get('Node Type') == 'Seq Scan':
+        loops = plan.get('Actual Loops', 1) or 1
+        removed = plan.get('Rows Removed by Filter', 0) * loops
+        found.append({'table': plan.get('Relation Name'), 'removed': removed,
+                      'rows': plan.get('Actual Rows', 0) * loops})
+    for child in plan.get('Plans', []):
+        seq_scans(child, found)
+    return found
+
+
+async def explain_recorded(conn, recorded):
+    """EXPLAIN (ANALYZE, BUFFERS) каждого записанного запроса; изменения откатываются"""
+    reports = []
+    seen = set()
+    for method, query, args in recorded:
+        sql = query.strip()
+        if sql in seen or sql.split(None, 1)[0].upper() not in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE'):
+            continue
+        seen.add(sql)
+
+        tr = conn.transaction()
+        await tr.start()
+        try:
+            raw = await conn.fetchval(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", *args)
+        finally:
+            await tr.rollback()
+
+        result = json.loads(raw)[0] if isinstance(raw, str) else raw[0]
+        plan = result['Plan']
+        reports.append({
+            'method': method,
+            'sql': ' '.join(sql.split())[:100],
+            'time_ms': result.get('Execution Time', 0.0),
+            'shared_read': plan.get('Shared Read Blocks', 0),
+            'shared_hit': plan.get('Shared Hit Blocks', 0),
+            'seq_scans': seq_scans(plan),
+        })
+    return reports
+
+
+def print_report(reports):
+    problems = 0
+    for r in reports:
+        bad = [s for s in r['seq_scans'] if s['removed'] >= SEQ_SCAN_ROWS_THRESHOLD]
+        mark = "❌" if bad else "✅"
+        print(f"{mark} {r['method']:<34} {r['time_ms']:8.2f} мс  "
+              f"buffers hit={r['shared_hit']} read={r['shared_read']}")
+        print(f"     {r['sql']}")
+        for s in bad:
+            problems += 1
+            print(f"     Seq Scan {s['table']}: отброшено {s['removed']} строк, возвращено {s['rows']}")
+
+    print()
+    if problems:
+        print(f"⚠️ Последовательных сканов по чужим строкам: {problems}")
+    else:
+        print("✅ Последовательных сканов по чужим строкам нет")
+
+
+async def main():
+    DATABASE_URL = os.getenv('DATABASE_URL')
+    if not DATABASE_URL:
+        print("DATABASE_URL not found!")
+        sys.exit(1)
+
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    companies = int(args[0]) if len(args) > 0 else 50
+    days = int(args[1]) if len(args) > 1 else 180
+    keep = '--keep' in sys.argv
+
+    schema = f"index_advisor_{os.getpid()}"
+    admin = await asyncpg.connect(DATABASE_URL, ssl='prefer', statement_cache_size=0)
+    await admin.execute(f"CREATE SCHEMA {schema}")
+    db = AdvisorDB(DATABASE_URL, schema)
+    try:
+        await db.init_db()
+        await admin.execute(f"SET search_path TO {schema}")
+
+        started = time.perf_counter()
+        print(f"📦 Генерация данных: {companies} компаний × {PRODUCTS_PER_COMPANY} товаров × {days} дней...")
+        await seed(admin, companies, days)
+        await db.rebuild_consumption_gaps()
+        print(f"   готово за {time.perf_counter() - started:.1f} с\n")
+
+        # Компания из середины диапазона: ее строки перемешаны с чужими
+        company_id = await admin.fetchval("SELECT id FROM companies ORDER BY id OFFSET $1 LIMIT 1", companies // 2)
+        await run_hot_paths(db, company_id)
+        print_report(await explain_recorded(admin, db.recorded))
+    finally:
+        await db.close()
+        if keep:
+            print(f"\nℹ️ Схема {schema} сохранена")
+        else:
+            await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,26 +1,38 @@
 """
 WeDrink Stock Manager Bot
 Telegram бот для учета закупок и складских остатков
+
+Роли процесса (python main.py --role ROLE или APP_ROLE):
+    all       - бот, веб-сервер, планировщик и outbox в одном процессе (по умолчанию)
+    web       - только веб-сервер, WEB_WORKERS процессов на одном порту (SO_REUSEPORT);
+                при BOT_MODE=webhook web-процессы также принимают обновления бота
+    bot       - только long polling бота
+    scheduler - планировщик задач и отправка notification_outbox
 """
+import argparse
 import asyncio
 import logging
+import multiprocessing
 import os
+import signal
+import sys
+from multiprocessing.connection import wait as wait_processes
+
 from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
-from dotenv import load_dotenv
 
+from config import ROLES, Settings
 from database import Database as SQLiteDB
 from database_pg import DatabasePG
 from handlers import start, stock, orders, reports, supply, products, history, migrate, average_consumption, fix_cones, delete_duplicate, payment
-from scheduler import setup_scheduler
+from scheduler import setup_scheduler, start_scheduler
+from utils.telegram_dispatcher import close_dispatchers
+from utils.notification_outbox import NotificationOutboxWorker
+from utils.fsm_storage import create_fsm_storage
 from webapp.server import create_app
 
-# Загрузка переменных окружения
-load_dotenv()
-
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -28,25 +40,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Конфигурация
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-DATABASE_URL = os.getenv('DATABASE_URL')  # PostgreSQL URL (на Railway)
-DATABASE_PATH = os.getenv('DATABASE_PATH', 'wedrink.db')  # SQLite (локально)
 
-
-async def main():
-    """Основная функция запуска бота"""
-    # Инициализация базы данных (автовыбор: PostgreSQL на Railway, SQLite локально)
-    if DATABASE_URL:
+async def open_database(settings: Settings):
+    """Инициализация базы данных (автовыбор: PostgreSQL на Railway, SQLite локально)"""
+    if settings.database_url:
         logger.info("🐘 Используется PostgreSQL")
-        db = DatabasePG(DATABASE_URL)
+        db = DatabasePG(settings.database_url)  # Один пул на процесс: бот, веб-сервер и планировщик
     else:
         logger.info("📁 Используется SQLite")
-        db = SQLiteDB(DATABASE_PATH)
+        db = SQLiteDB(settings.database_path)
 
     await db.init_db()
+    if hasattr(db, 'start_change_listener'):
+        # Изменения из других процессов (веб-реплики, отдельный планировщик) сбрасывают локальные кэши
+        await db.start_change_listener()
+    return db
+
 
-    # Проверка и автоматический импорт данных если БД пустая
+async def import_initial_data(db):
+    """Проверка и автоматический импорт данных если БД пустая"""
     products_list = await db.get_all_products(company_id=1)
     if not products_list:
         logger.info("📦 БД пустая, запускаю автоматический импорт...")
@@ -76,29 +88,34 @@ async def main():
         except Exception as e:
             logger.error(f"❌ Ошибка импорта: {e}")
 
-    # Инициализация бота и диспетчера
+
+def create_bot(settings: Settings) -> Bot:
     bot = Bot(
-        token=BOT_TOKEN,
+        token=settings.bot_token,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
 
     # Устанавливаем bot instance для webapp уведомлений
     from webapp.server import set_bot_instance
     set_bot_instance(bot)
+    return bot
 
-    # Запуск встроенного веб-сервера (в том же asyncio loop, что и бот)
-    web_app = create_app()
-    runner = web.AppRunner(web_app)
-    await runner.setup()
-    port = int(os.getenv('PORT', 5000))
-    site = web.TCPSite(runner, '0.0.0.0', port)
-    await site.start()
-    logger.info(f"🌐 Веб-сервер запущен на порту {port}")
 
-    # Добавляем storage для FSM (для сохранения состояний заказов)
-    storage = MemoryStorage()
+async def create_dispatcher(db) -> Dispatcher:
+    """Диспетчер aiogram с middleware и роутерами (общее FSM-хранилище в PostgreSQL)"""
+    storage = await create_fsm_storage(db)
     dp = Dispatcher(storage=storage)
 
+    if hasattr(storage, 'flush'):
+        # Состояния, измененные за обновление, записываются одной пачкой до ответа Telegram,
+        # поэтому следующее обновление в любой реплике уже видит их
+        @dp.update.outer_middleware()
+        async def fsm_flush_middleware(handler, event, data):
+            try:
+                return await handler(event, data)
+            finally:
+                await storage.flush()
+
     # Middleware для передачи db во все handlers
     @dp.update.outer_middleware()
     async def db_middleware(handler, event, data):
@@ -129,25 +146,174 @@ async def main():
     dp.include_router(moderation.router)
     dp.include_router(users.router)
 
-    # Настройка и запуск планировщика задач
-    scheduler = setup_scheduler(bot)
-    scheduler.start()
+    return dp
+
+
+def setup_webhook_route(web_app: web.Application, dp: Dispatcher, bot: Bot, settings: Settings):
+    """Принимать обновления Telegram на WEBHOOK_PATH того же aiohttp-приложения"""
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+    from webapp.server import PUBLIC_PATHS
+
+    # Запросы без верного X-Telegram-Bot-Api-Secret-Token отклоняются с 401
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=settings.webhook_secret).register(
+        web_app, path=settings.webhook_path
+    )
+    PUBLIC_PATHS.append(settings.webhook_path)
+
+
+async def start_web(settings: Settings, db, dp: Dispatcher = None, bot: Bot = None) -> web.AppRunner:
+    """Запуск веб-сервера; при нескольких web-процессах порт делится через SO_REUSEPORT"""
+    web_app = create_app(database=db)
+    if dp is not None:
+        setup_webhook_route(web_app, dp, bot, settings)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', settings.port, reuse_port=settings.web_workers > 1)
+    await site.start()
+    logger.info(f"🌐 Веб-сервер запущен на порту {settings.port} (pid {os.getpid()})")
+    return runner
+
+
+def stop_event() -> asyncio.Event:
+    """Событие остановки по SIGTERM/SIGINT (Railway и supervisor web-процессов шлют SIGTERM)"""
+    event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, event.set)
+    return event
+
 
-    logger.info("🤖 Бот запущен!")
+async def run_role(settings: Settings):
+    """Запустить компоненты роли в одном asyncio loop и дождаться остановки"""
+    role = settings.role
+    run_web = role in ('all', 'web')
+    run_bot = role == 'bot' or (role == 'all' and not settings.use_webhook)
+    run_webhook = run_web and settings.use_webhook
+    run_background = role in ('all', 'scheduler')
 
-    # Запуск polling
+    stop = stop_event()
+    db = await open_database(settings)
+    if role in ('all', 'scheduler'):
+        await import_initial_data(db)
+
+    bot = create_bot(settings)
+    dp = await create_dispatcher(db) if (run_bot or run_webhook) else None
+
+    runner = scheduler = leader = outbox_worker = polling = None
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if run_web:
+            runner = await start_web(settings, db, dp if run_webhook else None, bot)
+
+        if run_background:
+            # Настройка и запуск планировщика задач (задачи выполняет только лидер среди реплик)
+            # Отправка notification_outbox (только PostgreSQL) идет у того же лидера,
+            # чтобы в Telegram слал один процесс с одним лимитом
+            scheduler = setup_scheduler(bot, db)
+            if hasattr(db, 'pool'):
+                outbox_worker = NotificationOutboxWorker.from_env(db, bot)
+            leader = start_scheduler(scheduler, db, outbox_worker)
+
+        if run_webhook and os.getenv('WEB_WORKER_INDEX', '0') == '0':
+            # Все реплики регистрируют один и тот же URL; при остановке webhook не удаляем,
+            # чтобы не отключить обновления для остальных реплик
+            await bot.set_webhook(
+                url=settings.webhook_url,
+                secret_token=settings.webhook_secret,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            logger.info(f"🔗 Webhook установлен: {settings.webhook_path}")
+
+        if run_bot:
+            # Запуск polling
+            await bot.delete_webhook()
+            polling = asyncio.create_task(dp.start_polling(
+                bot, allowed_updates=dp.resolve_used_update_types(), handle_signals=False
+            ))
+
+        logger.info(f"🤖 Запущена роль {role} (бот: {settings.bot_mode if run_bot or run_webhook else 'нет'})")
+
+        waiters = [asyncio.create_task(stop.wait())]
+        if polling:
+            waiters.append(polling)
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
     finally:
-        await runner.cleanup()
-        scheduler.shutdown()
+        if polling:
+            if not polling.done():
+                await dp.stop_polling()
+            await asyncio.gather(polling, return_exceptions=True)
+        if runner:
+            await runner.cleanup()
+        if leader:
+            # Освобождаем lock сразу, чтобы другая реплика не ждала обрыва соединения
+            await leader.stop()
+        if scheduler:
+            scheduler.shutdown()
+        if outbox_worker:
+            await outbox_worker.stop()
+        await close_dispatchers()
+        if dp:
+            await dp.storage.close()
         if hasattr(db, 'close'):
             await db.close()
         await bot.session.close()
+        logger.info(f"👋 Роль {role} остановлена")
 
 
-if __name__ == '__main__':
+def _run_web_worker(settings: Settings, index: int):
+    """Точка входа дочернего web-процесса"""
+    os.environ['WEB_WORKER_INDEX'] = str(index)
+    asyncio.run(run_role(settings))
+
+
+def run_web_workers(settings: Settings):
+    """
+    Запустить WEB_WORKERS web-процессов на одном порту и следить за ними
+
+    Каждый процесс держит свой пул БД (DB_POOL_MAX_SIZE на процесс) и свои
+    кэши; кэши согласуются через LISTEN/NOTIFY. Если один процесс падает,
+    останавливаются все, чтобы платформа перезапустила сервис целиком.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    workers = [
+        ctx.Process(target=_run_web_worker, args=(settings, index), name=f"web-{index}")
+        for index in range(settings.web_workers)
+    ]
+    for process in workers:
+        process.start()
+    logger.info(f"🌐 Запущено web-процессов: {len(workers)}")
+
+    def terminate(*_):
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    wait_processes([process.sentinel for process in workers])
+    terminate()
+    for process in workers:
+        process.join()
+    # 0 - штатная остановка по сигналу, иначе - код упавшего процесса
+    return next((process.exitcode for process in workers if process.exitcode not in (0, -signal.SIGTERM)), 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WeDrink: бот, веб-сервер и планировщик")
+    parser.add_argument('--role', choices=ROLES, help="роль процесса (по умолчанию APP_ROLE или all)")
+    args = parser.parse_args()
+
+    settings = Settings.from_env(args.role)
     try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        logger.info("👋 Бот остановлен")
+        settings.validate()
+    except ValueError as e:
+        logger.error(f"❌ {e}")
+        sys.exit(1)
+
+    if settings.role == 'web' and settings.web_workers > 1:
+        sys.exit(run_web_workers(settings))
+    asyncio.run(run_role(settings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+-- Базовая схема Multi-Tenant SaaS (бывший DDL из DatabasePG.init_db)
+--
+-- Написана идемпотентно (IF NOT EXISTS), чтобы ее можно было применить к уже
+-- существующей продовой базе: там таблицы созданы старым init_db и разовыми
+-- скриптами (update_db_notes.py, add_real_name_column.py, migrate_menu_freeze.py).
+
+-- 1. Companies
+CREATE TABLE IF NOT EXISTS companies (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    subscription_status TEXT DEFAULT 'trial' CHECK (subscription_status IN ('trial', 'active', 'expired', 'cancelled')),
+    subscription_ends_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE companies
+    ADD COLUMN IF NOT EXISTS default_shift_start TIME,
+    ADD COLUMN IF NOT EXISTS default_shift_end TIME,
+    ADD COLUMN IF NOT EXISTS notes TEXT;
+
+-- 2. Users
+CREATE TABLE IF NOT EXISTS users (
+    id BIGINT PRIMARY KEY,
+    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    real_name TEXT,
+    role TEXT DEFAULT 'user',
+    is_active BOOLEAN DEFAULT TRUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS real_name TEXT;
+
+-- 3. Products
+CREATE TABLE IF NOT EXISTS products (
+    id SERIAL PRIMARY KEY,
+    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
+    name_chinese TEXT,
+    name_russian TEXT,
+    name_internal TEXT NOT NULL,
+    package_weight REAL NOT NULL,
+    units_per_box INTEGER NOT NULL,
+    box_weight REAL NOT NULL,
+    price_per_box REAL NOT NULL,
+    unit TEXT DEFAULT 'кг',
+    is_active BOOLEAN DEFAULT TRUE,
+    is_global BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(company_id, name_internal)
+);
+
+ALTER TABLE products ADD COLUMN IF NOT EXISTS is_global BOOLEAN DEFAULT FALSE;
+
+-- 4. Stock
+CREATE TABLE IF NOT EXISTS stock (
+    id SERIAL PRIMARY KEY,
+    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
+    product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    date DATE NOT NULL,
+    quantity REAL NOT NULL,
+    weight REAL NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(company_id, product_id, date)
+);
+
+-- 5. Supplies
+CREATE TABLE IF NOT EXISTS supplies (
+    id SERIAL PRIMARY KEY,
+    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
+    product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    date DATE NOT NULL,
+    boxes INTEGER NOT NULL,
+    weight REAL NOT NULL,
+    cost REAL NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 6. Pending Orders
+CREATE TABLE IF NOT EXISTS pending_orders (
+    id SERIAL PRIMARY KEY,
+    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    status TEXT DEFAULT 'pending' CHECK (status IN ('pending', 'completed', 'cancelled')),
+    total_cost REAL NOT NULL,
+    notes TEXT
+);
+
+-- 7. Pending Order Items
+CREATE TABLE IF NOT EXISTS pending_order_items (
+    id SERIAL PRIMARY KEY,
+    order_id INTEGER NOT NULL REFERENCES pending_orders(id) ON DELETE CASCADE,
+    product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    boxes_ordered INTEGER NOT NULL,
+    weight_ordered REAL NOT NULL,
+    cost REAL NOT NULL
+);
+
+-- 8. Pending Stock Submissions (старый init_db ссылался на нее, но не создавал)
+CREATE TABLE IF NOT EXISTS pending_stock_submissions (
+    id SERIAL PRIMARY KEY,
+    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
+    submitted_by BIGINT NOT NULL REFERENCES users(id),
+    submission_date DATE NOT NULL,
+    status TEXT DEFAULT 'pending' CHECK (status IN ('pending', 'approved', 'rejected')),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    reviewed_at TIMESTAMP,
+    reviewed_by BIGINT REFERENCES users(id),
+    rejection_reason TEXT,
+    UNIQUE(submitted_by, submission_date)
+);
+
+ALTER TABLE pending_stock_submissions
+    ADD COLUMN IF NOT EXISTS company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE;
+
+-- 9. Pending Stock Items (в старом DDL колонка edited_quantity была объявлена дважды)
+CREATE TABLE IF NOT EXISTS pending_stock_items (
+    id SERIAL PRIMARY KEY,
+    submission_id INTEGER NOT NULL REFERENCES pending_stock_submissions(id) ON DELETE CASCADE,
+    product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    quantity REAL NOT NULL,
+    weight REAL NOT NULL,
+    edited_quantity REAL,
+    edited_weight REAL
+);
+
+-- 10. Shifts (Employee Schedule; раньше создавалась дважды)
+CREATE TABLE IF NOT EXISTS shifts (
+    id SERIAL PRIMARY KEY,
+    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
+    user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
+    date DATE NOT NULL,
+    start_time TIME,
+    end_time TIME,
+    status VARCHAR(50) DEFAULT 'assigned',
+    is_notified BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE shifts ADD COLUMN IF NOT EXISTS is_notified BOOLEAN DEFAULT FALSE;
+
+-- 11. Supplier Debts (Missing items from deliveries)
+CREATE TABLE IF NOT EXISTS supplier_debts (
+    id SERIAL PRIMARY KEY,
+    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
+    product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+    boxes REAL NOT NULL,
+    weight REAL NOT NULL,
+    cost REAL NOT NULL,
+    status VARCHAR(50) DEFAULT 'active',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    resolved_at TIMESTAMP NULL
+);
+
+-- Личные заметки по компании (отдельные карточки)
+CREATE TABLE IF NOT EXISTS company_notes (
+    id SERIAL PRIMARY KEY,
+    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
+    content TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Уникальные ключи для ON CONFLICT в коде: stock(product_id, date) и
+-- shifts(company_id, user_id, date). В продовой базе они могут уже существовать
+-- под другими именами, поэтому создаем только при отсутствии равнозначного индекса.
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_indexes
+        WHERE schemaname = current_schema() AND tablename = 'stock'
+          AND indexdef LIKE 'CREATE UNIQUE INDEX % (product_id, date)'
+    ) THEN
+        CREATE UNIQUE INDEX stock_product_date_key ON stock(product_id, date);
+    END IF;
+
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_indexes
+        WHERE schemaname = current_schema() AND tablename = 'shifts'
+          AND indexdef LIKE 'CREATE UNIQUE INDEX % (company_id, user_id, date)'
+    ) THEN
+        CREATE UNIQUE INDEX shifts_company_user_date_key ON shifts(company_id, user_id, date);
+    END IF;
+END $$;
@@ -0,0 +1,18 @@
+-- 12. Consumption Gaps (расход между соседними ревизиями, производная от stock и supplies)
+--
+-- Заполняется из Python (DatabasePG.rebuild_consumption_gaps) после применения миграции.
+CREATE TABLE IF NOT EXISTS consumption_gaps (
+    company_id INTEGER REFERENCES companies(id) ON DELETE CASCADE,
+    product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+    start_date DATE NOT NULL,
+    end_date DATE NOT NULL,
+    days INTEGER NOT NULL,
+    consumed_quantity DOUBLE PRECISION NOT NULL,
+    consumed_weight DOUBLE PRECISION NOT NULL,
+    valid_days INTEGER NOT NULL,
+    is_anomaly BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (product_id, start_date)
+);
+
+CREATE INDEX IF NOT EXISTS idx_consumption_gaps_company_date
+    ON consumption_gaps(company_id, start_date);
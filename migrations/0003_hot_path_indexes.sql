@@ -0,0 +1,43 @@
+-- Составные индексы для горячих запросов Multi-Tenant
+--
+-- Почти все запросы фильтруют по company_id, поэтому он идет первым: запрос
+-- одной точки не должен читать строки остальных франшиз. INCLUDE-колонки
+-- позволяют отвечать index-only scan'ом без обращения к таблице.
+-- Проверка планов: python index_advisor.py
+
+-- Остатки: ревизия на дату, MAX/MIN(date), сводка по датам.
+-- (company_id, product_id, date) уже покрыт UNIQUE-ограничением таблицы.
+CREATE INDEX IF NOT EXISTS idx_stock_company_date
+    ON stock(company_id, date) INCLUDE (product_id, quantity, weight);
+
+-- Поставки: суммы за день/период, поставки между ревизиями, история товара
+CREATE INDEX IF NOT EXISTS idx_supplies_company_date
+    ON supplies(company_id, date) INCLUDE (product_id, boxes, weight, cost);
+CREATE INDEX IF NOT EXISTS idx_supplies_company_product_date
+    ON supplies(company_id, product_id, date) INCLUDE (boxes, weight, cost);
+
+-- Заказы в пути и их позиции
+CREATE INDEX IF NOT EXISTS idx_pending_orders_company_status
+    ON pending_orders(company_id, status, created_at);
+CREATE INDEX IF NOT EXISTS idx_pending_order_items_order
+    ON pending_order_items(order_id) INCLUDE (product_id, weight_ordered);
+
+-- Заявки на остатки и их позиции
+CREATE INDEX IF NOT EXISTS idx_pending_stock_submissions_company_status
+    ON pending_stock_submissions(company_id, status, created_at);
+CREATE INDEX IF NOT EXISTS idx_pending_stock_items_submission
+    ON pending_stock_items(submission_id);
+
+-- Смены: график компании и поиск неуведомленных смен планировщиком (каждые 5 минут)
+CREATE INDEX IF NOT EXISTS idx_shifts_company_date
+    ON shifts(company_id, date);
+CREATE INDEX IF NOT EXISTS idx_shifts_date_not_notified
+    ON shifts(date, start_time) WHERE is_notified = FALSE;
+
+-- Долги поставщиков, сотрудники и заметки компании
+CREATE INDEX IF NOT EXISTS idx_supplier_debts_company_status
+    ON supplier_debts(company_id, status);
+CREATE INDEX IF NOT EXISTS idx_users_company
+    ON users(company_id);
+CREATE INDEX IF NOT EXISTS idx_company_notes_company
+    ON company_notes(company_id);
@@ -0,0 +1,62 @@
+-- Снимок последних остатков: одна строка на товар (самая свежая ревизия)
+--
+-- get_latest_stock читает его за O(товаров) вместо ROW_NUMBER() по всей
+-- истории stock. Поддерживается триггером, поэтому любые записи в stock
+-- (методы DatabasePG, хендлеры, разовые скрипты) сразу видны в снимке.
+-- Внешних ключей нет намеренно: при каскадном удалении товара строки stock
+-- удаляются по одной, и триггер сам очищает снимок.
+CREATE TABLE IF NOT EXISTS stock_latest (
+    product_id INTEGER PRIMARY KEY,
+    company_id INTEGER,
+    date DATE NOT NULL,
+    quantity REAL NOT NULL,
+    weight REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_stock_latest_company
+    ON stock_latest(company_id) INCLUDE (date);
+
+CREATE OR REPLACE FUNCTION stock_latest_sync() RETURNS trigger AS $$
+BEGIN
+    -- Удаление или перенос строки, которая была последней: берем предыдущую ревизию
+    IF TG_OP = 'DELETE'
+       OR (TG_OP = 'UPDATE' AND (OLD.product_id <> NEW.product_id OR OLD.date <> NEW.date)) THEN
+        DELETE FROM stock_latest WHERE product_id = OLD.product_id AND date = OLD.date;
+        IF FOUND THEN
+            INSERT INTO stock_latest (product_id, company_id, date, quantity, weight)
+            SELECT product_id, company_id, date, quantity, weight
+            FROM stock
+            WHERE product_id = OLD.product_id
+            ORDER BY date DESC
+            LIMIT 1
+            ON CONFLICT (product_id) DO NOTHING;
+        END IF;
+    END IF;
+
+    -- Новая или измененная ревизия не старше текущей в снимке
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO stock_latest (product_id, company_id, date, quantity, weight)
+        VALUES (NEW.product_id, NEW.company_id, NEW.date, NEW.quantity, NEW.weight)
+        ON CONFLICT (product_id) DO UPDATE
+        SET company_id = EXCLUDED.company_id,
+            date = EXCLUDED.date,
+            quantity = EXCLUDED.quantity,
+            weight = EXCLUDED.weight
+        WHERE stock_latest.date <= EXCLUDED.date;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS stock_latest_sync ON stock;
+CREATE TRIGGER stock_latest_sync
+    AFTER INSERT OR UPDATE OR DELETE ON stock
+    FOR EACH ROW EXECUTE FUNCTION stock_latest_sync();
+
+-- Заполнение по существующей истории
+INSERT INTO stock_latest (product_id, company_id, date, quantity, weight)
+SELECT DISTINCT ON (product_id) product_id, company_id, date, quantity, weight
+FROM stock
+ORDER BY product_id, date DESC
+ON CONFLICT (product_id) DO NOTHING;
@@ -0,0 +1,32 @@
+-- Outbox уведомлений Telegram
+--
+-- Уведомление записывается в той же транзакции, что и изменение данных
+-- (заказ, заявка на остатки, отметка смены), а отправляет его фоновый
+-- воркер (utils/notification_outbox.py). Ни медленный Telegram, ни
+-- перезапуск процесса не теряют сообщения и не задерживают HTTP-запрос.
+--
+-- status: pending - ждет отправки, sent - отправлено, dead - не доставлено
+-- (ошибка без смысла повторять или исчерпаны попытки).
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    company_id INTEGER,
+    chat_id BIGINT NOT NULL,
+    kind TEXT,
+    text TEXT NOT NULL,
+    options JSONB NOT NULL DEFAULT '{}'::jsonb,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    locked_until TIMESTAMPTZ,
+    last_error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    sent_at TIMESTAMPTZ
+);
+
+-- Очередь воркера: только ожидающие отправки, по времени следующей попытки
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_pending
+    ON notification_outbox(next_attempt_at, id) WHERE status = 'pending';
+
+-- Очистка отправленных и просмотр недоставленных
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_status_created
+    ON notification_outbox(status, created_at);
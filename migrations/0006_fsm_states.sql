@@ -0,0 +1,16 @@
+-- Состояния диалогов бота (aiogram FSM)
+--
+-- Общее хранилище для всех процессов бота (utils/fsm_storage.py): начатый
+-- диалог (поставка, редактирование заказа, причина отклонения заявки)
+-- переживает перезапуск и продолжается в любой реплике за webhook'ом.
+-- data - pickle словаря FSM: в нем бывают ключи-числа, Decimal и даты,
+-- которые JSON не сохранит без потерь. Пустые состояния не хранятся.
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data BYTEA,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Удаление брошенных диалогов старше FSM_STATE_TTL
+CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states(updated_at);
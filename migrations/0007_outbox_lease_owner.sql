@@ -0,0 +1,6 @@
+-- Владелец аренды notification_outbox
+--
+-- claim_notifications записывает в locked_by токен пачки, а продление аренды
+-- и отметка результата выполняются только с этим токеном. Воркер, у которого
+-- аренду перехватил другой, не может ни продлить ее, ни перезаписать итог.
+ALTER TABLE notification_outbox ADD COLUMN IF NOT EXISTS locked_by TEXT;
@@ -0,0 +1,13 @@
+-- Черновики заказов для Mini App (/api/draft_order)
+--
+-- Бот сохраняет черновик через веб-сервер, а открывает его Mini App - запрос
+-- может прийти в другой web-процесс или реплику, поэтому черновики лежат в
+-- БД, а не в памяти процесса. Просроченные черновики не читаются и
+-- удаляются при следующих сохранениях.
+CREATE TABLE IF NOT EXISTS draft_orders (
+    key TEXT PRIMARY KEY,
+    data JSONB NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_draft_orders_expires_at ON draft_orders(expires_at);
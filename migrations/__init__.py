@@ -0,0 +1,111 @@
+"""
+Версионные миграции схемы PostgreSQL
+
+Каждая миграция - файл NNNN_описание.sql в этой папке. Примененные версии
+записываются в таблицу schema_migrations, поэтому каждая миграция выполняется
+ровно один раз. Одновременный запуск из нескольких реплик сериализуется
+advisory lock'ом: вторая реплика дождется первой и увидит, что применять нечего.
+"""
+import os
+import re
+from typing import Dict, List, NamedTuple
+
+MIGRATIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Ключ pg_advisory_lock для миграций (любое постоянное число, уникальное для приложения)
+MIGRATIONS_LOCK_ID = 7_301_905_001
+
+_FILENAME_RE = re.compile(r'^(\d{4})_([a-z0-9_]+)\.sql$')
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    path: str
+
+    def read_sql(self) -> str:
+        with open(self.path, encoding='utf-8') as f:
+            return f.read()
+
+
+def load_migrations() -> List[Migration]:
+    """Все миграции из папки migrations/, отсортированные по версии"""
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = _FILENAME_RE.match(filename)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2),
+                                        os.path.join(MIGRATIONS_DIR, filename)))
+    migrations.sort()
+
+    versions = [m.version for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"Дублирующиеся номера миграций: {versions}")
+    return migrations
+
+
+def latest_version() -> int:
+    """Версия схемы, которую ожидает код"""
+    migrations = load_migrations()
+    return migrations[-1].version if migrations else 0
+
+
+async def _ensure_migrations_table(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+async def current_version(conn) -> int:
+    """Текущая версия схемы в БД (0, если миграции еще не применялись)"""
+    exists = await conn.fetchval("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if not exists:
+        return 0
+    return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+
+
+async def migration_status(conn) -> List[Dict]:
+    """Список миграций с отметкой о применении (для run_migrations.py --status)"""
+    applied = {}
+    if await conn.fetchval("SELECT to_regclass('schema_migrations') IS NOT NULL"):
+        rows = await conn.fetch("SELECT version, applied_at FROM schema_migrations")
+        applied = {r['version']: r['applied_at'] for r in rows}
+    return [
+        {'version': m.version, 'name': m.name, 'applied_at': applied.get(m.version)}
+        for m in load_migrations()
+    ]
+
+
+async def apply_migrations(conn) -> List[Migration]:
+    """
+    Применить все непримененные миграции
+
+    Каждая миграция выполняется в своей транзакции вместе с записью
+    в schema_migrations. Возвращает список примененных миграций.
+    """
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_ID)
+    try:
+        await _ensure_migrations_table(conn)
+        applied_versions = {
+            r['version'] for r in await conn.fetch("SELECT version FROM schema_migrations")
+        }
+
+        applied = []
+        for migration in load_migrations():
+            if migration.version in applied_versions:
+                continue
+            print(f"🔄 Миграция {migration.version:04d}_{migration.name}...")
+            async with conn.transaction():
+                await conn.execute(migration.read_sql())
+                await conn.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                    migration.version, migration.name
+                )
+            applied.append(migration)
+        return applied
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
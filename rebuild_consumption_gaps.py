@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Пересчет таблицы consumption_gaps (интервалы расхода) по stock и supplies
+
+Использование:
+    python rebuild_consumption_gaps.py              # все компании
+    python rebuild_consumption_gaps.py <company_id> # одна компания
+"""
+import asyncio
+import os
+import sys
+from dotenv import load_dotenv
+from database_pg import DatabasePG
+
+load_dotenv()
+
+
+async def main():
+    DATABASE_URL = os.getenv('DATABASE_URL')
+    if not DATABASE_URL:
+        print("DATABASE_URL not found!")
+        return
+
+    company_id = int(sys.argv[1]) if len(sys.argv) > 1 else None
+
+    db = DatabasePG(DATABASE_URL)
+    await db.init_db()
+    try:
+        target = f"компании {company_id}" if company_id else "всех компаний"
+        print(f"🔄 Пересчитываю интервалы расхода для {target}...")
+        total = await db.rebuild_consumption_gaps(company_id)
+        print(f"✅ Готово: {total} интервалов")
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
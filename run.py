@@ -3,6 +3,7 @@
 Запуск бота и веб-сервера (веб-сервер встроен в main.py)
 """
 import os
+import subprocess
 import sys
 
 
@@ -22,12 +23,22 @@ def check_env():
     print("✅ Environment variables OK")
 
 
+def run_migrations():
+    """Применить миграции схемы до старта (один раз на деплой, а не в каждом процессе)"""
+    result = subprocess.run([sys.executable, 'run_migrations.py'])
+    if result.returncode != 0:
+        print("❌ ERROR: Migrations failed")
+        sys.exit(1)
+
+
 def main():
     print("🚀 Starting WeDrink services...")
     check_env()
+    run_migrations()
 
-    # Запускаем main.py (бот + встроенный веб-сервер в одном процессе)
-    os.execv(sys.executable, [sys.executable, 'main.py'])
+    # Запускаем main.py; аргументы (--role web|bot|scheduler) передаются как есть,
+    # без них - бот, веб-сервер и планировщик в одном процессе
+    os.execv(sys.executable, [sys.executable, 'main.py'] + sys.argv[1:])
 
 
 if __name__ == '__main__':
@@ -1,37 +1,52 @@
+#!/usr/bin/env python3
+"""
+Применение миграций схемы PostgreSQL (migrations/*.sql)
+
+Использование:
+    python run_migrations.py           # применить непримененные миграции
+    python run_migrations.py --status  # показать состояние миграций
+"""
 import asyncio
-import asyncpg
 import os
-
+import sys
 from dotenv import load_dotenv
 
+from database_pg import DatabasePG
+from migrations import migration_status
+
 load_dotenv()
 
-DATABASE_URL = os.getenv('DATABASE_URL')
-
-async def migrate():
-    print(f"Connecting to {DATABASE_URL}...")
-    pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=1, ssl='require')
-    async with pool.acquire() as conn:
-        try:
-            await conn.execute("ALTER TABLE companies ADD COLUMN notes TEXT")
-            print("Added notes")
-        except Exception as e:
-            print("Already exists notes", e)
-        
-        try:
-            await conn.execute("ALTER TABLE companies ADD COLUMN default_shift_start TIME")
-            print("Added default_shift_start")
-        except Exception as e:
-            print("Already exists default_shift_start", e)
-        
-        try:
-            await conn.execute("ALTER TABLE companies ADD COLUMN default_shift_end TIME")
-            print("Added default_shift_end")
-        except Exception as e:
-            print("Already exists default_shift_end", e)
-            
-    await pool.close()
-    print("Migration complete.")
-
-if __name__ == '__main__':
-    asyncio.run(migrate())
+
+async def show_status(db: DatabasePG):
+    async with db.acquire() as conn:
+        rows = await migration_status(conn)
+    for row in rows:
+        mark = f"✅ {row['applied_at']:%Y-%m-%d %H:%M}" if row['applied_at'] else "⏳ не применена"
+        print(f"  {row['version']:04d}_{row['name']:<30} {mark}")
+
+
+async def main():
+    DATABASE_URL = os.getenv('DATABASE_URL')
+    if not DATABASE_URL:
+        print("DATABASE_URL not found!")
+        sys.exit(1)
+
+    db = DatabasePG(DATABASE_URL, min_size=1, max_size=1)
+    # Пул создаем без init_db: он сам проверяет версию схемы
+    db.pool = await db._create_pool()
+    try:
+        if '--status' in sys.argv:
+            await show_status(db)
+            return
+
+        applied = await db.migrate()
+        if applied:
+            print(f"✅ Применено миграций: {len(applied)} ({', '.join(applied)})")
+        else:
+            print("✅ Схема актуальна, миграций для применения нет")
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,7 @@
 """
 Планировщик задач для WeDrink бота
 """
+import asyncio
 import logging
 import os
 from datetime import datetime
@@ -8,37 +9,29 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
+from utils.company_jobs import run_per_company
+from utils.telegram_dispatcher import get_dispatcher
+from utils.notification_outbox import notification
+from utils.leader_election import AdvisoryLockLeader
 
 logger = logging.getLogger(__name__)
 
 
-async def send_auto_purchase_order(bot: Bot):
+async def send_auto_purchase_order(bot: Bot, db):
     """
     Автоматически рассчитать и отправить заказ на закуп (если сумма >= 500,000₸)
     Отправляется в 12:00 по Астане
     """
     try:
-        from database import Database
-        from database_pg import DatabasePG
         from utils.calculations import get_auto_order_with_threshold, format_auto_order_list
         from handlers.orders import prepare_order_data
 
-        database_url = os.getenv('DATABASE_URL')
-        if database_url:
-            db = DatabasePG(database_url)
-        else:
-            db = Database("wedrink.db")
-            
-        await db.init_db()
-
         logger.info("🔍 Рассчитываю автоматический заказ на 14 дней для всех активных компаний...")
 
         companies = await db.get_all_companies()
-        
-        for company in companies:
-            if company.get('subscription_status') != 'active':
-                continue
-                
+        active_companies = [c for c in companies if c.get('subscription_status') == 'active']
+
+        async def process_company(company):
             company_id = company['id']
             # Подготавливаем данные (аналогично ручному расчету)
             stock_data = await prepare_order_data(db, company_id=company_id)
@@ -55,7 +48,7 @@ async def send_auto_purchase_order(bot: Bot):
                     f"🏢 Компания {company_id}: Сумма заказа ({total_cost:,.0f}₸) меньше порога (500,000₸). "
                     f"Уведомление не отправляется."
                 )
-                continue
+                return 0
 
             # Формируем сообщение
             order_text = format_auto_order_list(products_to_order, total_cost)
@@ -64,24 +57,16 @@ async def send_auto_purchase_order(bot: Bot):
             admin_ids = await db.get_admins_for_company(company_id)
             logger.info(f"📢 Компания {company_id}: Отправка заказа {len(admin_ids)} администраторам...")
 
-            success_count = 0
-            for admin_id in admin_ids:
-                try:
-                    await bot.send_message(
-                        chat_id=admin_id,
-                        text=order_text,
-                        parse_mode="HTML"
-                    )
-                    success_count += 1
-                except Exception as e:
-                    logger.error(f"❌ Ошибка отправки админу {admin_id}: {e}")
+            report = await get_dispatcher(bot).send_many(admin_ids, order_text, parse_mode="HTML")
+            success_count = report['sent']
 
             logger.info(
                 f"✅ Компания {company_id}: Автоматический заказ (сумма: {total_cost:,.0f}₸) "
                 f"отправлен {success_count}/{len(admin_ids)} администраторам"
             )
+            return success_count
 
-        await db.close()
+        await run_per_company('auto_purchase_order', active_companies, process_company)
 
     except Exception as e:
         logger.error(f"❌ Ошибка в send_auto_purchase_order: {e}")
@@ -89,145 +74,101 @@ async def send_auto_purchase_order(bot: Bot):
         traceback.print_exc()
 
 
-async def check_and_send_reminder(bot: Bot, reminder_type: str):
+async def check_and_send_reminder(bot: Bot, db, reminder_type: str):
     """
     Проверить введены ли остатки сегодня, если нет - отправить напоминание
 
     Args:
         bot: Telegram bot instance
+        db: общий экземпляр БД процесса
         reminder_type: Тип напоминания (morning, afternoon, evening, final)
     """
     try:
-        from database import Database
-        from database_pg import DatabasePG
-
-        database_url = os.getenv('DATABASE_URL')
-        if database_url:
-            db = DatabasePG(database_url)
-        else:
-            db = Database("wedrink.db")
-            
-        await db.init_db()
-
         from zoneinfo import ZoneInfo
         today = datetime.now(ZoneInfo("Asia/Almaty")).date()
         
-        companies = await db.get_all_companies()
-        
-        for company in companies:
-            if company.get('subscription_status') not in ['active', 'trial']:
-                continue
-                
-            company_id = company['id']
-            # Проверяем были ли введены остатки сегодня для этой компании
-            has_data = await db.has_stock_for_date(company_id, today) if hasattr(db, 'pool') else await db.has_stock_for_date(today)
-
-            if has_data:
-                logger.info(f"✅ Компания {company_id}: Остатки за {today} уже введены, напоминание не требуется")
-                continue
-
-            # Формируем сообщение в зависимости от времени
-            messages = {
-                'morning': (
-                    "⏰ <b>Доброе утро!</b>\n\n"
-                    "Напоминание: необходимо ввести остатки на складе.\n"
-                    "Нажмите 📝 Ввод остатков для обновления данных.\n\n"
-                    f"Дата: {today.strftime('%d.%m.%Y')}"
-                ),
-                'afternoon': (
-                    "⏰ <b>Напоминание!</b>\n\n"
-                    "Остатки ещё не введены.\n"
-                    "Пожалуйста, внесите данные по складу.\n\n"
-                    f"Дата: {today.strftime('%d.%m.%Y')}"
-                ),
-                'evening': (
-                    "⚠️ <b>Важное напоминание!</b>\n\n"
-                    "Остатки до сих пор не введены.\n"
-                    "Это влияет на точность расчёта закупов.\n"
-                    "Пожалуйста, внесите данные как можно скорее.\n\n"
-                    f"Дата: {today.strftime('%d.%m.%Y')}"
-                ),
-                'final': (
-                    "🚨 <b>КРАЙНЕЕ НАПОМИНАНИЕ!</b>\n\n"
-                    "Остатки за сегодня всё ещё не введены!\n"
-                    "Это последнее напоминание за день.\n\n"
-                    "⚠️ Без актуальных данных расчёт закупов будет неточным.\n"
-                    "Пожалуйста, не забудьте ввести остатки.\n\n"
-                    f"Дата: {today.strftime('%d.%m.%Y')}"
-                )
-            }
+        if not hasattr(db, 'pool'):
+            return # Only supported in PG mode currently
 
-            message = messages.get(reminder_type, messages['morning'])
+        # Компании без остатков за сегодня, их сотрудники (с учетом смен) и админы - одним запросом
+        targets = await db.get_stock_reminder_targets(today)
+        logger.info(f"📋 Остатки за {today} не введены в {len(targets)} компаниях")
+
+        # Формируем сообщение в зависимости от времени
+        messages = {
+            'morning': (
+                "⏰ <b>Доброе утро!</b>\n\n"
+                "Напоминание: необходимо ввести остатки на складе.\n"
+                "Нажмите 📝 Ввод остатков для обновления данных.\n\n"
+                f"Дата: {today.strftime('%d.%m.%Y')}"
+            ),
+            'afternoon': (
+                "⏰ <b>Напоминание!</b>\n\n"
+                "Остатки ещё не введены.\n"
+                "Пожалуйста, внесите данные по складу.\n\n"
+                f"Дата: {today.strftime('%d.%m.%Y')}"
+            ),
+            'evening': (
+                "⚠️ <b>Важное напоминание!</b>\n\n"
+                "Остатки до сих пор не введены.\n"
+                "Это влияет на точность расчёта закупов.\n"
+                "Пожалуйста, внесите данные как можно скорее.\n\n"
+                f"Дата: {today.strftime('%d.%m.%Y')}"
+            ),
+            'final': (
+                "🚨 <b>КРАЙНЕЕ НАПОМИНАНИЕ!</b>\n\n"
+                "Остатки за сегодня всё ещё не введены!\n"
+                "Это последнее напоминание за день.\n\n"
+                "⚠️ Без актуальных данных расчёт закупов будет неточным.\n"
+                "Пожалуйста, не забудьте ввести остатки.\n\n"
+                f"Дата: {today.strftime('%d.%m.%Y')}"
+            )
+        }
 
-            # Кнопка для перехода в Web App
-            web_app_url = os.getenv('WEB_APP_URL', 'http://localhost:5005')
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="📝 Ввести остатки (Web)", web_app=WebAppInfo(url=f"{web_app_url}/stock_input"))]
-            ])
+        message = messages.get(reminder_type, messages['morning'])
+
+        # Кнопка для перехода в Web App
+        web_app_url = os.getenv('WEB_APP_URL', 'http://localhost:5005')
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📝 Ввести остатки (Web)", web_app=WebAppInfo(url=f"{web_app_url}/stock_input"))]
+        ])
+
+        async def process_company(target):
+            company_id = target['id']
+            user_ids = target['user_ids']
+            logger.info(f"📢 Компания {company_id}: Рассылка {len(user_ids)} пользователям (с учетом графика смен)...")
+
+            dispatcher = get_dispatcher(bot)
+            report = await dispatcher.send_many(user_ids, message, parse_mode="HTML", reply_markup=keyboard)
+            success_count = report['sent']
 
-            # Отправляем всем пользователям в личку
-            if hasattr(db, 'get_active_users_for_reminder'):
-                user_ids = await db.get_active_users_for_reminder(company_id, today.isoformat())
-                logger.info(f"📢 Компания {company_id}: Рассылка {len(user_ids)} пользователям (с учетом графика смен)...")
-            else:
-                user_ids = await db.get_all_active_users()
-                logger.info(f"📢 Компания {company_id}: Рассылка {len(user_ids)} пользователям...")
-
-            success_count = 0
-            for user_id in user_ids:
-                try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=message,
-                        parse_mode="HTML",
-                        reply_markup=keyboard
-                    )
-                    success_count += 1
-                except Exception as e:
-                    logger.error(f"❌ Ошибка отправки пользователю {user_id}: {e}")
-                    
             # Дублируем уведомление администраторам франшизы (для контроля)
-            admin_ids = await db.get_admins_for_company(company_id)
-            for admin_id in admin_ids:
-                if admin_id not in user_ids: # не отправляем дважды, если админ на смене
-                    try:
-                        admin_msg = f"⚠️ <b>Внимание (Контроль)!</b>\n\nСотрудники получили напоминание о вводе остатков!\n\n" + message
-                        await bot.send_message(
-                            chat_id=admin_id,
-                            text=admin_msg,
-                            parse_mode="HTML",
-                            reply_markup=keyboard
-                        )
-                    except Exception as e:
-                        logger.error(f"❌ Ошибка CC админу {admin_id}: {e}")
+            # не отправляем дважды, если админ на смене
+            cc_ids = [admin_id for admin_id in target['admin_ids'] if admin_id not in user_ids]
+            if cc_ids:
+                admin_msg = f"⚠️ <b>Внимание (Контроль)!</b>\n\nСотрудники получили напоминание о вводе остатков!\n\n" + message
+                await dispatcher.send_many(cc_ids, admin_msg, parse_mode="HTML", reply_markup=keyboard)
 
             logger.info(f"✅ Компания {company_id}: Напоминание ({reminder_type}) отправлено {success_count}/{len(user_ids)} пользователям")
+            return success_count
 
-        # Закрываем БД после всех операций
-        await db.close()
+        await run_per_company(f'reminder_{reminder_type}', targets, process_company)
 
     except Exception as e:
         logger.error(f"❌ Ошибка в check_and_send_reminder: {e}")
 
-async def check_and_send_shift_reminder(bot: Bot):
+async def check_and_send_shift_reminder(bot: Bot, db):
     """
     Проверить, есть ли у кого-то смена через 1 час, и отправить напоминание.
     """
     try:
-        from database_pg import DatabasePG
-        database_url = os.getenv('DATABASE_URL')
-        if not database_url:
+        if not hasattr(db, 'pool'):
             return # Only supported in PG mode currently
-            
-        db = DatabasePG(database_url)
-        await db.init_db()
 
         from zoneinfo import ZoneInfo
         now_astana = datetime.now(ZoneInfo("Asia/Almaty")) # Changed to correctly use Almaty time
-        users_in_one_hour = await db.get_users_with_shift_in_one_hour(now_astana)
 
-        success_count = 0
-        for data in users_in_one_hour:
+        def build_notifications(data):
             user_id = data['id']
             start_time_str = data.get('start_time', '')
             if isinstance(start_time_str, str):
@@ -240,91 +181,66 @@ async def check_and_send_shift_reminder(bot: Bot):
                 f"Ваша смена начинается примерно через час (в <b>{start_time_str}</b>).\n"
                 "Пожалуйста, не опаздывайте!"
             )
-            
-            try:
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=message,
-                    parse_mode="HTML"
-                )
-                success_count += 1
-            except Exception as e:
-                logger.error(f"❌ Ошибка отправки напоминания о смене пользователю {user_id}: {e}")
-                
+
             # Копия администраторам для контроля
-            try:
-                company_id = data.get('company_id')
-                if company_id:
-                    first_name = data.get('first_name') or ''
-                    last_name = data.get('last_name') or ''
-                    employee_name = f"{first_name} {last_name}".strip() or "Сотрудник"
-                    
-                    admin_ids = await db.get_admins_for_company(company_id)
-                    admin_msg = f"👁‍🗨 <b>Контроль смен</b>\n\nСотруднику <b>{employee_name}</b> отправлено напоминание о начале смены в <b>{start_time_str}</b>."
-                    for admin_id in admin_ids:
-                        if admin_id != user_id:
-                            try:
-                                await bot.send_message(chat_id=admin_id, text=admin_msg, parse_mode="HTML")
-                            except Exception as e:
-                                logger.error(f"❌ Ошибка отправки CC админу {admin_id} о смене: {e}")
-            except Exception as e:
-                logger.error(f"❌ Ошибка при отправке CC о смене админам: {e}")
+            first_name = data.get('first_name') or ''
+            last_name = data.get('last_name') or ''
+            employee_name = f"{first_name} {last_name}".strip() or "Сотрудник"
+            admin_msg = f"👁‍🗨 <b>Контроль смен</b>\n\nСотруднику <b>{employee_name}</b> отправлено напоминание о начале смены в <b>{start_time_str}</b>."
+            cc_ids = [admin_id for admin_id in data.get('admin_ids') or [] if admin_id != user_id]
+
+            return [
+                notification([user_id], message, 'shift_reminder'),
+                notification(cc_ids, admin_msg, 'shift_reminder_cc'),
+            ]
+
+        # Смены отмечаются уведомленными и напоминания ставятся в outbox одной транзакцией;
+        # отправляет их фоновый воркер (utils/notification_outbox.py)
+        users_in_one_hour = await db.get_users_with_shift_in_one_hour(now_astana, notify=build_notifications)
 
         if users_in_one_hour:
-            logger.info(f"✅ Напоминание о предстоящей смене отправлено {success_count}/{len(users_in_one_hour)} пользователям")
+            logger.info(f"✅ Напоминание о предстоящей смене поставлено в очередь для {len(users_in_one_hour)} пользователей")
 
-        await db.close()
     except Exception as e:
         logger.error(f"❌ Ошибка в check_and_send_shift_reminder: {e}")
         import traceback
         traceback.print_exc()
 
-async def check_expired_trials_and_subscriptions():
+async def check_expired_trials_and_subscriptions(db):
     """Ежедневная задача для проверки и отключения истекших подписок/триалов"""
     try:
-        from database_pg import DatabasePG
-        database_url = os.getenv('DATABASE_URL')
-        if not database_url:
+        if not hasattr(db, 'pool'):
             return
-            
-        db = DatabasePG(database_url)
-        await db.init_db()
-        
+
         updated_count = await db.check_expired_subscriptions()
         if updated_count > 0:
             logger.warning(f"⚠️ Отключено {updated_count} компаний по истечению срока подписки/триала")
         else:
             logger.info("✅ Истекших подписок не найдено")
-            
-        await db.close()
+
     except Exception as e:
         logger.error(f"❌ Ошибка в check_expired_trials_and_subscriptions: {e}")
 
-async def check_expiring_subscriptions_and_notify(bot: Bot):
+async def check_expiring_subscriptions_and_notify(bot: Bot, db):
     """
     Проверяет подписки, которые истекают через 3 дня и 0 дней,
     и отправляет напоминание администраторам точки с кнопкой оплаты.
     """
     try:
-        from database_pg import DatabasePG
-        database_url = os.getenv('DATABASE_URL')
-        if not database_url:
+        if not hasattr(db, 'pool'):
             return
-            
-        db = DatabasePG(database_url)
-        await db.init_db()
 
         # 1. Проверяем те, у кого осталось ровно 3 дня
         expiring_in_3_days = await db.get_expiring_subscriptions(days_left=3)
         # 2. Проверяем те, у кого осталось 0 дней (истекает сегодня или уже истекла)
         expiring_today = await db.get_expiring_subscriptions(days_left=0)
 
-        # Функция для рассылки
+        # Функция для рассылки (компании обрабатываются параллельно)
         async def notify_admins(companies, days_left):
-            for company in companies:
+            async def notify_company(company):
                 company_id = company['id']
                 company_name = company['name_russian'] or company['name_internal']
-                
+            
                 # Формируем текст
                 if days_left == 0:
                     text = (
@@ -344,39 +260,45 @@ async def check_expiring_subscriptions_and_notify(bot: Bot):
                     [InlineKeyboardButton(text="💳 Оплатить подписку (Kaspi)", callback_data=f"pay_subscription_{company_id}")]
                 ])
 
+                # Отправку выполнит воркер outbox - задача не ждет Telegram
                 admin_ids = await db.get_admins_for_company(company_id)
-                for admin_id in admin_ids:
-                    try:
-                        await bot.send_message(
-                            chat_id=admin_id,
-                            text=text,
-                            parse_mode="HTML",
-                            reply_markup=keyboard
-                        )
-                    except Exception as e:
-                        logger.error(f"❌ Ошибка при отправке уведомления об оплате админу {admin_id}: {e}")
+                return await db.enqueue_notifications(
+                    company_id, [notification(admin_ids, text, 'subscription_warning', reply_markup=keyboard)])
+
+            await run_per_company(f'notify_expiring_subs_{days_left}d', companies, notify_company)
 
         # Отправляем уведомления
         await notify_admins(expiring_in_3_days, 3)
         await notify_admins(expiring_today, 0)
 
-        await db.close()
-
     except Exception as e:
         logger.error(f"❌ Ошибка в check_expiring_subscriptions_and_notify: {e}")
         import traceback
         traceback.print_exc()
 
-def setup_scheduler(bot: Bot) -> AsyncIOScheduler:
+def setup_scheduler(bot: Bot, db) -> AsyncIOScheduler:
     """
     Настроить и запустить планировщик задач
+
+    Все задачи используют общий экземпляр БД (один пул соединений на процесс),
+    а не создают собственный пул при каждом запуске. Задача не запускается
+    повторно, пока не закончился предыдущий запуск (max_instances=1), а
+    пропущенные срабатывания схлопываются в одно (coalesce).
     """
-    scheduler = AsyncIOScheduler(timezone="Asia/Almaty")  # Казахстан UTC+5
+    scheduler = AsyncIOScheduler(  # Казахстан UTC+5
+        timezone="Asia/Almaty",
+        job_defaults={
+            'max_instances': 1,
+            'coalesce': True,
+            'misfire_grace_time': int(os.getenv('SCHEDULER_MISFIRE_GRACE', 300)),
+        },
+    )
 
     # Проверка подписок каждую полночь в 00:05
     scheduler.add_job(
         check_expired_trials_and_subscriptions,
         trigger=CronTrigger(hour=0, minute=5, timezone="Asia/Almaty"),
+        args=[db],
         id='check_expired_subs',
         name='Проверка истекших подписок (00:05)',
         replace_existing=True
@@ -387,7 +309,7 @@ def setup_scheduler(bot: Bot) -> AsyncIOScheduler:
     scheduler.add_job(
         check_expiring_subscriptions_and_notify,
         trigger=CronTrigger(hour=10, minute=0, timezone="Asia/Almaty"),
-        args=[bot],
+        args=[bot, db],
         id='notify_expiring_subs',
         name='Напоминание об оплате подписки (10:00)',
         replace_existing=True
@@ -407,7 +329,7 @@ def setup_scheduler(bot: Bot) -> AsyncIOScheduler:
         scheduler.add_job(
             check_and_send_reminder,
             trigger=CronTrigger(hour=hour, minute=minute, timezone="Asia/Almaty"),
-            args=[bot, reminder_type],
+            args=[bot, db, reminder_type],
             id=f'reminder_{reminder_type}',
             name=name,
             replace_existing=True
@@ -420,7 +342,7 @@ def setup_scheduler(bot: Bot) -> AsyncIOScheduler:
     scheduler.add_job(
         send_auto_purchase_order,
         trigger=CronTrigger(hour=12, minute=0, timezone="Asia/Almaty"),
-        args=[bot],
+        args=[bot, db],
         id='auto_purchase_order',
         name='Автоматический заказ на закуп (12:00)',
         replace_existing=True
@@ -432,7 +354,7 @@ def setup_scheduler(bot: Bot) -> AsyncIOScheduler:
     scheduler.add_job(
         check_and_send_shift_reminder,
         trigger=CronTrigger(minute='*/5', timezone="Asia/Almaty"),
-        args=[bot],
+        args=[bot, db],
         id='shift_reminder',
         name='Напоминание о смене (за 1 час)',
         replace_existing=True
@@ -440,3 +362,42 @@ def setup_scheduler(bot: Bot) -> AsyncIOScheduler:
     logger.info("⏰ Проверка предстоящих смен настроена (каждые 5 минут)")
 
     return scheduler
+
+
+def start_scheduler(scheduler: AsyncIOScheduler, db, outbox_worker=None):
+    """
+    Запустить планировщик; при нескольких репликах задачи выполняет только лидер
+
+    На PostgreSQL планировщик стартует на паузе и возобновляется, когда процесс
+    становится лидером (AdvisoryLockLeader). Новый лидер не догоняет
+    пропущенные срабатывания: предыдущий лидер мог успеть их выполнить, поэтому
+    расписание пересчитывается от текущего момента. Возвращает объект лидерства
+    (его нужно остановить при завершении) или None для SQLite.
+
+    outbox_worker (NotificationOutboxWorker) работает только у лидера: все
+    массовые отправки в Telegram (задачи планировщика и notification_outbox)
+    идут из одного процесса через один лимит TelegramDispatcher.
+    """
+    if not hasattr(db, 'pool'):
+        scheduler.start()
+        return None
+
+    def on_elected():
+        now = datetime.now(scheduler.timezone)
+        for job in scheduler.get_jobs():
+            job.modify(next_run_time=job.trigger.get_next_fire_time(None, now))
+        scheduler.resume()
+        if outbox_worker:
+            outbox_worker.start()
+        logger.info("▶️ Задачи планировщика выполняются в этом процессе")
+
+    def on_lost():
+        scheduler.pause()
+        if outbox_worker:
+            asyncio.create_task(outbox_worker.stop())
+        logger.info("⏸ Задачи планировщика приостановлены (лидер - другой процесс)")
+
+    scheduler.start(paused=True)
+    leader = AdvisoryLockLeader.from_env(db.database_url, on_elected=on_elected, on_lost=on_lost)
+    leader.start()
+    return leader
@@ -0,0 +1,101 @@
+"""
+Кэш контекста авторизации веб-приложения
+
+Хранит на короткое время (AUTH_CACHE_TTL секунд, по умолчанию 15):
+- контекст пользователя: роль, company_id, is_active, статус подписки компании;
+- результат проверки подписи Telegram initData (по SHA-256 строки initData).
+
+Роль и подписка сбрасываются сразу при изменениях (DatabasePG.add_change_handler,
+в том числе из других процессов через NOTIFY company_changed), TTL лишь страхует
+от изменений в обход DatabasePG.
+"""
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+class AuthContextCache:
+    """TTL/LRU-кэш контекстов пользователей и проверенных initData"""
+
+    def __init__(self, ttl: float = 15.0, max_entries: int = 5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._users: "OrderedDict[int, Tuple[float, Optional[Dict]]]" = OrderedDict()
+        self._init_data: "OrderedDict[str, Tuple[float, Optional[Dict]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls) -> "AuthContextCache":
+        return cls(
+            ttl=float(os.getenv('AUTH_CACHE_TTL', 15)),
+            max_entries=int(os.getenv('AUTH_CACHE_MAX_ENTRIES', 5000)),
+        )
+
+    def _get(self, store, key) -> Tuple[bool, Any]:
+        entry = store.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del store[key]
+            self.misses += 1
+            return False, None
+        store.move_to_end(key)
+        self.hits += 1
+        value = entry[1]
+        return True, dict(value) if value is not None else None
+
+    def _set(self, store, key, value):
+        if self.ttl <= 0:
+            return
+        store[key] = (time.monotonic() + self.ttl, dict(value) if value is not None else None)
+        store.move_to_end(key)
+        while len(store) > self.max_entries:
+            store.popitem(last=False)
+
+    # --- Контекст пользователя
+
+    def get_user(self, user_id: int) -> Tuple[bool, Optional[Dict]]:
+        """(найдено в кэше, контекст или None если пользователя нет в БД)"""
+        return self._get(self._users, user_id)
+
+    def set_user(self, user_id: int, context: Optional[Dict]):
+        self._set(self._users, user_id, context)
+
+    # --- Проверенные initData
+
+    @staticmethod
+    def init_data_key(init_data: str) -> str:
+        return hashlib.sha256(init_data.encode()).hexdigest()
+
+    def get_init_data(self, init_data: str) -> Tuple[bool, Optional[Dict]]:
+        return self._get(self._init_data, self.init_data_key(init_data))
+
+    def set_init_data(self, init_data: str, tg_user: Optional[Dict]):
+        self._set(self._init_data, self.init_data_key(init_data), tg_user)
+
+    # --- Сброс
+
+    def on_change(self, company_id: Optional[int], entity: str):
+        """Обработчик DatabasePG.add_change_handler: роли и подписки изменились"""
+        if entity not in ('users', 'company', '*'):
+            return
+        # Смена роли или компании сотрудника (инвайт переводит его между компаниями)
+        # затрагивает и старую, и новую компанию - сбрасываем всех
+        if company_id is None or entity != 'company':
+            self._users.clear()
+            return
+        stale = [uid for uid, (_, ctx) in self._users.items()
+                 if ctx is None or ctx.get('company_id') == company_id]
+        for uid in stale:
+            del self._users[uid]
+
+    def stats(self) -> Dict:
+        return {
+            'users': len(self._users),
+            'init_data': len(self._init_data),
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
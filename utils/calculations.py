@@ -3,6 +3,7 @@
 """
 from typing import List, Dict, Tuple
 from datetime import datetime, timedelta
+from utils.consumption import SupplyIndex
 
 
 def calculate_average_consumption(history: List[Dict], supplies: List[Dict] = None) -> Tuple[float, int, str]:
@@ -24,6 +25,7 @@ def calculate_average_consumption(history: List[Dict], supplies: List[Dict] = No
 
     # Сортируем по дате (от старых к новым) для правильного расчета
     history_sorted = sorted(history, key=lambda x: x['date'])
+    supply_index = SupplyIndex(supplies)
 
     # ПЕРВЫЙ ПРОХОД: собираем все расходы для определения аномалий
     daily_consumptions = []  # Список кортежей (daily_consumption, consumption, days_diff, index)
@@ -43,13 +45,11 @@ def calculate_average_consumption(history: List[Dict], supplies: List[Dict] = No
 
         # Находим поставки между этими датами
         supply_weight = 0.0
-        for supply in supplies:
-            supply_date = supply['date']
-            if current_date <= supply_date <= next_date:
-                if supply_date == current_date:
-                    if current_stock >= supply['weight'] * 0.9:
-                        continue
-                supply_weight += supply['weight']
+        for supply in supply_index.between(current_date, next_date, include_start=True):
+            if supply['date'] == current_date:
+                if current_stock >= supply['weight'] * 0.9:
+                    continue
+            supply_weight += supply['weight']
 
         # Расход = текущий остаток + поставки - следующий остаток
         consumption = current_stock + supply_weight - next_stock
@@ -0,0 +1,97 @@
+"""
+Выполнение задач планировщика по компаниям
+
+run_per_company обрабатывает компании параллельно (не больше
+SCHEDULER_CONCURRENCY одновременно), ограничивает время обработки одной
+компании (SCHEDULER_COMPANY_TIMEOUT) и всей задачи (SCHEDULER_JOB_DEADLINE)
+и сохраняет итог последнего запуска каждой задачи: какие компании
+обработаны, какие упали и какие не уложились в срок.
+
+Настройки (переменные окружения):
+    SCHEDULER_CONCURRENCY      - компаний одновременно, по умолчанию 5
+    SCHEDULER_COMPANY_TIMEOUT  - секунд на одну компанию, по умолчанию 120
+    SCHEDULER_JOB_DEADLINE     - секунд на всю задачу, по умолчанию 900
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Итоги последнего запуска по имени задачи (для /api/superadmin/db_stats)
+last_reports: Dict[str, Dict] = {}
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+async def run_per_company(job_name: str, companies: Iterable[Dict],
+                          worker: Callable[[Dict], Awaitable],
+                          concurrency: Optional[int] = None,
+                          company_timeout: Optional[float] = None,
+                          deadline: Optional[float] = None) -> Dict:
+    """
+    Выполнить worker(company) для каждой компании
+
+    Ошибка или таймаут одной компании не останавливает остальные.
+    По истечении deadline незавершенные компании отменяются и попадают
+    в timed_out. Возвращает отчет:
+        {'job', 'started_at', 'duration', 'total',
+         'succeeded': {company_id: результат worker},
+         'failed': {company_id: текст ошибки},
+         'timed_out': [company_id, ...]}
+    """
+    concurrency = concurrency or int(_env_float('SCHEDULER_CONCURRENCY', 5))
+    company_timeout = company_timeout or _env_float('SCHEDULER_COMPANY_TIMEOUT', 120)
+    deadline = deadline or _env_float('SCHEDULER_JOB_DEADLINE', 900)
+
+    companies = list(companies)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    report = {
+        'job': job_name,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'duration': 0.0,
+        'total': len(companies),
+        'succeeded': {},
+        'failed': {},
+        'timed_out': [],
+    }
+    started = time.monotonic()
+
+    async def run_one(company: Dict):
+        company_id = company['id']
+        async with semaphore:
+            try:
+                result = await asyncio.wait_for(worker(company), timeout=company_timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"⏱ {job_name}: компания {company_id} не уложилась в {company_timeout:.0f} с")
+                report['timed_out'].append(company_id)
+            except Exception as e:
+                logger.error(f"❌ {job_name}: ошибка для компании {company_id}: {e}", exc_info=True)
+                report['failed'][company_id] = str(e)
+            else:
+                report['succeeded'][company_id] = result
+
+    tasks = {asyncio.create_task(run_one(company)): company['id'] for company in companies}
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=deadline)
+        for task in pending:
+            task.cancel()
+            report['timed_out'].append(tasks[task])
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.error(f"⏱ {job_name}: срок задачи {deadline:.0f} с истек, "
+                         f"не обработано компаний: {len(pending)}")
+
+    report['duration'] = round(time.monotonic() - started, 3)
+    last_reports[job_name] = report
+    logger.info(
+        f"📋 {job_name}: успешно {len(report['succeeded'])}/{report['total']}, "
+        f"ошибок {len(report['failed'])}, таймаутов {len(report['timed_out'])} "
+        f"за {report['duration']:.1f} с"
+    )
+    return report
@@ -0,0 +1,269 @@
+"""
+Движок расчета расхода: проход по интервалам между ревизиями
+"""
+import functools
+import logging
+import os
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+from datetime import date
+from collections import defaultdict
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy as np
+except ImportError:  # numpy - необязательная зависимость
+    np = None
+
+logger = logging.getLogger(__name__)
+
+
+# Окна ретроспективы (в днях) для "умного" среднего расхода на дашборде
+DEFAULT_CONSUMPTION_WINDOWS = (30, 60, 90)
+
+# Бэкенд расчета по всей компании: auto (numpy, если установлен), numpy или python
+CONSUMPTION_BACKEND = os.getenv('CONSUMPTION_BACKEND', 'auto').lower()
+
+
+class ConsumptionGap(NamedTuple):
+    """Интервал между двумя соседними ревизиями одного товара"""
+    start_date: date
+    end_date: date
+    days: int
+    consumed_quantity: float
+    consumed_weight: float
+    valid_days: int      # Дни, которые идут в знаменатель (0 если интервал отброшен)
+    is_anomaly: bool     # Отрицательный расход (забыли внести поставку, пересорт и т.п.)
+
+
+class SupplyIndex:
+    """
+    Поставки товара, отсортированные по дате, для поиска поставок внутри интервала
+
+    Интервалы ищутся бинарным поиском, поэтому проход по истории линейный
+    (с точностью до логарифма), а не O(интервалы × поставки). Поставки внутри
+    интервала возвращаются в исходном порядке списка, чтобы суммы совпадали
+    с прямым перебором до последнего бита.
+    """
+
+    def __init__(self, supplies: Sequence[Dict]):
+        self.supplies = supplies
+        # sorted() стабилен: при равных датах сохраняется исходный порядок
+        self.order = sorted(range(len(supplies)), key=lambda i: supplies[i]['date'])
+        self.dates = [supplies[i]['date'] for i in self.order]
+        # Обычно поставки уже приходят отсортированными по дате (ORDER BY date)
+        self.presorted = all(i == pos for pos, i in enumerate(self.order))
+
+    def between(self, start, end, include_start: bool = False) -> List[Dict]:
+        """Поставки с датой в (start, end] или в [start, end] при include_start"""
+        lo = bisect_left(self.dates, start) if include_start else bisect_right(self.dates, start)
+        hi = bisect_right(self.dates, end)
+        if lo >= hi:
+            return []
+        if self.presorted:
+            return self.supplies[lo:hi]
+        return [self.supplies[i] for i in sorted(self.order[lo:hi])]
+
+
+def parse_windows(value: Optional[str]) -> Tuple[int, ...]:
+    """Разобрать окна из строки вида "30,60,90" (например, из переменной окружения)"""
+    if not value:
+        return DEFAULT_CONSUMPTION_WINDOWS
+    windows = tuple(int(part) for part in value.split(',') if part.strip())
+    return windows or DEFAULT_CONSUMPTION_WINDOWS
+
+
+def consumption_gaps(history: List[Dict], supplies: List[Dict]) -> List[ConsumptionGap]:
+    """
+    Разбить историю остатков товара на интервалы и посчитать расход в каждом
+
+    Args:
+        history: остатки товара, отсортированные по дате (от старых к новым)
+        supplies: поставки этого товара за тот же период
+
+    Returns:
+        список интервалов в хронологическом порядке (включая отброшенные, с valid_days = 0)
+    """
+    gaps = []
+    supply_index = SupplyIndex(supplies)
+    for i in range(len(history) - 1):
+        cur_rec = history[i]
+        nxt_rec = history[i + 1]
+
+        days_between = (nxt_rec['date'] - cur_rec['date']).days
+
+        # Find all supplies that arrived exactly within this gap
+        gap_supplies = supply_index.between(cur_rec['date'], nxt_rec['date'])
+        gap_supplies_qty = sum(s['boxes'] for s in gap_supplies)
+        gap_supplies_wgt = sum(s['weight'] for s in gap_supplies)
+
+        consumed_qty = cur_rec['quantity'] + gap_supplies_qty - nxt_rec['quantity']
+        consumed_wgt = cur_rec['weight'] + gap_supplies_wgt - nxt_rec['weight']
+
+        valid_days = days_between
+        is_anomaly = False
+        if days_between <= 0:
+            valid_days = 0
+        elif cur_rec['quantity'] <= 0 and nxt_rec['quantity'] <= 0:
+            # If BOTH the start and end of this specific gap is 0, we assume the product was
+            # completely out of stock during this time. We discard these days from the average.
+            valid_days = 0
+        elif consumed_qty < 0:
+            # Anomaly Filtering: staff manually added stock without a supply.
+            # We skip this interval completely to prevent dragging the average down.
+            valid_days = 0
+            is_anomaly = True
+
+        gaps.append(ConsumptionGap(cur_rec['date'], nxt_rec['date'], days_between,
+                                   consumed_qty, consumed_wgt, valid_days, is_anomaly))
+    return gaps
+
+
+def period_totals(gaps: Sequence[ConsumptionGap]) -> Tuple[float, float, int]:
+    """Сумма по всем валидным интервалам: (упаковки, вес, валидные дни)"""
+    total_qty = 0.0
+    total_wgt = 0.0
+    total_days = 0
+    for gap in gaps:
+        if gap.valid_days > 0:
+            total_qty += gap.consumed_quantity
+            total_wgt += gap.consumed_weight
+            total_days += gap.valid_days
+    return total_qty, total_wgt, total_days
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_backend(backend: str) -> bool:
+    """numpy, если он запрошен (или auto) и установлен; решение и предупреждение - один раз на значение"""
+    backend = backend.lower()
+    if backend in ('auto', 'numpy') and np is not None:
+        return True
+    if backend == 'numpy':
+        logger.warning("⚠️ CONSUMPTION_BACKEND=numpy, но numpy не установлен - используем Python")
+    return False
+
+
+def _use_numpy(backend: Optional[str]) -> bool:
+    """Выбрать бэкенд: явный backend или CONSUMPTION_BACKEND (решен при импорте)"""
+    return _resolve_backend(backend or CONSUMPTION_BACKEND)
+
+
+# Бэкенд по умолчанию выбирается при импорте, а не на каждый пересчет
+_resolve_backend(CONSUMPTION_BACKEND)
+
+
+def _group_by_product(stock_rows: Sequence, supply_rows: Sequence):
+    history_by_product = defaultdict(list)
+    for r in stock_rows:
+        history_by_product[r['product_id']].append(r)
+
+    supplies_by_product = defaultdict(list)
+    for r in supply_rows:
+        supplies_by_product[r['product_id']].append(r)
+
+    return history_by_product, supplies_by_product
+
+
+def company_gaps(stock_rows: Sequence, supply_rows: Sequence,
+                 backend: Optional[str] = None) -> List[Tuple[int, ConsumptionGap]]:
+    """
+    Все интервалы всех товаров компании: [(product_id, интервал), ...]
+
+    Используется для заполнения таблицы consumption_gaps.
+    """
+    if _use_numpy(backend):
+        return company_gaps_numpy(stock_rows, supply_rows)
+    return company_gaps_python(stock_rows, supply_rows)
+
+
+def company_gaps_python(stock_rows: Sequence, supply_rows: Sequence) -> List[Tuple[int, ConsumptionGap]]:
+    """Эталонная реализация company_gaps на чистом Python"""
+    history_by_product, supplies_by_product = _group_by_product(stock_rows, supply_rows)
+    return [
+        (pid, gap)
+        for pid, history in history_by_product.items()
+        for gap in consumption_gaps(history, supplies_by_product[pid])
+    ]
+
+
+# Ключ строки: product_id * 2^22 + порядковый номер даты (date.toordinal() < 2^20)
+_DATE_BITS = 22
+
+
+def _numpy_gap_columns(stock_rows: Sequence, supply_rows: Sequence) -> Dict[str, object]:
+    """
+    Векторизованный проход по интервалам: те же правила, что и в consumption_gaps
+
+    Остатки раскладываются в колонки (product_id, дата, упаковки, вес), интервал -
+    пара соседних строк одного товара. Поставка попадает в интервал через
+    searchsorted по ключу (товар, дата). Суммы считаются через bincount, который
+    складывает значения последовательно в исходном порядке, поэтому результат
+    совпадает с Python-версией до последнего бита.
+    """
+    n = len(stock_rows)
+    pid = np.fromiter((r['product_id'] for r in stock_rows), dtype=np.int64, count=n)
+    day = np.fromiter((r['date'].toordinal() for r in stock_rows), dtype=np.int64, count=n)
+    qty = np.fromiter((r['quantity'] for r in stock_rows), dtype=np.float64, count=n)
+    wgt = np.fromiter((r['weight'] for r in stock_rows), dtype=np.float64, count=n)
+
+    # Строки должны идти по товару и дате (ORDER BY product_id, date) - подстрахуемся
+    keys = (pid << _DATE_BITS) + day
+    if n > 1 and np.any(keys[1:] < keys[:-1]):
+        order = np.argsort(keys, kind='stable')
+        pid, day, qty, wgt, keys = pid[order], day[order], qty[order], wgt[order], keys[order]
+
+    # Поставки: интервал (start, end] одного товара, где start.date < s.date <= end.date
+    m = len(supply_rows)
+    gap_boxes = np.zeros(n, dtype=np.float64)
+    gap_supply_wgt = np.zeros(n, dtype=np.float64)
+    if m:
+        s_pid = np.fromiter((r['product_id'] for r in supply_rows), dtype=np.int64, count=m)
+        s_day = np.fromiter((r['date'].toordinal() for r in supply_rows), dtype=np.int64, count=m)
+        s_boxes = np.fromiter((r['boxes'] for r in supply_rows), dtype=np.float64, count=m)
+        s_wgt = np.fromiter((r['weight'] for r in supply_rows), dtype=np.float64, count=m)
+
+        end = np.searchsorted(keys, (s_pid << _DATE_BITS) + s_day, side='left')
+        start = end - 1
+        inside = (end < n) & (start >= 0)
+        end_c = np.minimum(end, n - 1)
+        start_c = np.maximum(start, 0)
+        inside &= (pid[end_c] == s_pid) & (pid[start_c] == s_pid)
+
+        gap_boxes = np.bincount(start[inside], weights=s_boxes[inside], minlength=n)
+        gap_supply_wgt = np.bincount(start[inside], weights=s_wgt[inside], minlength=n)
+
+    # Интервалы: строка i -> строка i + 1 того же товара
+    cur, nxt = slice(0, n - 1), slice(1, n)
+    same_product = pid[cur] == pid[nxt]
+    days_between = day[nxt] - day[cur]
+    consumed_qty = qty[cur] + gap_boxes[:n - 1] - qty[nxt]
+    consumed_wgt = wgt[cur] + gap_supply_wgt[:n - 1] - wgt[nxt]
+
+    counted = (days_between > 0) & ~((qty[cur] <= 0) & (qty[nxt] <= 0))   # товар закончился на весь интервал
+    anomaly = counted & (consumed_qty < 0)                                 # остаток вырос без поставки
+    valid = same_product & counted & ~anomaly
+
+    return {
+        'pid': pid, 'day': day, 'same_product': same_product, 'days_between': days_between,
+        'consumed_qty': consumed_qty, 'consumed_wgt': consumed_wgt,
+        'valid': valid, 'anomaly': anomaly,
+    }
+
+
+def company_gaps_numpy(stock_rows: Sequence, supply_rows: Sequence) -> List[Tuple[int, ConsumptionGap]]:
+    """Векторизованная версия company_gaps (см. _numpy_gap_columns)"""
+    if not stock_rows:
+        return []
+
+    cols = _numpy_gap_columns(stock_rows, supply_rows)
+    idx = np.flatnonzero(cols['same_product'])
+    pids = cols['pid'][idx].tolist()
+    starts = cols['day'][idx].tolist()
+    ends = cols['day'][idx + 1].tolist()
+    days = cols['days_between'][idx].tolist()
+    valid_days = np.where(cols['valid'], cols['days_between'], 0)[idx].tolist()
+    gaps = zip(pids, starts, ends, days, cols['consumed_qty'][idx].tolist(),
+               cols['consumed_wgt'][idx].tolist(), valid_days, cols['anomaly'][idx].tolist())
+    return [
+        (p, ConsumptionGap(date.fromordinal(s), date.fromordinal(e), d, q, w, v, a))
+        for p, s, e, d, q, w, v, a in gaps
+    ]
@@ -0,0 +1,233 @@
+"""
+Хранилище состояний FSM aiogram в PostgreSQL
+
+PostgresStorage держит состояния в таблице fsm_states (миграция 0006), поэтому
+начатые диалоги переживают перезапуск и доступны всем процессам бота за
+webhook'ом. Перед таблицей стоит локальный LRU-кэш:
+
+- чтения (aiogram читает состояние несколько раз за обновление) обслуживаются
+  из кэша; прочитанная из БД запись живет в кэше FSM_CACHE_TTL секунд, поэтому
+  реплика не отдает чужое устаревшее состояние дольше этого времени;
+- записи помечают ключ грязным и сбрасываются в БД пачкой одной транзакцией:
+  в конце обработки каждого обновления (мидлвар из create_dispatcher в main.py,
+  до ответа Telegram) и по таймеру FSM_FLUSH_INTERVAL для записей вне обновлений;
+- после записи ключи объявляются через NOTIFY fsm_changed, и другие процессы
+  выбрасывают их из своего кэша раньше FSM_CACHE_TTL. Без NOTIFY
+  (DB_NOTIFY_CHANGES=0) прочитанные записи не кэшируются вовсе.
+
+Состояния, не менявшиеся дольше FSM_STATE_TTL часов, считаются брошенными:
+они не читаются и периодически удаляются.
+
+Настройки (переменные окружения):
+    FSM_CACHE_SIZE      - ключей в локальном кэше, по умолчанию 10000
+    FSM_CACHE_TTL       - секунд жизни прочитанной записи в кэше, по умолчанию 1 (0 - не кэшировать)
+    FSM_STATE_TTL       - часов жизни неизменяемого состояния, по умолчанию 48
+    FSM_FLUSH_INTERVAL  - задержка фоновой записи, по умолчанию 0.5 с
+"""
+import asyncio
+import logging
+import os
+import pickle
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+FSM_CHANNEL = 'fsm_changed'
+
+
+def storage_key(key: StorageKey) -> str:
+    """Строковый ключ строки fsm_states"""
+    return ':'.join(str(part) for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+    ))
+
+
+class PostgresStorage(BaseStorage):
+    """FSM-хранилище: PostgreSQL с локальным LRU-кэшем и пакетной записью"""
+
+    PURGE_EVERY = 3600  # секунд между удалениями устаревших состояний
+
+    def __init__(self, db, cache_size: int = 10000, cache_ttl: float = 1.0, ttl_hours: float = 48,
+                 flush_interval: float = 0.5):
+        self.db = db
+        self.cache_size = cache_size
+        if cache_ttl > 0 and not getattr(db, 'notify_changes', False):
+            # Другие процессы не узнают об изменениях - кэшировать чистые записи нельзя
+            logger.warning("⚠️ DB_NOTIFY_CHANGES=0: состояния FSM читаются из БД без кэша")
+            cache_ttl = 0
+        self.cache_ttl = cache_ttl
+        self.ttl = int(ttl_hours * 3600)
+        self.flush_interval = flush_interval
+        # key -> [state, pickle(data) или None, запись в кэше действительна до (monotonic)]
+        self._cache: "OrderedDict[str, list]" = OrderedDict()
+        self._dirty: set = set()
+        self._origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._flush_lock = asyncio.Lock()
+        self._flush_timer: Optional[asyncio.Task] = None
+        self._last_purge = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+    @classmethod
+    def from_env(cls, db) -> "PostgresStorage":
+        return cls(
+            db,
+            cache_size=int(os.getenv('FSM_CACHE_SIZE', 10000)),
+            cache_ttl=float(os.getenv('FSM_CACHE_TTL', 1)),
+            ttl_hours=float(os.getenv('FSM_STATE_TTL', 48)),
+            flush_interval=float(os.getenv('FSM_FLUSH_INTERVAL', 0.5)),
+        )
+
+    async def start(self):
+        """Подписаться на изменения ключей из других процессов"""
+        await self.db.add_channel_listener(FSM_CHANNEL, self._on_remote_change)
+
+    # --- BaseStorage ---
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._entry(storage_key(key))
+        entry[0] = state.state if isinstance(state, State) else state
+        self._mark_dirty(storage_key(key), entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(storage_key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        entry = await self._entry(storage_key(key))
+        entry[1] = pickle.dumps(dict(data), protocol=pickle.HIGHEST_PROTOCOL) if data else None
+        self._mark_dirty(storage_key(key), entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        # Каждый вызов получает свою копию, как при чтении из внешнего хранилища
+        data = (await self._entry(storage_key(key)))[1]
+        return pickle.loads(data) if data else {}
+
+    async def close(self) -> None:
+        """Дописать грязные ключи при остановке"""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        await self.flush()
+
+    # --- кэш и запись ---
+
+    async def _entry(self, key: str) -> list:
+        entry = self._cache.get(key)
+        if entry is not None and (key in self._dirty or entry[2] > time.monotonic()):
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        record = await self.db.get_fsm_record(key, self.ttl)
+        expires = time.monotonic() + self.cache_ttl
+        entry = [record['state'], record['data'], expires] if record else [None, None, expires]
+        # Пока шел запрос, ключ мог быть записан в этом процессе - локальная версия новее
+        if key in self._dirty:
+            return self._cache[key]
+        if self.cache_ttl > 0:
+            self._cache[key] = entry
+            self._trim()
+        return entry
+
+    def _mark_dirty(self, key: str, entry: list):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        self._dirty.add(key)
+        if self._flush_timer is None:
+            self._flush_timer = asyncio.create_task(self._flush_later())
+
+    def _trim(self):
+        """Выбросить самые старые чистые ключи сверх cache_size"""
+        if len(self._cache) <= self.cache_size:
+            return
+        for key in list(self._cache):
+            if len(self._cache) <= self.cache_size:
+                break
+            if key not in self._dirty:
+                del self._cache[key]
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.flush_interval)
+            self._flush_timer = None
+            await self.flush()
+        except asyncio.CancelledError:
+            pass
+
+    async def flush(self):
+        """Записать грязные ключи одной транзакцией; ошибки не пробрасываются (повтор позже)"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            keys = list(self._dirty)
+            self._dirty.clear()
+            records = [(key, self._cache[key][0], self._cache[key][1]) for key in keys]
+            try:
+                await self.db.save_fsm_records(records, FSM_CHANNEL, self._origin)
+                self.flushes += 1
+                # Записанные ключи становятся чистыми и живут в кэше как прочитанные
+                expires = time.monotonic() + self.cache_ttl
+                for key in keys:
+                    entry = self._cache.get(key)
+                    if entry is not None and key not in self._dirty:
+                        entry[2] = expires
+            except asyncio.CancelledError:
+                self._dirty.update(keys)
+                raise
+            except Exception as e:
+                logger.error(f"❌ Не удалось сохранить состояния FSM ({len(keys)}): {e}")
+                self._dirty.update(keys)
+                if self._flush_timer is None:
+                    self._flush_timer = asyncio.create_task(self._flush_later())
+                return
+            self._trim()
+            if self.cache_ttl <= 0:
+                for key in keys:
+                    if key not in self._dirty:
+                        self._cache.pop(key, None)
+
+            if time.monotonic() - self._last_purge > self.PURGE_EVERY:
+                self._last_purge = time.monotonic()
+                try:
+                    purged = await self.db.purge_fsm_records(self.ttl)
+                    if purged:
+                        logger.info(f"🧹 Удалено устаревших состояний FSM: {purged}")
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось удалить устаревшие состояния FSM: {e}")
+
+    def _on_remote_change(self, payload: Optional[str]):
+        if payload is None:
+            # Слушатель переподключился: чужие изменения могли быть пропущены
+            for key in [k for k in self._cache if k not in self._dirty]:
+                del self._cache[key]
+            return
+        origin, _, key = payload.partition(':')
+        if origin != self._origin and key not in self._dirty:
+            self._cache.pop(key, None)
+
+    def stats(self) -> Dict:
+        return {
+            'cached': len(self._cache),
+            'dirty': len(self._dirty),
+            'hits': self.hits,
+            'misses': self.misses,
+            'flushes': self.flushes,
+        }
+
+
+async def create_fsm_storage(db) -> BaseStorage:
+    """PostgresStorage для PostgreSQL, MemoryStorage для локальной SQLite"""
+    if not hasattr(db, 'pool'):
+        return MemoryStorage()
+    storage = PostgresStorage.from_env(db)
+    await storage.start()
+    return storage
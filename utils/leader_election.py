@@ -0,0 +1,128 @@
+"""
+Выбор лидера среди реплик через advisory lock PostgreSQL
+
+Планировщик запускается в каждом процессе с ролью all/scheduler, но задачи
+выполняет только лидер - процесс, который держит session-level
+pg_advisory_lock на отдельном соединении. Остальные реплики раз в
+LEADER_RETRY_INTERVAL секунд пробуют взять блокировку. Если лидер
+завершается или теряет соединение, PostgreSQL снимает блокировку вместе с
+сессией, и ее забирает следующая реплика. При штатной остановке блокировка
+освобождается сразу (pg_advisory_unlock).
+
+Лидер раз в LEADER_CHECK_INTERVAL секунд проверяет соединение и при ошибке
+сразу слагает полномочия, не дожидаясь, пока блокировку возьмет другой.
+
+Настройки (переменные окружения):
+    LEADER_RETRY_INTERVAL - пауза между попытками стать лидером, по умолчанию 15 с
+    LEADER_CHECK_INTERVAL - период проверки соединения лидера, по умолчанию 10 с
+"""
+import asyncio
+import logging
+import os
+from typing import Callable, Optional
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# Ключ pg_advisory_lock для лидера планировщика (см. MIGRATIONS_LOCK_ID в migrations)
+SCHEDULER_LOCK_ID = 7_301_905_002
+
+
+class AdvisoryLockLeader:
+    """Лидерство процесса, пока он держит advisory lock"""
+
+    def __init__(self, database_url: str, lock_id: int = SCHEDULER_LOCK_ID,
+                 on_elected: Optional[Callable[[], None]] = None,
+                 on_lost: Optional[Callable[[], None]] = None,
+                 retry_interval: float = 15.0, check_interval: float = 10.0):
+        self.database_url = database_url
+        self.lock_id = lock_id
+        self.on_elected = on_elected
+        self.on_lost = on_lost
+        self.retry_interval = retry_interval
+        self.check_interval = check_interval
+        self.is_leader = False
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, database_url: str, on_elected=None, on_lost=None,
+                 lock_id: int = SCHEDULER_LOCK_ID) -> "AdvisoryLockLeader":
+        return cls(
+            database_url, lock_id,
+            on_elected=on_elected,
+            on_lost=on_lost,
+            retry_interval=float(os.getenv('LEADER_RETRY_INTERVAL', 15)),
+            check_interval=float(os.getenv('LEADER_CHECK_INTERVAL', 10)),
+        )
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Сложить полномочия и освободить блокировку"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _set_leader(self, value: bool):
+        if value == self.is_leader:
+            return
+        self.is_leader = value
+        callback = self.on_elected if value else self.on_lost
+        if value:
+            logger.info(f"👑 Процесс {os.getpid()} стал лидером (lock {self.lock_id})")
+        else:
+            logger.warning(f"🔻 Процесс {os.getpid()} больше не лидер (lock {self.lock_id})")
+        if callback:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработчика смены лидера: {e}")
+
+    async def _run(self):
+        while True:
+            lost = asyncio.Event()
+            try:
+                conn = await asyncpg.connect(self.database_url, ssl='require')
+                try:
+                    conn.add_termination_listener(lambda c: lost.set())
+                    while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", self.lock_id):
+                        await asyncio.sleep(self.retry_interval)
+                    self._set_leader(True)
+                    await self._hold(conn, lost)
+                finally:
+                    was_leader = self.is_leader
+                    self._set_leader(False)
+                    if not conn.is_closed():
+                        if was_leader:
+                            await self._release(conn)
+                        await conn.close()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Выбор лидера: соединение потеряно: {e}")
+            await asyncio.sleep(self.retry_interval)
+
+    async def _hold(self, conn, lost: asyncio.Event):
+        """Держать блокировку, пока соединение живо"""
+        while True:
+            try:
+                await asyncio.wait_for(lost.wait(), timeout=self.check_interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            await asyncio.wait_for(conn.fetchval("SELECT 1"), timeout=self.check_interval)
+
+    async def _release(self, conn):
+        try:
+            await asyncio.wait_for(
+                conn.execute("SELECT pg_advisory_unlock($1)", self.lock_id), timeout=5
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось освободить lock {self.lock_id}: {e}")
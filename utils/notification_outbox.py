@@ -0,0 +1,175 @@
+"""
+Фоновая доставка уведомлений из таблицы notification_outbox
+
+Уведомления записываются методами DatabasePG в той же транзакции, что и
+изменение данных (см. notification() и параметр notify у методов записи).
+NotificationOutboxWorker забирает их пачками (FOR UPDATE SKIP LOCKED с
+арендой, поэтому несколько процессов не отправят одно сообщение дважды),
+отправляет через общий TelegramDispatcher и отмечает результат каждой строки
+сразу после ее отправки: успешные - sent, временные ошибки - повтор с
+растущей паузой, постоянные ошибки и исчерпанные попытки - dead (в том числе
+строки, на которых воркер падал max_attempts раз, не успев отметить результат). Пока в пачке
+есть неотправленные строки (ожидание лимита Telegram, паузы на 429), их
+аренда продлевается каждые OUTBOX_LEASE / 3 секунд. Продление и отметка
+результата выполняются только с токеном пачки (locked_by), поэтому воркер,
+у которого аренду перехватили, не перезапишет чужой результат.
+
+Настройки (переменные окружения):
+    OUTBOX_BATCH_SIZE     - уведомлений за один проход, по умолчанию 50
+    OUTBOX_POLL_INTERVAL  - пауза между проходами при пустой очереди, по умолчанию 1 с
+    OUTBOX_LEASE          - сколько секунд пачка закреплена за воркером, по умолчанию 120
+    OUTBOX_MAX_ATTEMPTS   - попыток до перевода в dead, по умолчанию 8
+    OUTBOX_RETENTION_DAYS - сколько дней хранить отправленные, по умолчанию 7
+    OUTBOX_DEAD_RETENTION_DAYS - сколько дней хранить недоставленные (dead), по умолчанию 30
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Dict, Iterable, Optional
+
+from aiogram.types import InlineKeyboardMarkup
+
+from utils.telegram_dispatcher import get_dispatcher
+
+logger = logging.getLogger(__name__)
+
+
+def notification(chat_ids: Iterable[int], text: str, kind: str,
+                 reply_markup: Optional[InlineKeyboardMarkup] = None,
+                 parse_mode: Optional[str] = "HTML") -> Dict:
+    """Описание уведомления для записи в outbox: один текст нескольким чатам"""
+    options = {}
+    if parse_mode:
+        options['parse_mode'] = parse_mode
+    if reply_markup is not None:
+        options['reply_markup'] = reply_markup.model_dump(exclude_none=True)
+    return {
+        'chat_ids': list(dict.fromkeys(chat_ids)),
+        'text': text,
+        'kind': kind,
+        'options': options,
+    }
+
+
+def _send_kwargs(options: Dict) -> Dict:
+    """Параметры send_message из сохраненных options"""
+    kwargs = dict(options)
+    if 'reply_markup' in kwargs:
+        kwargs['reply_markup'] = InlineKeyboardMarkup.model_validate(kwargs['reply_markup'])
+    return kwargs
+
+
+class NotificationOutboxWorker:
+    """Фоновая задача, отправляющая notification_outbox"""
+
+    PURGE_EVERY = 3600  # секунд между очистками отправленных
+
+    def __init__(self, db, bot, batch_size: int = 50, poll_interval: float = 1.0,
+                 lease: int = 120, max_attempts: int = 8, retention_days: int = 7,
+                 dead_retention_days: int = 30):
+        self.db = db
+        self.bot = bot
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retention_days = retention_days
+        self.dead_retention_days = dead_retention_days
+        self._task: Optional[asyncio.Task] = None
+        self._last_purge = 0.0
+
+    @classmethod
+    def from_env(cls, db, bot) -> "NotificationOutboxWorker":
+        return cls(
+            db, bot,
+            batch_size=int(os.getenv('OUTBOX_BATCH_SIZE', 50)),
+            poll_interval=float(os.getenv('OUTBOX_POLL_INTERVAL', 1)),
+            lease=int(os.getenv('OUTBOX_LEASE', 120)),
+            max_attempts=int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8)),
+            retention_days=int(os.getenv('OUTBOX_RETENTION_DAYS', 7)),
+            dead_retention_days=int(os.getenv('OUTBOX_DEAD_RETENTION_DAYS', 30)),
+        )
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("📤 Воркер outbox уведомлений запущен")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def drain_once(self) -> int:
+        """Отправить одну пачку; возвращает количество обработанных уведомлений"""
+        token = uuid.uuid4().hex
+        rows = await self.db.claim_notifications(self.batch_size, self.lease, token, self.max_attempts)
+        if not rows:
+            return 0
+
+        dispatcher = get_dispatcher(self.bot)
+        in_flight = {row['id'] for row in rows}
+        failed_count = 0
+
+        async def deliver(row):
+            nonlocal failed_count
+            try:
+                kwargs = _send_kwargs(row['options'])
+            except Exception as e:
+                result = {'chat_id': row['chat_id'], 'ok': False, 'error': f"bad options: {e}", 'retryable': False}
+            else:
+                result = await dispatcher.send(row['chat_id'], row['text'], **kwargs)
+
+            # Результат фиксируется сразу, а не после всей пачки: аренда нужна только неотправленным
+            in_flight.discard(row['id'])
+            if not result['ok']:
+                failed_count += 1
+            sent_ids = [row['id']] if result['ok'] else []
+            failed = [] if result['ok'] else [(row['id'], result['error'], result.get('retryable', True))]
+            try:
+                await self.db.complete_notifications(sent_ids, failed, self.max_attempts, token)
+            except Exception as e:
+                # Строка вернется в очередь после окончания аренды
+                logger.error(f"❌ Outbox: не удалось отметить уведомление {row['id']}: {e}")
+
+        heartbeat = asyncio.create_task(self._extend_leases(in_flight, token))
+        try:
+            await asyncio.gather(*(deliver(row) for row in rows))
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+        if failed_count:
+            logger.warning(f"⚠️ Outbox: отправлено {len(rows) - failed_count}/{len(rows)}, ошибок {failed_count}")
+        return len(rows)
+
+    async def _extend_leases(self, in_flight: set, token: str):
+        """Продлевать аренду неотправленных строк пачки, пока она отправляется"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self.db.extend_notification_leases(list(in_flight), self.lease, token)
+            except Exception as e:
+                logger.warning(f"⚠️ Outbox: не удалось продлить аренду: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                processed = await self.drain_once()
+                if time.monotonic() - self._last_purge > self.PURGE_EVERY:
+                    self._last_purge = time.monotonic()
+                    await self.db.purge_sent_notifications(self.retention_days, self.dead_retention_days)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка воркера outbox: {e}")
+                processed = 0
+            # Полная пачка - возможно, в очереди есть еще: продолжаем без паузы
+            if processed < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,220 @@
+"""
+Кэш результатов запросов DatabasePG с версиями данных компаний
+
+Ключ записи - (метод, аргументы, версия данных компании, глобальная эпоха).
+Любая запись в данные компании увеличивает ее версию, поэтому старые записи
+кэша сразу становятся недостижимыми и со временем вытесняются LRU/TTL.
+Записи без привязки к компании (суперадмин, глобальные товары) увеличивают
+глобальную эпоху и сбрасывают кэш всех компаний. Изменения из других
+процессов приходят через LISTEN company_changed (см. DatabasePG).
+
+Настройки (переменные окружения):
+    QUERY_CACHE_TTL          - время жизни записи в секундах (0 - кэш выключен), по умолчанию 30
+    QUERY_CACHE_MAX_ENTRIES  - максимум записей, по умолчанию 2000
+    QUERY_CACHE_MAX_MB       - примерный лимит памяти в МБ, по умолчанию 32
+"""
+import functools
+import inspect
+import os
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+def _freeze(value):
+    """Аргументы метода -> хешируемая часть ключа"""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, set):
+        return tuple(sorted(value))
+    return value
+
+
+def _clone(value):
+    """
+    Копия результата для вызывающего кода
+
+    Хендлеры меняют полученные словари (например, item['date'] = str(...)),
+    поэтому из кэша всегда отдается копия списков и словарей. Скалярные
+    значения (числа, даты, строки) неизменяемы и не копируются.
+    """
+    if isinstance(value, list):
+        return [_clone(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _clone(v) for k, v in value.items()}
+    return value
+
+
+def _estimate_size(value) -> int:
+    """Грубая оценка занимаемой памяти в байтах"""
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(_estimate_size(v) for v in value)
+    elif isinstance(value, dict):
+        size += sum(sys.getsizeof(k) + _estimate_size(v) for k, v in value.items())
+    return size
+
+
+class QueryCache:
+    """LRU-кэш с TTL, лимитом памяти и версиями данных по компаниям"""
+
+    def __init__(self, ttl: float = 30.0, max_entries: int = 2000, max_bytes: int = 32 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, Tuple[Any, float, int]]" = OrderedDict()
+        self._versions: Dict[int, int] = {}
+        self._epoch = 0
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["QueryCache"]:
+        """Кэш по настройкам окружения или None, если QUERY_CACHE_TTL=0"""
+        ttl = float(os.getenv('QUERY_CACHE_TTL', 30))
+        if ttl <= 0:
+            return None
+        return cls(
+            ttl=ttl,
+            max_entries=int(os.getenv('QUERY_CACHE_MAX_ENTRIES', 2000)),
+            max_bytes=int(float(os.getenv('QUERY_CACHE_MAX_MB', 32)) * 1024 * 1024),
+        )
+
+    def version(self, company_id) -> Tuple[int, int]:
+        """Текущая версия данных компании (вместе с глобальной эпохой)"""
+        return self._epoch, self._versions.get(company_id, 0)
+
+    def invalidate(self, company_id=None):
+        """Данные компании изменились (None - изменились данные всех компаний)"""
+        self.invalidations += 1
+        if company_id is None:
+            self._epoch += 1
+        else:
+            self._versions[company_id] = self._versions.get(company_id, 0) + 1
+
+    def get(self, key) -> Tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+
+        value, expires_at, size = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return False, None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, _clone(value)
+
+    def set(self, key, value):
+        size = _estimate_size(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (_clone(value), time.monotonic() + self.ttl, size)
+        self._bytes += size
+
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+def _company_id_getter(method):
+    """Функция (args, kwargs) -> company_id по сигнатуре метода, либо None"""
+    params = list(inspect.signature(method).parameters)[1:]  # без self
+    if 'company_id' not in params:
+        return None
+    index = params.index('company_id')
+
+    def get(args, kwargs):
+        if 'company_id' in kwargs:
+            return kwargs['company_id']
+        return args[index] if index < len(args) else None
+    return get
+
+
+def cached_query(method):
+    """
+    Кэшировать результат метода чтения DatabasePG
+
+    Метод обязан принимать company_id: ключ включает версию данных компании,
+    снятую ДО запроса, поэтому результат, прочитанный параллельно с записью,
+    сохраняется под старой версией и больше не отдается.
+    """
+    get_company_id = _company_id_getter(method)
+    if get_company_id is None:
+        raise TypeError(f"{method.__name__}: cached_query требует параметр company_id")
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        cache = self.query_cache
+        if cache is None:
+            return await method(self, *args, **kwargs)
+
+        company_id = get_company_id(args, kwargs)
+        key = (method.__name__, company_id, cache.version(company_id), _freeze(args), _freeze(kwargs))
+        hit, value = cache.get(key)
+        if hit:
+            return value
+
+        value = await method(self, *args, **kwargs)
+        cache.set(key, value)
+        return value
+    return wrapper
+
+
+def invalidates_cache(entity: str):
+    """
+    Сбросить кэш компании после успешного метода записи DatabasePG
+
+    entity - что изменилось (products, stock, company, users, ...): передается
+    обработчикам изменений этого процесса. Компания берется из параметра
+    company_id; если его нет (или он None), изменение относится ко всем
+    компаниям. Сброс происходит после выхода из метода, то есть после фиксации
+    его транзакции. Другие процессы метод оповещает сам: _notify_change на
+    своем соединении внутри транзакции (NOTIFY company_changed).
+    """
+    def decorator(method):
+        get_company_id = _company_id_getter(method)
+
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            result = await method(self, *args, **kwargs)
+            company_id = get_company_id(args, kwargs) if get_company_id else None
+            self._apply_change(company_id, entity)
+            return result
+        return wrapper
+    return decorator
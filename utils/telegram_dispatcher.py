@@ -0,0 +1,227 @@
+"""
+Рассылка сообщений Telegram с ограничением скорости
+
+Все массовые уведомления (планировщик, объявления, заявки) идут через один
+диспетчер на бота: несколько воркеров берут сообщения из очереди, общий
+token bucket держит темп ниже лимита Telegram (~30 сообщений/с), а в один чат
+уходит не чаще одного сообщения в TG_PER_CHAT_INTERVAL секунд. На 429
+(TelegramRetryAfter) диспетчер ждет указанное Telegram время и повторяет
+отправку, на сетевые ошибки и 5xx - повторяет с нарастающей паузой.
+
+Настройки (переменные окружения):
+    TG_RATE_LIMIT         - сообщений в секунду на бота, по умолчанию 25
+    TG_PER_CHAT_INTERVAL  - секунд между сообщениями в один чат, по умолчанию 1
+    TG_DISPATCH_WORKERS   - параллельных отправок, по умолчанию 8
+    TG_MAX_RETRIES        - повторов одной отправки, по умолчанию 3
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket: не больше rate операций в секунду, всплеск до capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Остановить выдачу токенов (Telegram вернул 429 с retry_after)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class TelegramDispatcher:
+    """Очередь отправки сообщений одного бота"""
+
+    def __init__(self, bot, rate: float = 25.0, per_chat_interval: float = 1.0,
+                 workers: int = 8, max_retries: int = 3):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.workers = workers
+        self.max_retries = max_retries
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._background: set = set()
+        self._next_chat_slot: Dict[int, float] = {}
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    @classmethod
+    def from_env(cls, bot) -> "TelegramDispatcher":
+        return cls(
+            bot,
+            rate=float(os.getenv('TG_RATE_LIMIT', 25)),
+            per_chat_interval=float(os.getenv('TG_PER_CHAT_INTERVAL', 1)),
+            workers=int(os.getenv('TG_DISPATCH_WORKERS', 8)),
+            max_retries=int(os.getenv('TG_MAX_RETRIES', 3)),
+        )
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> Dict:
+        """
+        Отправить одно сообщение через очередь и дождаться результата
+
+        Возвращает {'chat_id', 'ok', 'attempts', 'error', 'retryable'};
+        исключения наружу не пробрасываются. retryable - ошибка временная
+        (429, сеть, 5xx) и отправку имеет смысл повторить позже.
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((chat_id, text, kwargs, future))
+        return await future
+
+    async def send_many(self, chat_ids: Iterable[int], text: str, **kwargs) -> Dict:
+        """
+        Разослать одно сообщение многим чатам (дубликаты отбрасываются)
+
+        Возвращает {'total', 'sent', 'failed': {chat_id: ошибка}, 'results'}.
+        """
+        unique_ids = list(dict.fromkeys(chat_ids))
+        results = await asyncio.gather(*(self.send(chat_id, text, **kwargs) for chat_id in unique_ids))
+        return {
+            'total': len(results),
+            'sent': sum(1 for r in results if r['ok']),
+            'failed': {r['chat_id']: r['error'] for r in results if not r['ok']},
+            'results': results,
+        }
+
+    def submit_many(self, chat_ids: Iterable[int], text: str, **kwargs) -> asyncio.Task:
+        """send_many в фоне: веб-запрос не ждет окончания рассылки"""
+        task = asyncio.create_task(self._logged_send_many(list(chat_ids), text, kwargs))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    async def _logged_send_many(self, chat_ids: List[int], text: str, kwargs: Dict) -> Dict:
+        report = await self.send_many(chat_ids, text, **kwargs)
+        if report['failed']:
+            logger.warning(f"⚠️ Рассылка: доставлено {report['sent']}/{report['total']}, "
+                           f"ошибки: {report['failed']}")
+        return report
+
+    async def _wait_chat_slot(self, chat_id: int):
+        """Не чаще одного сообщения в чат за per_chat_interval (слот резервируется без await)"""
+        now = time.monotonic()
+        slot = max(now, self._next_chat_slot.get(chat_id, 0.0))
+        self._next_chat_slot[chat_id] = slot + self.per_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        if len(self._next_chat_slot) > 10000:
+            self._next_chat_slot = {c: t for c, t in self._next_chat_slot.items() if t > now}
+
+    async def _deliver(self, chat_id: int, text: str, kwargs: Dict) -> Dict:
+        attempts = 0
+        while True:
+            attempts += 1
+            await self._wait_chat_slot(chat_id)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                self.sent += 1
+                return {'chat_id': chat_id, 'ok': True, 'attempts': attempts, 'error': None, 'retryable': False}
+            except TelegramRetryAfter as e:
+                error, delay = e, float(e.retry_after)
+                # 429 относится ко всему боту - приостанавливаем всех воркеров
+                self.bucket.pause(delay)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                error, delay = e, min(2 ** attempts, 30)
+            except Exception as e:
+                # Заблокировал бота, чат не найден и т.п. - повтор не поможет
+                error, delay = e, None
+
+            if delay is None or attempts > self.max_retries:
+                self.failed += 1
+                logger.error(f"❌ Не удалось отправить сообщение в чат {chat_id}: {error}")
+                return {'chat_id': chat_id, 'ok': False, 'attempts': attempts, 'error': str(error),
+                        'retryable': delay is not None}
+            self.retried += 1
+            logger.warning(f"🔁 Повтор отправки в чат {chat_id} через {delay:.1f} с: {error}")
+            await asyncio.sleep(delay)
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs, future = await self._queue.get()
+            try:
+                result = await self._deliver(chat_id, text, kwargs)
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            finally:
+                self._queue.task_done()
+
+    async def close(self, timeout: float = 10.0):
+        """Дождаться отправки очереди (не дольше timeout) и остановить воркеров"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Не отправлено сообщений: {self._queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def stats(self) -> Dict:
+        return {
+            'queued': self._queue.qsize() if self._queue else 0,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'rate': self.bucket.rate,
+            'workers': self.workers,
+        }
+
+
+_dispatchers: Dict[int, TelegramDispatcher] = {}
+
+
+def get_dispatcher(bot) -> TelegramDispatcher:
+    """Общий диспетчер бота в процессе (планировщик и веб делят один лимит)"""
+    dispatcher = _dispatchers.get(id(bot))
+    if dispatcher is None or dispatcher.bot is not bot:
+        dispatcher = TelegramDispatcher.from_env(bot)
+        _dispatchers[id(bot)] = dispatcher
+    return dispatcher
+
+
+async def close_dispatchers():
+    """Дослать очереди всех диспетчеров при остановке процесса"""
+    for dispatcher in list(_dispatchers.values()):
+        await dispatcher.close()
+    _dispatchers.clear()
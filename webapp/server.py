@@ -25,6 +25,10 @@ from database import Database
 from database_pg import DatabasePG
 from dotenv import load_dotenv
 from utils.working_day import get_working_date
+from utils.auth_cache import AuthContextCache
+from utils import company_jobs
+from utils.telegram_dispatcher import close_dispatchers, get_dispatcher
+from utils.notification_outbox import notification
 
 load_dotenv()
 
@@ -35,8 +39,14 @@ db = None
 # Глобальный экземпляр бота для уведомлений
 bot_instance = None
 
-# Временное хранилище черновиков заказов
+# Черновики заказов: в PostgreSQL таблица draft_orders (общая для всех процессов),
+# в локальной SQLite - память процесса
 draft_orders = {}
+DRAFT_ORDER_TTL = int(float(os.getenv('DRAFT_ORDER_TTL', 24)) * 3600)  # часы -> секунды
+
+# Кэш контекста авторизации (роль, компания, подписка) и проверенных initData
+auth_cache = AuthContextCache.from_env()
+
 
 
 def set_bot_instance(bot):
@@ -45,6 +55,19 @@ def set_bot_instance(bot):
     bot_instance = bot
 
 
+def set_database(database):
+    """Установить общий экземпляр БД (пул создается один раз на процесс в main.py)"""
+    global db
+    db = database
+    _subscribe_auth_cache()
+
+
+def _subscribe_auth_cache():
+    """Сбрасывать кэш авторизации при смене ролей и подписок (в том числе из других процессов)"""
+    if hasattr(db, 'add_change_handler'):
+        db.add_change_handler(auth_cache.on_change)
+
+
 def json_serializer(obj):
     import datetime
     if isinstance(obj, (datetime.date, datetime.datetime, datetime.time)):
@@ -94,29 +117,90 @@ async def init_db(app):
         
     if hasattr(db, 'init_db'):
         await db.init_db()
+    _subscribe_auth_cache()
+    if hasattr(db, 'start_change_listener'):
+        await db.start_change_listener()
     print("✅ База данных инициализирована")
 
 
 async def close_db(app):
     """Закрытие БД при остановке"""
     global db
+    await close_dispatchers()
     if db and hasattr(db, 'close'):
         await db.close()
 
 
+async def notify_telegram(company_id, chat_ids, text: str, kind: str) -> int:
+    """
+    Отправить уведомление из веб-процесса; возвращает число адресатов
+
+    В PostgreSQL сообщение ставится в notification_outbox, и его отправляет
+    воркер лидера планировщика: web-процессов может быть много, а общий лимит
+    Telegram один. В SQLite (один процесс) - сразу через диспетчер в фоне.
+    """
+    chat_ids = list(dict.fromkeys(chat_ids))
+    if not chat_ids:
+        return 0
+    if hasattr(db, 'pool'):
+        try:
+            await db.enqueue_notifications(company_id, [notification(chat_ids, text, kind)])
+            return len(chat_ids)
+        except Exception as e:
+            print(f"⚠️ Не удалось поставить уведомление в outbox, отправляем напрямую: {e}")
+    bot = get_bot_instance()
+    if not bot:
+        return 0
+    get_dispatcher(bot).submit_many(chat_ids, text, parse_mode="HTML")
+    return len(chat_ids)
+
+
+async def get_auth_context(user_id: int):
+    """Роль, компания, активность и подписка пользователя (кэш процесса с коротким TTL)"""
+    found, context = auth_cache.get_user(user_id)
+    if found:
+        return context
+
+    if hasattr(db, 'get_auth_context'):
+        context = await db.get_auth_context(user_id)
+    else:
+        user_info = await db.get_user_info(user_id)
+        context = user_info or None
+    auth_cache.set_user(user_id, context)
+    return context
+
+
+def verify_init_data_cached(init_data: str, bot_token: str):
+    """verify_telegram_webapp с кэшем: одна и та же initData приходит с каждым запросом Mini App"""
+    found, tg_user = auth_cache.get_init_data(init_data)
+    if not found:
+        tg_user = verify_telegram_webapp(init_data, bot_token)
+        auth_cache.set_init_data(init_data, tg_user)
+    return tg_user
+
+
 async def get_current_user(request):
     """Вспомогательная функция для получения текущего пользователя из сессии или Telegram WebApp"""
-    
+    # В пределах одного запроса пользователь определяется один раз
+    # (get_current_company, auth_middleware и хендлер вызывают эту функцию повторно)
+    if 'current_user' in request:
+        return request['current_user']
+    user = await _resolve_current_user(request)
+    request['current_user'] = user
+    return user
+
+
+async def _resolve_current_user(request):
     # 1. Сначала проверяем заголовок x-telegram-init-data (для Mini App)
     init_data = request.headers.get('x-telegram-init-data')
     if init_data:
         bot_token = os.getenv('BOT_TOKEN')
         if bot_token:
-            tg_user = verify_telegram_webapp(init_data, bot_token)
+            tg_user = verify_init_data_cached(init_data, bot_token)
             if tg_user:
                 # Если токен валиден, возвращаем пользователя (эмуляция сессии)
                 user_id = tg_user.get('id')
-                user_info = await db.get_user_info(user_id)
+                user_info = await get_auth_context(user_id)
                 role = user_info.get('role') if user_info else 'user'
                 company_id = user_info.get('company_id') if user_info else None
                 
@@ -132,12 +216,14 @@ async def get_current_user(request):
                     'photo_url': tg_user.get('photo_url'),
                     'role': role,
                     'company_id': company_id,
-                    'is_active': user_info.get('is_active', True) if user_info else True
+                    'is_active': user_info.get('is_active', True) if user_info else True,
+                    'subscription_status': user_info.get('subscription_status') if user_info else None
                 }
                 
                 # Сохраняем пользователя в сессию, чтобы при навигации по страницам (напр. /staff) он не разлогинивался
                 session = await aiohttp_session.get_session(request)
-                session['user'] = user_dict
+                if session.get('user') != user_dict:
+                    session['user'] = user_dict
                 return user_dict
 
     # 2. Иначе проверяем Cookie сессию (для обычного браузера)
@@ -145,7 +231,7 @@ async def get_current_user(request):
     if 'user' in session:
         user_data = session['user']
         # Всегда перепроверяем статус активности в БД для безопасности
-        user_info = await db.get_user_info(user_data['id'])
+        user_info = await get_auth_context(user_data['id'])
         # Мы больше не инвалидируем сессию, статусы активности проверятся в auth_middleware
         
 
@@ -153,6 +239,7 @@ async def get_current_user(request):
         if user_info:
             user_data['role'] = user_info.get('role', user_data.get('role', 'user'))
             user_data['company_id'] = user_info.get('company_id', user_data.get('company_id'))
+            user_data['subscription_status'] = user_info.get('subscription_status')
             session['user'] = user_data
             
         return user_data
@@ -167,17 +254,21 @@ async def get_current_company(request):
     return 1
 
 
+# Пути без авторизации (main.py добавляет сюда путь webhook'а Telegram)
+PUBLIC_PATHS = [
+    '/api/auth/telegram',
+    '/api/auth/webapp_auto',
+    '/login',
+    '/static',
+    '/favicon.ico',
+    '/about'
+]
+
+
 @web.middleware
 async def auth_middleware(request, handler):
     """Мидлвар для проверки авторизации"""
-    public_paths = [
-        '/api/auth/telegram',
-        '/api/auth/webapp_auto',
-        '/login',
-        '/static',
-        '/favicon.ico',
-        '/about'
-    ]
+    public_paths = PUBLIC_PATHS
     
     if request.path.startswith('/api/') and 'x-telegram-init-data' in request.headers:
         return await handler(request)
@@ -209,8 +300,8 @@ async def auth_middleware(request, handler):
                 # Check company subscription status (только для активных)
                 company_id = user.get('company_id')
                 if company_id and company_id != 1 and not request.path.startswith('/superadmin'):
-                    async with db.pool.acquire() as conn:
-                        status = await conn.fetchval("SELECT subscription_status FROM companies WHERE id = $1", company_id)
+                    # Статус подписки приходит вместе с контекстом пользователя (без отдельного запроса)
+                    status = user.get('subscription_status')
                     
                     if status == 'expired' and request.path != '/expired':
                         if request.path.startswith('/api/'):
@@ -355,15 +446,20 @@ async def telegram_login(request):
     await db.add_or_update_user(user_id, username, first_name, last_name, company_id=None)
     
     # Делаем пользователя Супер-Админом (admin) с company_id=1, если он первый в базе Staging
-    async with db.pool.acquire() as conn:
+    promoted = False
+    async with db.acquire() as conn:
         admin_check = await conn.fetchval("SELECT count(*) FROM users WHERE role = 'admin'")
         if admin_check == 0:
             await conn.execute("UPDATE users SET role = 'admin', company_id = 1 WHERE id = $1", user_id)
+            promoted = True
         else:
             # На случай если админ уже был создан, но company_id еще не был равен 1 (старый лог)
             user_current_role = await conn.fetchrow("SELECT role, company_id FROM users WHERE id = $1", user_id)
             if user_current_role and user_current_role['role'] == 'admin' and user_current_role['company_id'] is None:
                 await conn.execute("UPDATE users SET company_id = 1 WHERE id = $1", user_id)
+                promoted = True
+    if promoted:
+        await db.invalidate_company(1, 'users')
 
     user_info = await db.get_user_info(user_id)
     
@@ -762,41 +858,16 @@ async def save_supply(request):
         date_str = data.get('date', get_working_date())
         resolve_pending_order_id = data.get('resolve_pending_order_id')
         debts = data.get('debts', [])
-        
-        for item in items:
-            product_id = item.get('product_id')
-            boxes = float(item.get('boxes', 0))
-            weight = float(item.get('weight', 0))
-            cost = float(item.get('cost', 0))
-            
-            if boxes > 0 or weight > 0:
-                await db.add_supply(company_id, product_id, date_str, int(boxes), weight, cost)
-                
-                # Обновляем текущий остаток склада на количество упаковок, а не коробок!
-                async with db.pool.acquire() as conn:
-                    prod = await conn.fetchrow("SELECT units_per_box FROM products WHERE id = $1", product_id)
-                    upb = prod['units_per_box'] if prod else 1
-                packages = boxes * upb
-                
-                await db.increment_stock(company_id, product_id, date_str, float(packages), weight)
-                
-                # Обновляем ценник товара в базе, если мы указали количество и стоимость
-                if boxes > 0 and cost > 0:
-                    new_price = round(cost / boxes, 2)
-                    await db.update_product_price(company_id, product_id, new_price)
-                
-        if resolve_pending_order_id:
-            await db.resolve_order_without_insert(int(resolve_pending_order_id))
 
-        for db_item in debts:
-            product_id = db_item.get('product_id')
-            boxes = float(db_item.get('boxes', 0))
-            weight = float(db_item.get('weight', 0))
-            cost = float(db_item.get('cost', 0))
-            if boxes > 0 or weight > 0:
-                await db.add_supplier_debt(company_id, product_id, boxes, weight, cost)
+        await db.receive_supply(
+            company_id, date_str, items,
+            debts=debts,
+            resolve_order_id=int(resolve_pending_order_id) if resolve_pending_order_id else None
+        )
 
         return safe_json_response({'status': 'ok'})
+    except ValueError as e:
+        return safe_json_response({'error': str(e)}, status=400)
     except Exception as e:
         print(f"Ошибка сохранения поставки: {e}")
         return safe_json_response({'error': str(e)}, status=500)
@@ -833,14 +904,7 @@ async def save_stock(request):
 
 
         if user_role == 'admin':
-            for item in stock_items:
-                await db.add_stock(
-                    company_id=company_id,
-                    product_id=item['product_id'],
-                    date=date_obj,
-                    quantity=item['quantity'],
-                    weight=item['weight']
-                )
+            await db.bulk_upsert_stock(company_id, date_obj, stock_items)
 
             print(f"✅ Админ {user_id} (Co:{company_id}) сохранил {len(stock_items)} позиций")
 
@@ -851,21 +915,20 @@ async def save_stock(request):
                 'requires_moderation': False
             })
         else:
+            notify = await build_submission_notifier(company_id, user_id, working_date_str, stock_items)
             try:
                 submission_id = await db.create_stock_submission(
                     company_id=company_id,
                     user_id=user_id,
                     date=date_obj,
-                    items=stock_items
+                    items=stock_items,
+                    notify=notify
                 )
             except ValueError as e:
                 return safe_json_response({'error': str(e)}, status=400)
 
             print(f"📝 Сотрудник {user_id} создал submission #{submission_id} для Co:{company_id}")
 
-            await notify_admins_about_submission(company_id, submission_id, user_id,
-                                                working_date_str, stock_items)
-
             return safe_json_response({
                 'success': True,
                 'message': 'Остатки отправлены на модерацию',
@@ -1022,12 +1085,13 @@ async def get_today_supplies(request):
         return safe_json_response({'error': str(e)}, status=500)
 
 
-async def notify_admins_about_submission(company_id, submission_id, user_id, date_str, items):
-    """Отправить уведомление админам компании о новой заявке"""
-    bot = get_bot_instance()
-    if not bot:
-        return
+async def build_submission_notifier(company_id, user_id, date_str, items):
+    """
+    Уведомление админов компании о новой заявке
 
+    Возвращает функцию notify(submission_id) для create_stock_submission:
+    уведомление пишется в notification_outbox в одной транзакции с заявкой.
+    """
     try:
         admin_ids = set(await db.get_admin_ids(company_id))
         
@@ -1038,7 +1102,13 @@ async def notify_admins_about_submission(company_id, submission_id, user_id, dat
             
         user_info = await db.get_user_info(user_id)
         username = user_info.get('username') or user_info.get('first_name') or 'Неизвестно'
+    except Exception as e:
+        print(f"❌ Ошибка в build_submission_notifier: {e}")
+        return None
 
+    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+    def notify(submission_id):
         message = f"""
 🔔 <b>НОВАЯ ЗАЯВКА НА ОСТАТКИ</b>
 
@@ -1050,7 +1120,6 @@ async def notify_admins_about_submission(company_id, submission_id, user_id, dat
 Заявка №{submission_id}
 """
 
-        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="👁️ Просмотреть", callback_data=f"review_{submission_id}")],
             [
@@ -1059,19 +1128,9 @@ async def notify_admins_about_submission(company_id, submission_id, user_id, dat
             ],
             [InlineKeyboardButton(text="❌ Отклонить", callback_data=f"reject_{submission_id}")]
         ])
+        return [notification(admin_ids, message, 'stock_submission', reply_markup=keyboard)]
 
-        for admin_id in admin_ids:
-            try:
-                await bot.send_message(
-                    chat_id=admin_id,
-                    text=message,
-                    reply_markup=keyboard,
-                    parse_mode="HTML"
-                )
-            except Exception as e:
-                print(f"❌ Ошибка отправки уведомления админу {admin_id}: {e}")
-    except Exception as e:
-        print(f"❌ Ошибка в notify_admins_about_submission: {e}")
+    return notify
 
 
 async def save_draft_order(request):
@@ -1084,7 +1143,10 @@ async def save_draft_order(request):
         if not draft_key or not order_data:
             return safe_json_response({'error': 'Missing draft_key or order_data'}, status=400)
 
-        draft_orders[draft_key] = order_data
+        if hasattr(db, 'pool'):
+            await db.save_draft_order(draft_key, order_data, DRAFT_ORDER_TTL)
+        else:
+            draft_orders[draft_key] = order_data
         return safe_json_response({'success': True, 'draft_key': draft_key})
     except Exception:
         return safe_json_response({'error': 'Error'}, status=500)
@@ -1093,9 +1155,13 @@ async def get_draft_order(request):
     """API: Получить данные черновика заказа"""
     try:
         draft_key = request.match_info.get('draft_key')
-        if draft_key not in draft_orders:
+        if hasattr(db, 'pool'):
+            order_data = await db.get_draft_order(draft_key)
+        else:
+            order_data = draft_orders.get(draft_key)
+        if order_data is None:
             return safe_json_response({'error': 'Draft not found'}, status=404)
-        return safe_json_response(draft_orders[draft_key])
+        return safe_json_response(order_data)
     except Exception:
         return safe_json_response({'error': 'Error'}, status=500)
 
@@ -1211,16 +1277,11 @@ async def api_approve_submission(request):
         await db.approve_submission(submission_id, user['id'])
         
         # Опционально: отправить уведомление в Telegram сотруднику
-        bot = get_bot_instance()
-        if bot:
-             try:
-                 await bot.send_message(
-                     chat_id=sub['submitted_by'],
-                     text=f"✅ <b>ЗАЯВКА УТВЕРЖДЕНА</b>\n\nВаша заявка #{submission_id} от {sub['submission_date']} была утверждена.\n\nДанные успешно сохранены в базе.",
-                     parse_mode="HTML"
-                 )
-             except Exception as notify_err:
-                 print(f"Failed to notify user about approval: {notify_err}")
+        await notify_telegram(
+            company_id, [sub['submitted_by']],
+            f"✅ <b>ЗАЯВКА УТВЕРЖДЕНА</b>\n\nВаша заявка #{submission_id} от {sub['submission_date']} была утверждена.\n\nДанные успешно сохранены в базе.",
+            'submission_approved'
+        )
 
         return safe_json_response({'success': True, 'message': 'Заявка успешно утверждена'})
     except Exception as e:
@@ -1249,16 +1310,11 @@ async def api_reject_submission(request):
         await db.reject_submission(submission_id, user['id'], reason)
         
         # Отправить уведомление в Telegram сотруднику
-        bot = get_bot_instance()
-        if bot:
-             try:
-                 await bot.send_message(
-                     chat_id=sub['submitted_by'],
-                     text=f"❌ <b>ЗАЯВКА ОТКЛОНЕНА</b>\n\nВаша заявка #{submission_id} была отклонена.\n\n<b>Причина:</b> {reason}\n\nПроверьте данные и отправьте заново.",
-                     parse_mode="HTML"
-                 )
-             except Exception as notify_err:
-                 print(f"Failed to notify user about rejection: {notify_err}")
+        await notify_telegram(
+            company_id, [sub['submitted_by']],
+            f"❌ <b>ЗАЯВКА ОТКЛОНЕНА</b>\n\nВаша заявка #{submission_id} была отклонена.\n\n<b>Причина:</b> {reason}\n\nПроверьте данные и отправьте заново.",
+            'submission_rejected'
+        )
                  
         return safe_json_response({'success': True, 'message': 'Заявка отклонена'})
     except Exception as e:
@@ -1295,13 +1351,10 @@ async def send_order_telegram_api(request):
                 
         message = "\n".join(message_lines)
         
-        await bot.send_message(
-            chat_id=user['id'],
-            text=message,
-            parse_mode="HTML"
-        )
+        company_id = await get_current_company(request)
+        await notify_telegram(company_id, [user['id']], message, 'purchase_order')
         
-        return safe_json_response({'success': True, 'message': 'Список закупа успешно отправлен в ваш Telegram'})
+        return safe_json_response({'success': True, 'message': 'Список закупа поставлен в очередь отправки в ваш Telegram'})
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -1411,50 +1464,42 @@ async def send_order_telegram_api(request):
         if not bot:
              return safe_json_response({'error': 'Бот не инициализирован. Уведомление не отправлено.'}, status=500)
              
+        company_id = await get_current_company(request)
+        order_type = data.get('type', 'auto') 
+        notes = f"Автоматический смарт план на {days} дней" if order_type == 'auto' else "Ручной заказ через Web"
+
         # Fetch all box_weights once for efficiency
         product_ids = [item.get('product_id') for item in items if item.get('product_id')]
         products_info = {}
         if product_ids:
-            async with db.pool.acquire() as conn:
+            async with db.acquire() as conn:
                 rows = await conn.fetch("SELECT id, box_weight, units_per_box FROM products WHERE id = ANY($1)", product_ids)
                 for r in rows:
                     products_info[r['id']] = {'box_weight': r['box_weight'], 'units_per_box': r.get('units_per_box', 1)}
 
-        # 1. Сохраняем в базу как "Ожидающий приход"
-        try:
-            company_id = await get_current_company(request)
-            order_type = data.get('type', 'auto') 
-            notes = f"Автоматический смарт план на {days} дней" if order_type == 'auto' else "Ручной заказ через Web"
-            
-            # Создаем заказ
-            order_id = await db.create_pending_order(company_id, total_cost, notes)
+        # 1. Позиции заказа "Ожидающий приход"
+        # В items у нас должен быть product_id и box_weight. Иначе пропускаем.
+        order_items = []
+        for item in items:
+            product_id = item.get('product_id')
+            boxes = item.get('order_boxes', 0)
             
-            # Добавляем товары
-            # В items у нас должен быть product_id и box_weight. Иначе пропускаем.
-            for item in items:
-                product_id = item.get('product_id')
-                boxes = item.get('order_boxes', 0)
-                
-                if not product_id or boxes <= 0:
-                    continue
-                    
-                cost = item.get('item_total', 0)
-                
-                # Fetch reliable box_weight from the database instead of trusting the frontend payload
-                p_info = products_info.get(product_id, {})
-                box_weight = float(p_info.get('box_weight', item.get('box_weight', 1.0)))
-                
-                # Если товар в штуках (unit == 'шт'), то вес это просто кол-во штук = boxes * units_per_box
-                # Но так как мы не всегда знаем unit в этом объекте на 100%, 
-                # мы полагаемся на логику: если weight_ordered был передан, берем его. 
-                # Иначе считаем классический (коробки * вес коробки).
-                weight_ordered = boxes * box_weight
-                
-                await db.add_item_to_order(order_id, product_id, boxes, weight_ordered, cost)
+            if not product_id or boxes <= 0:
+                continue
                 
-        except Exception as db_err:
-            print(f"Ошибка сохранения ожидающего заказа в БД: {db_err}")
-            # Мы не прерываем отправку в ТГ, если БД упала, но логируем.
+            cost = item.get('item_total', 0)
+            
+            # Fetch reliable box_weight from the database instead of trusting the frontend payload
+            p_info = products_info.get(product_id, {})
+            box_weight = float(p_info.get('box_weight', item.get('box_weight', 1.0)))
+            
+            # Если товар в штуках (unit == 'шт'), то вес это просто кол-во штук = boxes * units_per_box
+            # Но так как мы не всегда знаем unit в этом объекте на 100%, 
+            # мы полагаемся на логику: если weight_ordered был передан, берем его. 
+            # Иначе считаем классический (коробки * вес коробки).
+            weight_ordered = boxes * box_weight
+            order_items.append({'product_id': product_id, 'boxes_ordered': boxes,
+                                'weight_ordered': weight_ordered, 'cost': cost})
 
         # 2. Формируем официальное сообщение для поставщика
         message_lines = [
@@ -1467,8 +1512,7 @@ async def send_order_telegram_api(request):
             
             if boxes > 0:
                 message_lines.append(f"- {name}: {boxes} уп.")
-                # Fetch Active Debts to append reminder
-        company_id = await get_current_company(request) # Ensure company_id is available here
+        # Fetch Active Debts to append reminder
         debts = await db.get_active_debts(company_id)
         if debts:
             message_lines.append("\n\n⚠️ <b>Напоминание о долгах поставщика:</b>\n")
@@ -1479,45 +1523,38 @@ async def send_order_telegram_api(request):
 
         message = "\n".join(message_lines)
 
-        # Send via telegram
-        bot = get_bot_instance()
-        if not bot:
-            return safe_json_response({'error': 'Бот не инициализирован (telegram_mode error)'}, status=500)
-            
         admin_ids = await db.get_admins_for_company(company_id)
+        notifications = [notification(admin_ids, message, 'purchase_order')] if admin_ids else []
+
+        # 3. Заказ, позиции и уведомление админам - одной транзакцией.
+        # Отправляет фоновый воркер outbox: запрос не ждет Telegram, а редеплой не теряет сообщение.
+        try:
+            await db.create_pending_order_with_items(company_id, total_cost, notes, order_items, notifications)
+        except Exception as db_err:
+            print(f"Ошибка сохранения ожидающего заказа в БД: {db_err}")
+            # Мы не прерываем отправку в ТГ, если БД упала, но логируем.
+            await notify_telegram(company_id, admin_ids, message, 'purchase_order')
+
         if not admin_ids:
             return safe_json_response({'error': 'Нет администраторов для уведомления в текущей компании'}, status=400)
             
-        success_count = 0
-        for admin_id in admin_ids:
-            try:
-                await bot.send_message(chat_id=admin_id, text=message, parse_mode="HTML")
-                success_count += 1
-            except Exception as tg_err:
-                print(f"Ошибка отправки заказа админу {admin_id}: {tg_err}")
-                
-        if success_count == 0:
-            return safe_json_response({'error': 'Не удалось доставить список закупа в Telegram'}, status=500)
-            
-        return safe_json_response({'success': True, 'message': f'Список закупа успешно отправлен в Telegram ({success_count}/{len(admin_ids)} чел.)'})
+        return safe_json_response({'success': True, 'message': f'Список закупа поставлен в очередь отправки в Telegram ({len(admin_ids)} чел.)'})
     except Exception as e:
         import traceback
         traceback.print_exc()
         return safe_json_response({'error': str(e)}, status=500)
 
-
 async def api_get_pending_orders(request):
     """API: Получить ожидающие заказы для Приемки"""
     user = await get_current_user(request)
     if not user: return safe_json_response({'error': 'Unauthorized'}, status=401)
     company_id = await get_current_company(request)
     try:
-        orders_list = await db.get_pending_orders(company_id)
+        # Заказы и их позиции одним запросом (без запроса на каждый заказ)
+        orders_list = await db.get_pending_orders_with_items(company_id)
         for order in orders_list:
             if 'created_at' in order and order['created_at']:
                 order['created_at'] = order['created_at'].strftime('%Y-%m-%d %H:%M')
-            items = await db.get_pending_order_items(order['id'])
-            order['items'] = items
         return safe_json_response({'success': True, 'orders': orders_list})
     except Exception as e:
         return safe_json_response({'error': str(e)}, status=500)
@@ -1580,8 +1617,13 @@ async def api_cancel_debt(request):
     except Exception as e:
         return safe_json_response({'error': str(e)}, status=500)
 
-def create_app():
-    """Создать приложение aiohttp"""
+def create_app(database=None):
+    """Создать приложение aiohttp
+
+    Args:
+        database: уже инициализированный экземпляр БД (общий пул процесса).
+                  Если не передан - сервер сам создаст и закроет БД (отдельный запуск).
+    """
     app = web.Application()
 
     cors = aiohttp_cors.setup(app, defaults={
@@ -1657,6 +1699,7 @@ def create_app():
     app.router.add_post('/api/superadmin/companies/{id}/subscription', api_update_company_subscription)
     app.router.add_post('/api/superadmin/products', api_add_superadmin_product)
     app.router.add_delete('/api/superadmin/companies/{id}', api_delete_company)
+    app.router.add_get('/api/superadmin/db_stats', api_superadmin_db_stats)
 
     app.router.add_get('/staff', staff_page)
     app.router.add_post('/api/company/invite', api_invite_staff)
@@ -1695,6 +1738,9 @@ def create_app():
 
     session_key = os.getenv('SESSION_KEY')
     if not session_key:
+        # Ключ живет только в этом процессе: с несколькими воркерами или репликами
+        # сессии не переживут переход между ними (см. Settings.validate)
+        print("⚠️ SESSION_KEY не задан: используется случайный ключ, сессии сбросятся при перезапуске")
         session_key = os.urandom(32)
     elif isinstance(session_key, str):
         session_key = session_key.encode()
@@ -1715,8 +1761,12 @@ def create_app():
 
     app.middlewares.append(auth_middleware)
 
-    app.on_startup.append(init_db)
-    app.on_cleanup.append(close_db)
+    if database is not None:
+        # Общий пул: жизненным циклом управляет владелец (main.py)
+        set_database(database)
+    else:
+        app.on_startup.append(init_db)
+        app.on_cleanup.append(close_db)
 
     return app
 
@@ -1740,7 +1790,7 @@ async def superadmin_page(request):
     # Двойная проверка, что пользователь именно Супер-Админ (создатель Платформы)
     # В этой версии Супер-Админ - это тот, кто первым зарегистрировался (id=1) 
     # или чья `company_id` = 1, но для надежности можно проверить БД:
-    async with db.pool.acquire() as conn:
+    async with db.acquire() as conn:
         record = await conn.fetchrow("SELECT role, company_id FROM users WHERE id = $1", user['id'])
         if not record or record['role'] != 'admin' or record['company_id'] != 1:
             return web.Response(text="Доступ запрещен. Только для Платформодержателя.", status=403)
@@ -1934,6 +1984,25 @@ async def api_delete_company(request):
         print(f"Ошибка api_delete_company: {e}")
         return safe_json_response({'error': str(e)}, status=500)
 
+async def api_superadmin_db_stats(request):
+    """API: Статистика пула соединений и кэша запросов (только для Super-Admin)"""
+    user = await get_current_user(request)
+    if not user or user.get('role') != 'admin' or user.get('company_id') != 1:
+        return safe_json_response({'error': 'Доступ запрещен'}, status=403)
+
+    if not hasattr(db, 'pool_stats'):
+        return safe_json_response({'error': 'Статистика доступна только для PostgreSQL'}, status=400)
+
+    stats = db.pool_stats()
+    stats['query_cache'] = db.query_cache.stats() if db.query_cache else None
+    stats['auth_cache'] = auth_cache.stats()
+    stats['scheduler_jobs'] = company_jobs.last_reports
+    bot = get_bot_instance()
+    stats['telegram'] = get_dispatcher(bot).stats() if bot else None
+    stats['notification_outbox'] = await db.get_outbox_stats()
+    return safe_json_response(stats)
+
+
 async def staff_page(request):
     """Страница управления сотрудниками (Только для Admin/Manager)"""
     user = await get_current_user(request)
@@ -2342,19 +2411,11 @@ async def api_company_broadcast(request):
             return safe_json_response({'error': 'Empty message'}, status=400)
             
         users = await db.get_users_by_company(company_id)
-        bot = get_bot_instance()
-        count = 0
-        if bot:
-            for u in users:
-                if u.get('is_active'):
-                    try:
-                        await bot.send_message(
-                            chat_id=u['id'], 
-                            text=f"📢 <b>Объявление от администратора</b>\n\n{message}"
-                        )
-                        count += 1
-                    except Exception:
-                        pass
-        return safe_json_response({'success': True, 'sent_count': count})
+        # Рассылка только ставится в очередь (notification_outbox) и уходит в фоне с учетом
+        # лимитов Telegram, поэтому возвращаем число поставленных, а не доставленных сообщений
+        recipients = [u['id'] for u in users if u.get('is_active')]
+        count = await notify_telegram(
+            company_id, recipients, f"📢 <b>Объявление от администратора</b>\n\n{message}", 'broadcast')
+        return safe_json_response({'success': True, 'queued_count': count})
     except Exception as e:
         return safe_json_response({'error': str(e)}, status=500)